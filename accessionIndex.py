@@ -0,0 +1,135 @@
+"""Offline accession -> taxon ID index, built from the NCBI accession2taxid dumps (e.g.
+nucl_gb.accession2taxid.gz, with columns accession, accession.version, taxid and gi) or from
+two-column files (accession and taxid, such as the acc_2_taxid.tsv of process_usearch.py).
+
+The index is a single binary file made of sorted segments. Each segment holds up to 'chunkSize'
+entries: the accessions (without version), as fixed width strings sorted in ascending order, and
+their taxon IDs (int32). Building the index only needs to sort one segment in memory at a time,
+and a lookup is a binary search in each segment (numpy.searchsorted over the mmap'ed file), done
+for many accessions at once. Layout (little endian, sections aligned to 8 bytes):
+    header:   magic, number of segments, offset of the segment table
+    segments: keys (char[count][width]) and taxon IDs (int32[count]) of each segment
+    table:    count, width, offset of the keys and offset of the taxon IDs of each segment
+"""
+
+import sys, mmap, struct, itertools, numpy as np
+from compressedFiles import openInput
+
+MAGIC   = "MTAXACC1"
+HEADER  = struct.Struct("<8sQQ")
+SEGMENT = struct.Struct("<QQQQ")
+NOT_FOUND = -1
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _pad(out):
+    out.write("\0"*(_align(out.tell()) - out.tell()))
+
+def _entries(fileName, chunkSize):
+    """Returns a generator of (accessions, taxon IDs) lists, with up to chunkSize entries each.
+    """
+    f = openInput(fileName, "rt")
+    first = f.readline()
+    fields = first.split()
+    if len(fields) == 0:
+        return
+    if fields[0] == "accession": # Header of the NCBI dumps
+        keyCol, taxCol, nCols = fields.index("accession"), fields.index("taxid"), len(fields)
+        lines = f
+    else:
+        keyCol, taxCol, nCols = 0, 1, len(fields)
+        lines = itertools.chain([first], f)
+    while True:
+        chunk = list(itertools.islice(lines, chunkSize))
+        if len(chunk) == 0:
+            break
+        tokens = "".join(chunk).split()
+        if len(tokens) != len(chunk)*nCols:
+            raise ValueError("%s: all lines must have %i columns"%(fileName, nCols))
+        yield tokens[keyCol::nCols], tokens[taxCol::nCols]
+
+def buildIndex(srcFiles, outFile, chunkSize = 5000000):
+    """Builds an accession index.
+    Args:
+        srcFiles: list of accession2taxid files (can be compressed).
+        outFile: index file to be created.
+        chunkSize: number of entries of each segment (sorted in memory).
+    Returns:
+        the number of accessions in the index.
+    """
+    out = open(outFile, "wb")
+    out.write(HEADER.pack(MAGIC, 0, 0))
+    _pad(out)
+    table = []
+    for srcFile in srcFiles:
+        for keys, taxIds in _entries(srcFile, chunkSize):
+            keys   = np.array([k.split(".")[0] for k in keys])
+            taxIds = np.array(taxIds, dtype="<i4")
+            order  = np.argsort(keys, kind="mergesort")
+            keysOffset = out.tell()
+            out.write(keys[order].tostring())
+            _pad(out)
+            taxIdsOffset = out.tell()
+            out.write(taxIds[order].tostring())
+            _pad(out)
+            table.append((len(keys), keys.dtype.itemsize, keysOffset, taxIdsOffset))
+    tableOffset = out.tell()
+    for segment in table:
+        out.write(SEGMENT.pack(*segment))
+    out.seek(0)
+    out.write(HEADER.pack(MAGIC, len(table), tableOffset))
+    out.close()
+    return sum(s[0] for s in table)
+
+class AccessionIndex(object):
+    """Read only view of an index created by buildIndex().
+    """
+    def __init__(self, indexFile):
+        self.fileName = indexFile
+        f = open(indexFile, "rb")
+        self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic, nSegments, tableOffset = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not an accession index"%indexFile)
+        self.segments = []
+        for i in range(nSegments):
+            count, width, keysOffset, taxIdsOffset = SEGMENT.unpack_from(self.buf, tableOffset + i*SEGMENT.size)
+            keys   = np.frombuffer(self.buf, dtype="S%i"%width, count=count, offset=keysOffset)
+            taxIds = np.frombuffer(self.buf, dtype="<i4", count=count, offset=taxIdsOffset)
+            self.segments.append((width, keys, taxIds))
+
+    def __len__(self):
+        return sum(len(keys) for _, keys, _ in self.segments)
+
+    def lookup(self, accessions):
+        """Returns the taxon IDs of many accessions (without version) at once, as an int32 numpy array
+        (NOT_FOUND for accessions not in the index).
+        """
+        queries = np.array(accessions, dtype="S")
+        result  = np.full(len(queries), NOT_FOUND, dtype=np.int32)
+        if len(queries) == 0:
+            return result
+        lengths = np.char.str_len(queries)
+        for width, keys, taxIds in self.segments:
+            if len(keys) == 0:
+                continue
+            q   = queries.astype("S%i"%width)
+            pos = np.minimum(np.searchsorted(keys, q), len(keys) - 1)
+            found = (keys[pos] == q) & (lengths <= width)
+            result[found] = taxIds[pos[found]]
+        return result
+
+    def get(self, accession):
+        """Returns the taxon ID of an accession, or NOT_FOUND.
+        """
+        return int(self.lookup([accession])[0])
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: python %s indexFile accession2taxid [accession2taxid ...]"%sys.argv[0]
+        print "Builds an accession index from NCBI accession2taxid files (e.g. nucl_gb.accession2taxid.gz)"
+        sys.exit(1)
+    n = buildIndex(sys.argv[2:], sys.argv[1])
+    print "%i accessions written to %s"%(n, sys.argv[1])
@@ -0,0 +1,271 @@
+"""Benchmark of MetaTax on synthetic data, that runs offline. It creates:
+    - a small taxonomy (NCBI taxdump format), converted to a taxonomy snapshot (see taxonomySnapshot.py),
+      so neither ete3 nor its database are needed;
+    - a metagenome: a FASTA or FASTQ reads file, where each read comes from a random species;
+    - the outputs of several classifiers for the reads (in the formats of the plugins: Kraken, Clark,
+      Centrifuge, OneCodex, USEARCH, ...), where each tool reports the species of the read, its genus,
+      a wrong taxon or nothing, with a tunable disagreement rate.
+Then it runs metaTax.py with -report and appends the time of each stage (parsing of each classifier,
+lineage resolution, voting, output, ...) to a results file (JSON lines), together with the version
+(git revision) and the parameters, and compares the run with the last one with the same parameters.
+
+With -startup, it measures instead the start up time of metaTax.py: the wall time of 'metaTax.py --help'
+and of a run on a small sample (use a small -reads value), as the median of -repeat runs.
+
+Usage example:
+    python benchmark.py -reads 100000 -tools 5 -disagreement 0.2 -metatax-args "-workers 4"
+    python benchmark.py -startup -reads 100 -tools 2 -repeat 10
+"""
+
+import sys, os, json, time, random, argparse, tempfile, subprocess, shutil
+from os.path import join, abspath, dirname
+from collections import OrderedDict
+import config, taxonomySnapshot
+
+myPath = dirname(abspath(__file__))
+
+# ----------------------------------------------
+# Synthetic taxonomy
+# ----------------------------------------------
+def makeTaxonomy(outDir, nSpecies = 500, branching = 3, seed = 0):
+    """Creates a random taxonomy with the ranks of config.allowedRank (plus some intermediate 'no rank'
+    nodes) and about nSpecies species, and builds its snapshot.
+    Args:
+        outDir: directory where the taxdump (outDir/taxdump) and the snapshot (outDir/taxonomy.snap) are created.
+        nSpecies: approximate number of species.
+        branching: maximum number of children of each node above the genus level.
+        seed: random seed.
+    Returns:
+        (snapshot file, list of species taxon IDs, dictionary taxon ID -> parent taxon ID).
+    """
+    rnd = random.Random(seed)
+    dumpDir = join(outDir, "taxdump")
+    if not os.path.isdir(dumpDir):
+        os.makedirs(dumpDir)
+    parent = {1: 1}
+    rank   = {1: "no rank"}
+    level  = [1]
+    nextId = [2]
+    def newNode(p, r):
+        tid = nextId[0]
+        nextId[0] += 1
+        parent[tid] = p
+        rank[tid]   = r
+        return tid
+    genusRank = len(config.allowedRank) - 2
+    for i, r in enumerate(config.allowedRank):
+        children = []
+        for p in level:
+            if r == config.allowedRank[-1]: # Species per genus, to get about nSpecies species
+                n = max(1, int(round(rnd.uniform(0.5, 1.5)*nSpecies/len(level))))
+            elif i == 0:
+                n = 2
+            else:
+                n = rnd.randint(1, branching)
+            for j in range(n):
+                if 0 < i < genusRank and rnd.random() < 0.1: # Intermediate node without rank
+                    p = newNode(p, "no rank")
+                children.append(newNode(p, r))
+        level = children
+    species = level
+    f = open(join(dumpDir, "nodes.dmp"), "wt")
+    for tid in sorted(parent.keys()):
+        f.write("%i\t|\t%i\t|\t%s\t|\n"%(tid, parent[tid], rank[tid]))
+    f.close()
+    f = open(join(dumpDir, "names.dmp"), "wt")
+    for tid in sorted(parent.keys()):
+        name = "root" if tid == 1 else "%s %i"%(rank[tid].replace(" ", "_"), tid)
+        f.write("%i\t|\t%s\t|\t\t|\tscientific name\t|\n"%(tid, name))
+    f.close()
+    open(join(dumpDir, "merged.dmp"), "wt").close() # No merged taxon IDs
+    snapshot = join(outDir, "taxonomy.snap")
+    taxonomySnapshot.buildSnapshot(dumpDir, snapshot)
+    return snapshot, species, parent
+
+# ----------------------------------------------
+# Synthetic metagenome and classifier outputs
+# ----------------------------------------------
+# Writers of the output of each tool: (plugin name, header, function(read name, taxon ID) -> line).
+# Taxon ID 0 means that the tool did not classify the read.
+toolFormats = [
+    ("kraken",     None,                          lambda r, t: "%s\t%s\t%i\t150\t%i:116\n"%("C" if t else "U", r, t, t)),
+    ("clark",      None,                          lambda r, t: "%s,150,%s,0.9\n"%(r, t if t else "NA")),
+    ("centrifuge", "readID\tseqID\ttaxID\tscore\n", lambda r, t: "%s\tseq%i\t%i\t900\n"%(r, t, t)),
+    ("onecodex",   "Header\tTaxid\n",               lambda r, t: "%s\t%i\n"%(r, t)),
+    ("usearch",    None,                          lambda r, t: "%s\t%i\t99.000000\t0.000001\n"%(r, t)),
+    ("caravela",   "read\ttaxid\n",                 lambda r, t: "%s\t%i\n"%(r, t)),
+    ("clarkS",     None,                          lambda r, t: "%s,150,%s,%s,0.9\n"%(r, t if t else "NA", t if t else "NA")),
+    ]
+
+def makeSample(outDir, species, parent, nReads = 10000, nTools = 5, disagreement = 0.2, missing = 0.05,
+               fastq = False, seed = 0):
+    """Creates a reads file and the outputs of nTools classifiers (the formats of toolFormats are used
+    in turn). For each read, a tool does not report it (or reports it as unclassified) with probability
+    'missing', reports a random taxon with probability 'disagreement', and otherwise reports the
+    species of the read or (one in five times) its genus.
+    Returns:
+        the input file for metaTax.py.
+    """
+    rnd = random.Random(seed)
+    ext = "fq" if fastq else "fa"
+    readsFile = join(outDir, "reads.%s"%ext)
+    reads = open(readsFile, "wt")
+    tools = []
+    for i in range(nTools):
+        name, header, line = toolFormats[i%len(toolFormats)]
+        fileName = join(outDir, "%s_%i.out"%(name, i))
+        f = open(fileName, "wt")
+        if header:
+            f.write(header)
+        tools.append((name, fileName, f, line))
+    allTaxa = parent.keys()
+    seq  = "ACGT"*37 + "AC"
+    qual = "I"*len(seq)
+    for i in range(nReads):
+        rname = "read%i"%i
+        if fastq:
+            reads.write("@%s/1\n%s\n+\n%s\n"%(rname, seq, qual))
+        else:
+            reads.write(">%s/1\n%s\n"%(rname, seq))
+        sp = rnd.choice(species)
+        for name, fileName, f, line in tools:
+            x = rnd.random()
+            if x < missing: # Not reported, or reported as unclassified
+                if rnd.random() < 0.5:
+                    f.write(line(rname, 0))
+                continue
+            elif x < missing + disagreement:
+                f.write(line(rname, rnd.choice(allTaxa)))
+            elif rnd.random() < 0.2:
+                f.write(line(rname, parent[sp]))
+            else:
+                f.write(line(rname, sp))
+    reads.close()
+    inputFile = join(outDir, "input.txt")
+    f = open(inputFile, "wt")
+    f.write("%s\n%i\n"%(readsFile, nTools))
+    for name, fileName, out, line in tools:
+        out.close()
+        f.write("%s\n%s\n"%(name, fileName))
+    f.close()
+    return inputFile
+
+# ----------------------------------------------
+# Benchmark
+# ----------------------------------------------
+def version():
+    """Returns the git revision of MetaTax (with '-dirty' if there are uncommitted changes), or 'unknown'.
+    """
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd = myPath,
+                                       stderr = open(os.devnull, "w")).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def runMetaTax(inputFile, outDir, snapshot, extraArgs = []):
+    """Runs metaTax.py with -report and returns the report of the sample.
+    """
+    if os.path.isdir(outDir):
+        shutil.rmtree(outDir)
+    command = [sys.executable, join(myPath, "metaTax.py"), inputFile, outDir, "-report", "-taxonomy", snapshot] + extraArgs
+    start = time.time()
+    subprocess.check_call(command, cwd = myPath)
+    elapsed = time.time() - start
+    reports = [f for f in os.listdir(outDir) if f.endswith("_report.json")]
+    report = json.load(open(join(outDir, reports[0]), "rt"), object_pairs_hook = OrderedDict)
+    report['wallTime'] = elapsed # Including start up
+    return report
+
+def wallTime(command, repeat = 5):
+    """Returns the median wall time (in seconds) of 'repeat' runs of a command.
+    """
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        subprocess.check_call(command, cwd = myPath, stdout = open(os.devnull, "w"))
+        times.append(time.time() - start)
+    return sorted(times)[len(times)//2]
+
+def startupTimes(inputFile, outDir, snapshot, extraArgs = [], repeat = 5):
+    """Returns the median wall time of 'metaTax.py --help' ('help') and of metaTax.py on a sample ('run').
+    """
+    metaTax = join(myPath, "metaTax.py")
+    return OrderedDict([('help', wallTime([sys.executable, metaTax, "--help"], repeat)),
+                        ('run', wallTime([sys.executable, metaTax, inputFile, outDir, "-taxonomy", snapshot] + extraArgs, repeat))])
+
+def compare(previous, current):
+    """Returns the lines of a comparison of the stage times of two runs.
+    """
+    lines = ["%-20s %10s %10s %8s"%("stage", "previous", "current", "change")]
+    stages = current['report']['stages'].keys() + ['elapsed', 'wallTime']
+    for stage in stages:
+        old = previous['report']['stages'].get(stage, previous['report'].get(stage))
+        new = current['report']['stages'].get(stage, current['report'].get(stage))
+        if old is None or new is None:
+            continue
+        change = (new - old)*100.0/old if old > 0 else 0.0
+        lines.append("%-20s %10.3f %10.3f %+7.1f%%%s"%(stage, old, new, change, "  <--" if change > 10 and new - old > 0.05 else ""))
+    return lines
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description = "Benchmark of MetaTax on synthetic data")
+    argp.add_argument('-reads', help = 'Number of reads (default: 100000)', type = int, default = 100000)
+    argp.add_argument('-tools', help = 'Number of classifiers (default: 5)', type = int, default = 5)
+    argp.add_argument('-disagreement', help = 'Probability that a tool reports a random taxon (default: 0.2)', type = float, default = 0.2)
+    argp.add_argument('-missing', help = 'Probability that a tool does not report a read (default: 0.05)', type = float, default = 0.05)
+    argp.add_argument('-species', help = 'Approximate number of species of the taxonomy (default: 500)', type = int, default = 500)
+    argp.add_argument('-fastq', help = 'Write the reads in FASTQ format (default: FASTA)', action = "store_true")
+    argp.add_argument('-seed', help = 'Random seed (default: 0)', type = int, default = 0)
+    argp.add_argument('-repeat', help = 'Number of runs (default: 1, or 5 with -startup)', type = int)
+    argp.add_argument('-startup', help = 'Measure the start up time of metaTax.py (--help and a run on the sample)', action = "store_true")
+    argp.add_argument('-metatax-args', help = 'Other arguments for metaTax.py (e.g. "-workers 4 -voting batch")', default = "")
+    argp.add_argument('-workdir', help = 'Directory for the synthetic data and outputs (default: a temporary directory, removed at the end)')
+    argp.add_argument('-results', help = 'File where results are appended (default: benchmarks.jsonl)', default = "benchmarks.jsonl")
+    args = argp.parse_args()
+
+    workDir = args.workdir or tempfile.mkdtemp(prefix = "metatax_benchmark_")
+    if not os.path.isdir(workDir):
+        os.makedirs(workDir)
+    params = dict(reads = args.reads, tools = args.tools, disagreement = args.disagreement, missing = args.missing,
+                  species = args.species, fastq = args.fastq, seed = args.seed, metataxArgs = args.metatax_args)
+    if args.startup:
+        params['startup'] = True
+    repeat = args.repeat or (5 if args.startup else 1)
+    try:
+        start = time.time()
+        snapshot, species, parent = makeTaxonomy(workDir, args.species, seed = args.seed)
+        inputFile = makeSample(workDir, species, parent, args.reads, args.tools, args.disagreement, args.missing,
+                               args.fastq, args.seed)
+        print "Synthetic data created in %0.1f s (%i taxa, %i reads, %i tools)"%(time.time() - start, len(parent), args.reads, args.tools)
+        previous = None
+        if os.path.isfile(args.results):
+            for l in open(args.results, "rt"):
+                r = json.loads(l, object_pairs_hook = OrderedDict)
+                if dict(r['params']) == params:
+                    previous = r
+        if args.startup:
+            times  = startupTimes(inputFile, join(workDir, "out"), snapshot, args.metatax_args.split(), repeat)
+            result = dict(version = version(), date = time.strftime("%Y-%m-%d %H:%M:%S"), params = params, startup = times)
+            f = open(args.results, "at")
+            f.write(json.dumps(result) + "\n")
+            f.close()
+            for name, seconds in times.items():
+                print "%-20s %10.3f%s"%(name, seconds, " (previous: %0.3f)"%previous['startup'][name] if previous else "")
+            repeat = 0
+        for i in range(repeat):
+            outDir = join(workDir, "out%i"%i)
+            report = runMetaTax(inputFile, outDir, snapshot, args.metatax_args.split())
+            result = dict(version = version(), date = time.strftime("%Y-%m-%d %H:%M:%S"), params = params, report = report)
+            f = open(args.results, "at")
+            f.write(json.dumps(result) + "\n")
+            f.close()
+            print "Run %i: %i reads in %0.2f s (%0.0f reads/s)"%(i + 1, report['reads'], report['elapsed'], report['readsPerSecond'])
+            if previous is not None:
+                print "\n".join(compare(previous, result))
+            else:
+                for stage, seconds in report['stages'].items():
+                    print "%-20s %10.3f"%(stage, seconds)
+            previous = result
+    finally:
+        if args.workdir is None:
+            shutil.rmtree(workDir)
@@ -0,0 +1,199 @@
+"""Classifier tables spilled to disk, for samples whose tables do not fit in memory (-max-memory option
+of metaTax.py). The entries of the classifier outputs, and the names of the reads, are partitioned by
+the hash of the read name (see util.readBucket()) into buckets written to temporary files. Buckets are
+then loaded one at a time as ClassifierTables and classified together with the reads of the bucket,
+so only the tables of one bucket are in memory and classifier outputs can be in any order (e.g.
+Kraken outputs of multithreaded runs). Reads are classified, and written, bucket by bucket: within
+each bucket they keep the order of the reads file.
+
+Bucket files are text files with one entry per line: "read name<TAB>taxon ID" for classifier outputs
+and the read name for reads files.
+"""
+
+import os, math, time, shutil, tempfile, itertools, multiprocessing, numpy as np
+from os.path import join
+import config, pluginRegistry, classifierTables
+from util import readBuckets
+from getTaxonomyFromEte3 import resetNCBI, resolveNames
+from sampleScheduler import estimateFootprint
+
+# Approximate size in bytes of the chunks of classifier outputs parsed at once
+CHUNK_SIZE = 1 << 22
+
+def maxBuckets(workers = 1):
+    """Returns the maximum number of buckets: config.maxBuckets, capped so that the bucket files, which are
+    open at the same time while the tables are spilled, fit in the soft limit of open files of the process
+    (RLIMIT_NOFILE) with config.reservedFiles, and config.filesPerWorker for each of 'workers' worker processes,
+    left for MetaTax.
+    """
+    try:
+        import resource
+    except ImportError: # Not available on Windows
+        return config.maxBuckets
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return config.maxBuckets
+    return max(1, min(config.maxBuckets, soft - config.reservedFiles - config.filesPerWorker*workers))
+
+def bucketCount(fileNames, maxMemory, workers = 1):
+    """Returns the number of buckets needed to keep the tables of a sample within maxMemory MB (1 if they fit
+    in memory), up to maxBuckets(workers). The memory of the whole sample is estimated with
+    sampleScheduler.estimateFootprint().
+    Args:
+        fileNames: classifier output files of the sample.
+        maxMemory: maximum memory of the sample, in MB.
+        workers: number of worker processes that spill classifier outputs.
+    """
+    footprint = estimateFootprint(fileNames)
+    if footprint <= maxMemory:
+        return 1
+    limit     = maxBuckets(workers)
+    tables    = footprint - config.sampleBaseMemory
+    available = max(maxMemory - config.sampleBaseMemory, tables/limit)
+    return int(min(math.ceil(tables/available), limit))
+
+def _chunks(module, srcFile, shard = None):
+    """Returns a generator of (read names, taxon IDs) tuples with the entries of a classifier output (of the
+    reads of a shard, if given), in chunks.
+    """
+    if hasattr(module, "params"): # Parsed in chunks (see parserEngine.py)
+        import parserEngine
+        for names, taxIds in parserEngine.parseChunks(srcFile, module.params, CHUNK_SIZE, shard):
+            yield names, taxIds.tolist()
+        return
+    entries = classifierTables.iterTaxIds(module, srcFile, shard)
+    while True:
+        chunk = list(itertools.islice(entries, 100000))
+        if len(chunk) == 0:
+            break
+        yield [e[0] for e in chunk], [e[1] for e in chunk]
+
+def _spill(fileNames, chunks, stride = 1):
+    """Writes each entry of the chunks to the file of its bucket. Chunks are (read names, taxon IDs) tuples,
+    where taxon IDs is None for the names of a reads file. Stride is the number of shards (see util.readBucket()).
+    Returns:
+        the number of entries.
+    """
+    files = [open(f, "wb", 1 << 16) for f in fileNames]
+    n = 0
+    for names, taxIds in chunks:
+        if len(names) == 0:
+            continue
+        if taxIds is None:
+            lines = [name + "\n" for name in names]
+        else:
+            lines = ["%s\t%i\n"%entry for entry in itertools.izip(names, taxIds)]
+        buckets = np.array(readBuckets(names, len(files), stride))
+        order   = np.argsort(buckets, kind = "mergesort") # Stable: entries keep their order in each bucket
+        bounds  = np.searchsorted(buckets[order], np.arange(len(files) + 1))
+        for b, f in enumerate(files):
+            if bounds[b] < bounds[b + 1]:
+                f.write("".join([lines[i] for i in order[bounds[b]:bounds[b + 1]].tolist()]))
+        n += len(names)
+    for f in files:
+        f.close()
+    return n
+
+def _spillSource(task):
+    """Spills the entries of a classifier output (in a worker process, if called through BucketTables.addClassifiers()).
+    Returns:
+        (number of entries, seconds).
+    """
+    start = time.time()
+    fileNames, (moduleName, srcFile), shard = task
+    n = _spill(fileNames, _chunks(pluginRegistry.getPlugin(moduleName), srcFile, shard), shard[1] if shard else 1)
+    return n, time.time() - start
+
+# ----------------------------------------------
+class BucketTables(object):
+    """Classifier tables of one sample partitioned in buckets, in a temporary directory.
+    Args:
+        nBuckets: number of buckets.
+        tmpDir: directory where the temporary directory of the buckets is created.
+        shard: (i, N) tuple if only the reads of shard i of N are classified, or None.
+    """
+    def __init__(self, nBuckets, tmpDir = None, shard = None):
+        self.nBuckets = nBuckets
+        self.shard    = shard
+        self.dirName  = tempfile.mkdtemp(prefix = "buckets", dir = tmpDir)
+        self.sources  = 0
+        self.entries  = 0
+        self.reads    = None # Number of reads, if the reads file was spilled
+
+    def fileNames(self, source):
+        """Returns the names of the bucket files of a source: the index of a classifier or "reads".
+        """
+        return [join(self.dirName, "%s.%i"%(source, b)) for b in range(self.nBuckets)]
+
+    def addClassifiers(self, sources, workers = 1, times = None):
+        """Spills the outputs of several classifiers, up to 'workers' of them at the same time.
+        Args:
+            sources: list of (plugin module name, classifier output file) tuples.
+            workers: maximum number of classifier outputs parsed at once (in worker processes).
+            times: if given, a list where the seconds spent spilling each source are appended.
+        """
+        tasks   = [(self.fileNames(self.sources + i), source, self.shard) for i, source in enumerate(sources)]
+        workers = min(workers, len(sources))
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer = resetNCBI)
+            results = pool.map(_spillSource, tasks)
+            pool.close()
+            pool.join()
+        else:
+            results = map(_spillSource, tasks)
+        for n, seconds in results:
+            self.entries += n
+            if times is not None:
+                times.append(seconds)
+        self.sources += len(sources)
+
+    def addReads(self, readNames):
+        """Spills the names of the reads of the sample (an iterator of normalized read names, of the shard if any).
+        """
+        chunks = ((names, None) for names in iter(lambda: list(itertools.islice(readNames, 100000)), []))
+        self.reads = _spill(self.fileNames("reads"), chunks, self.shard[1] if self.shard else 1)
+
+    def _entries(self, fileName):
+        """Returns the (read name, taxon ID) tuples of a bucket file of a classifier.
+        """
+        f = open(fileName, "rb")
+        tokens = f.read().replace("\n", "\t").split("\t")[:-1]
+        f.close()
+        return itertools.izip(tokens[0::2], map(int, tokens[1::2]))
+
+    def tables(self, bucket):
+        """Loads the classifier tables of a bucket (resolved, see ClassifierTables.resolve()).
+        """
+        tables = classifierTables.ClassifierTables()
+        for source in range(self.sources):
+            tables.add(self._entries(self.fileNames(source)[bucket]))
+        tables.resolve()
+        return tables
+
+    def calls(self):
+        """Returns a generator of (read name, taxon IDs) tuples (see ClassifierTables.calls()), bucket by bucket.
+        The reads of each bucket are the ones of the reads file, if it was spilled, or the ones reported by
+        any classifier otherwise. The files of each bucket are removed once it is loaded.
+        """
+        for bucket in range(self.nBuckets):
+            tables = self.tables(bucket)
+            # Names of all taxa that can appear in the output of the bucket, at once
+            resolveNames(set(tid for lineage in tables.lineages for tid in lineage.values()))
+            if self.reads is None:
+                readNames = tables.readIndex.names()
+            else:
+                f = open(self.fileNames("reads")[bucket], "rb")
+                readNames = f.read().split("\n")[:-1]
+                f.close()
+            for source in range(self.sources) + ["reads"]:
+                fileName = self.fileNames(source)[bucket]
+                if os.path.isfile(fileName):
+                    os.remove(fileName)
+            for call in tables.calls(readNames):
+                yield call
+            tables = readNames = None
+
+    def close(self):
+        """Removes the temporary directory.
+        """
+        shutil.rmtree(self.dirName, True)
@@ -0,0 +1,264 @@
+"""Integer coded classification tables. Read names are interned once in a ReadIndex shared by all
+classifiers, the calls of each classifier are stored as an int32 array of taxon codes indexed by read
+ID, and lineages are stored once per unique taxon ID (as OrderedDict, for the voting algorithm, and
+as a rank x taxon code matrix).
+"""
+
+import sys, os, time, tempfile, itertools, multiprocessing, numpy as np
+from array import array
+from os.path import join
+
+myPath = os.path.split( os.path.abspath(__file__) )[0]
+sys.path.append(join(myPath, "plugins"))
+from getTaxonomyFromEte3 import resetNCBI, resolveLineages, resolveNames, addLineages
+import config, pluginRegistry
+from util import readBucket
+
+NOT_REPORTED = -1
+
+def iterTaxIds(module, srcFile, shard = None):
+    """Returns a generator of (read name, taxon ID) tuples with the entries of a classifier output or, if shard
+    is an (i, N) tuple, only the entries of the reads of shard i of N (see util.readBucket()). Plugins with a
+    spec (see parserEngine.py) skip the rows of other shards while parsing; the entries of other plugins are
+    filtered afterwards.
+    """
+    if shard is None:
+        return module.iterTaxIds(srcFile)
+    if hasattr(module, "params"):
+        return module.iterTaxIds(srcFile, shard)
+    return ((rname, taxId) for rname, taxId in module.iterTaxIds(srcFile) if readBucket(rname, shard[1]) == shard[0])
+
+def _parseClassifier(source, cache = None, shard = None):
+    """Parses the output of one classifier.
+    Args:
+        source: (plugin module name, classifier output file) tuple.
+        cache: a tableCache.TableCache, or None.
+        shard: (i, N) tuple to parse only the entries of the reads of shard i of N, or None.
+    Returns:
+        (list of read names, taxon IDs as an array('i'), seconds, cached lineages, cached taxon names, cache
+        key). Cached lineages and names are None if the output was parsed.
+    """
+    start = time.time()
+    moduleName, srcFile = source
+    key = None
+    if cache is not None:
+        key   = cache.key(moduleName, srcFile, shard)
+        entry = cache.load(moduleName, srcFile, key, shard)
+        if entry is not None:
+            names, n, tids, lineages, taxonNames = entry
+            return _table(names, n, tids) + (time.time() - start, lineages, taxonNames, key)
+    module = pluginRegistry.getPlugin(moduleName)
+    if hasattr(module, "readTable"): # Parsed in chunks (see parserEngine.py)
+        names, taxIds = module.readTable(srcFile, shard) if shard is not None else module.readTable(srcFile)
+        tids = array('i')
+        tids.fromstring(taxIds.astype(np.int32).tostring())
+    else:
+        names = []
+        tids  = array('i')
+        for rname, taxId in iterTaxIds(module, srcFile, shard):
+            names.append(rname)
+            tids.append(taxId)
+    return names, tids, time.time() - start, None, None, key
+
+def _table(names, n, tids):
+    """Returns the (list of read names, array('i') of taxon IDs) of n entries from their serialized form: the
+    names joined by '\n' and the taxon IDs as int32 bytes.
+    """
+    taxIds = array('i')
+    taxIds.fromstring(tids)
+    return names.split("\n") if n > 0 else [], taxIds
+
+def _parseClassifierTask(task):
+    """Parses a classifier output in a worker process (see _parseClassifier()) and writes the taxon IDs and
+    read names to a temporary file, as Python 2 multiprocessing cannot send messages of 2 GB or more between
+    processes.
+    Returns:
+        (name of the temporary file, number of entries, size in bytes of the taxon IDs, seconds, cached
+        lineages, cached taxon names, cache key).
+    """
+    source, cache, shard, tmpDir = task
+    names, tids, seconds, lineages, taxonNames, key = _parseClassifier(source, cache, shard)
+    fd, fileName = tempfile.mkstemp(prefix = "table", dir = tmpDir)
+    f = os.fdopen(fd, "wb")
+    tids.tofile(f)
+    f.write("\n".join(names))
+    f.close()
+    return fileName, len(names), len(tids)*tids.itemsize, seconds, lineages, taxonNames, key
+
+def _readTaskFile(fileName, n, tidsSize):
+    """Returns the (list of read names, array('i') of taxon IDs) written by _parseClassifierTask(), and
+    removes the file.
+    """
+    f = open(fileName, "rb")
+    tids  = f.read(tidsSize)
+    names = f.read()
+    f.close()
+    os.remove(fileName)
+    return _table(names, n, tids)
+
+def _parseClassifierResults(sources, workers, cache, shard, tmpDir):
+    """Returns a generator with the results of _parseClassifier() for each source, in order, parsed in
+    'workers' worker processes if workers > 1.
+    """
+    if workers <= 1:
+        for s in sources:
+            yield _parseClassifier(s, cache, shard)
+        return
+    pool = multiprocessing.Pool(workers, initializer = resetNCBI) # Plugins can query the taxonomy (e.g. multiHit = "lca")
+    for fileName, n, tidsSize, seconds, lineages, taxonNames, key in pool.imap(_parseClassifierTask, [(s, cache, shard, tmpDir) for s in sources]):
+        yield _readTaskFile(fileName, n, tidsSize) + (seconds, lineages, taxonNames, key)
+    pool.close()
+    pool.join()
+
+def loadClassifiers(sources, workers = 1, times = None, cache = None, shard = None, tmpDir = None):
+    """Parses the outputs of several classifiers, up to 'workers' of them at the same time.
+    Args:
+        sources: list of (plugin module name, classifier output file) tuples.
+        workers: maximum number of classifier outputs parsed at once (in worker processes).
+        times: if given, a list where the seconds spent parsing each source are appended.
+        cache: a tableCache.TableCache, or None. Sources found in the cache are not parsed, and their lineages
+            (and the names of their taxa) are added to the ones shared by resolveLineages() and resolveNames().
+            The lineages of the sources not found are resolved and stored in the cache with the parsed taxon IDs.
+        shard: (i, N) tuple to load only the entries of the reads of shard i of N, or None.
+        tmpDir: directory of the temporary files where worker processes write the parsed outputs (the
+            default temporary directory if None).
+    Returns:
+        a generator with one iterator of (read name, taxon ID) tuples for each source, in the order of
+        'sources', to be passed to ClassifierTables.add().
+    """
+    results = _parseClassifierResults(sources, min(workers, len(sources)), cache, shard, tmpDir)
+    for source, (names, taxIds, seconds, lineages, taxonNames, key) in itertools.izip(sources, results):
+        if times is not None:
+            times.append(seconds)
+        if lineages is not None:
+            addLineages(lineages, taxonNames)
+        elif cache is not None:
+            unique      = set(taxIds)
+            lineageDict = resolveLineages(unique)
+            lineages    = dict((t, lineageDict[t].items()) for t in unique)
+            taxa     = set(int(t) for items in lineages.itervalues() for _, t in items)
+            taxonNames = resolveNames(taxa)
+            cache.save(source[0], source[1], "\n".join(names), len(names), taxIds.tostring(), lineages,
+                       dict((t, taxonNames[t]) for t in taxa if t in taxonNames), key, shard)
+        yield itertools.izip(names, taxIds)
+        names = taxIds = None
+
+# ----------------------------------------------
+class ReadIndex(object):
+    """Maps read names to consecutive integer IDs (0, 1, ...).
+    """
+    def __init__(self):
+        self.ids = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def intern(self, rname):
+        """Returns the ID of a read name, creating a new one if the name was not seen before.
+        """
+        rid = self.ids.get(rname)
+        if rid is None:
+            rid = len(self.ids)
+            self.ids[rname] = rid
+        return rid
+
+    def names(self):
+        """Returns the list of read names, ordered by ID.
+        """
+        names = [None]*len(self.ids)
+        for rname, rid in self.ids.iteritems():
+            names[rid] = rname
+        return names
+
+    def get(self, rname):
+        """Returns the ID of a read name, or None if it was not seen before.
+        """
+        return self.ids.get(rname)
+
+# ----------------------------------------------
+class ClassifierTables(object):
+    """Calls of several classifiers for the reads of one sample.
+    After adding all classifiers and calling resolve():
+        codes: int32 matrix (classifiers x reads) with the taxon code of each call (NOT_REPORTED if the
+            classifier has no entry for the read).
+        taxIds: taxon ID of each taxon code.
+        lineages: lineage (OrderedDict) of each taxon code.
+        lineageMatrix: int32 matrix (len(config.allowedRank) x taxon codes) with the taxon ID at each
+            rank (0 if the lineage does not have the rank).
+    """
+    def __init__(self, readIndex = None):
+        if readIndex is None:
+            readIndex = ReadIndex()
+        self.readIndex = readIndex
+        self.rawCalls  = []
+        self.codes     = None
+
+    def add(self, taxIds):
+        """Adds the calls of one classifier.
+        Args:
+            taxIds: iterator of (read name, taxon ID) tuples, as returned by the iterTaxIds() function
+                of the plugins.
+        """
+        readIds = array('i')
+        tids    = array('i')
+        intern  = self.readIndex.intern
+        for rname, taxId in taxIds:
+            readIds.append(intern(rname))
+            tids.append(taxId)
+        self.rawCalls.append((readIds, tids))
+
+    def resolve(self, ncbi = None):
+        """Builds the integer coded tables, resolving the lineages of all classifiers at once.
+        """
+        allTaxIds = np.concatenate([np.frombuffer(t, dtype=np.int32) for _, t in self.rawCalls] + [np.zeros(0, dtype=np.int32)])
+        self.taxIds, inverse = np.unique(allTaxIds, return_inverse=True)
+        lineageDict   = resolveLineages([int(t) for t in self.taxIds], ncbi)
+        self.lineages = [lineageDict[int(t)] for t in self.taxIds]
+        self.lineageMatrix = np.zeros((len(config.allowedRank), len(self.taxIds)), dtype=np.int32)
+        for code, lineage in enumerate(self.lineages):
+            for i, rank in enumerate(config.allowedRank):
+                if rank in lineage:
+                    self.lineageMatrix[i, code] = int(lineage[rank])
+        self.codes = np.full((len(self.rawCalls), len(self.readIndex)), NOT_REPORTED, dtype=np.int32)
+        start = 0
+        for i, (readIds, tids) in enumerate(self.rawCalls):
+            readIds = np.frombuffer(readIds, dtype=np.int32)
+            codes   = inverse[start:start+len(readIds)]
+            start  += len(readIds)
+            # If a read appears several times, the last entry is used (as in getTaxonomy())
+            _, last = np.unique(readIds[::-1], return_index=True)
+            last    = len(readIds) - 1 - last
+            self.codes[i, readIds[last]] = codes[last]
+        self.rawCalls = []
+
+    def batchMatrix(self, calls):
+        """Returns the matrix of a batch of reads used by multiLevelVoting.batchClassification(), indexed from
+        lineageMatrix with the taxon codes of the calls.
+        Args:
+            calls: list with the taxon IDs of each read, as returned by calls().
+        Returns:
+            an int32 matrix (reads x classifiers x ranks) with the taxon ID at each rank of each call (a row
+            of zeros if the call is missing or NA), or None if a taxon ID is not in the tables.
+        """
+        taxIds = np.array(calls, dtype=np.float64).reshape(len(calls), len(self.codes)) # None -> NaN
+        reported = ~np.isnan(taxIds)
+        taxIds   = np.where(reported, taxIds, 0).astype(np.int64)
+        codes    = np.minimum(np.searchsorted(self.taxIds, taxIds), max(len(self.taxIds) - 1, 0)).astype(np.int32)
+        if len(self.taxIds) == 0 or (self.taxIds[codes] != taxIds)[reported].any():
+            return None
+        matrix = self.lineageMatrix[:, codes].transpose(1, 2, 0)
+        matrix[~reported] = 0
+        return matrix
+
+    def calls(self, readNames):
+        """Returns a generator of (read name, taxon IDs) tuples, where taxon IDs has one taxon ID (or None
+        if the read was not reported) for each classifier.
+        """
+        none = [None]*len(self.codes)
+        taxIds = self.taxIds.tolist()
+        for rname in readNames:
+            rid = self.readIndex.get(rname)
+            if rid is None or rid >= self.codes.shape[1]:
+                yield rname, none
+            else:
+                yield rname, [None if c == NOT_REPORTED else taxIds[c] for c in self.codes[:, rid].tolist()]
@@ -0,0 +1,177 @@
+"""Transparent decompression of input files (reads files and classifier outputs), and compressed
+output files. The compression format of inputs is detected from the first bytes of the file, so file
+names do not need any extension:
+    gzip, bgzip (blocked gzip, as created by htslib's bgzip), zstd and bzip2.
+Compressed files are decoded by an external program (bgzip, pigz, zstd, lbzip2, ...) running in a
+separate process, using config.decompressThreads threads when the program supports it, so
+decompression runs in parallel with parsing. If no suitable program is found, Python's gzip and
+bz2 modules (or the zstandard package, for zstd) are used instead.
+"""
+
+import sys, os, gzip, bz2, subprocess
+import config
+
+GZIP_MAGIC  = "\x1f\x8b"
+ZSTD_MAGIC  = "\x28\xb5\x2f\xfd"
+BZIP2_MAGIC = "BZh"
+
+# External decoders for each format, in order of preference. Each one is (program, arguments), where
+# '%(threads)i' is replaced by the number of threads. The file name is appended at the end.
+decoders = {
+        'bgzip': [("bgzip",  ["-d", "-c", "-@", "%(threads)i"]),
+                  ("pigz",   ["-d", "-c", "-p", "%(threads)i"]),
+                  ("gzip",   ["-d", "-c"])],
+        'gzip':  [("pigz",   ["-d", "-c", "-p", "%(threads)i"]),
+                  ("gzip",   ["-d", "-c"])],
+        'zstd':  [("zstd",   ["-d", "-c", "-q", "-T%(threads)i"])],
+        'bzip2': [("lbzip2", ["-d", "-c", "-n", "%(threads)i"]),
+                  ("pbzip2", ["-d", "-c", "-p%(threads)i"]),
+                  ("bzip2",  ["-d", "-c"])],
+        }
+
+def compression(fileName):
+    """Returns the compression format of a file ('gzip', 'bgzip', 'zstd' or 'bzip2'), or None if it is
+    not compressed.
+    """
+    f = open(fileName, "rb")
+    header = f.read(18)
+    f.close()
+    if header.startswith(GZIP_MAGIC):
+        # bgzip files are gzip files with an extra field 'BC' (block size) in each block header
+        if len(header) >= 14 and ord(header[3]) & 4 and header[12:14] == "BC":
+            return "bgzip"
+        return "gzip"
+    if header.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if header.startswith(BZIP2_MAGIC):
+        return "bzip2"
+    return None
+
+def which(program):
+    """Returns the full path of an executable in the PATH, or None if it is not found.
+    """
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(d, program)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+class DecompressedFile(object):
+    """Lines of a file decompressed by an external program (read through a pipe). An IOError is raised
+    at the end of the file if the program failed.
+    """
+    def __init__(self, command, fileName):
+        self.fileName = fileName
+        self.proc  = subprocess.Popen(command + [fileName], stdout = subprocess.PIPE, bufsize = 1 << 20, close_fds = True)
+        self.lines = iter(self.proc.stdout)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.proc is None: # Closed, or end of file already reached
+            raise StopIteration
+        try:
+            return next(self.lines)
+        except StopIteration:
+            self.close(True)
+            raise
+
+    def readline(self):
+        return next(self, "")
+
+    def read(self, size = -1):
+        """Reads up to 'size' bytes (the rest of the file if size < 0). It can not be mixed with reading lines.
+        """
+        if self.proc is None:
+            return ""
+        data = self.proc.stdout.read(size)
+        if data == "":
+            self.close(True)
+        return data
+
+    def close(self, eof = False):
+        if self.proc is None:
+            return
+        self.proc.stdout.close()
+        status = self.proc.wait()
+        self.proc = None
+        if eof and status != 0:
+            raise IOError("error decompressing %s (exit status %i)"%(self.fileName, status))
+
+def openInput(fileName, mode = "rt", threads = None):
+    """Opens an input file for reading lines, decompressing it if needed.
+    Args:
+        fileName: file to be opened.
+        mode: mode used to open uncompressed files ("rt" or "rU").
+        threads: threads used by the decompression program (default: config.decompressThreads).
+    Returns:
+        a file-like object (supports iteration, next() and readline()).
+    """
+    fmt = compression(fileName)
+    if fmt is None:
+        return open(fileName, mode)
+    if threads is None:
+        threads = config.decompressThreads
+    for program, arguments in decoders[fmt]:
+        path = which(program)
+        if path is not None:
+            return DecompressedFile([path] + [a%{'threads': threads} for a in arguments], fileName)
+    if fmt == "gzip" or fmt == "bgzip":
+        return gzip.open(fileName, "rb")
+    if fmt == "bzip2":
+        return bz2.BZ2File(fileName, "r")
+    try:
+        import zstandard, io
+    except ImportError:
+        raise IOError("%s is zstd compressed: install the zstd program or the zstandard package"%fileName)
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(fileName, "rb")))
+
+# External gzip compressors, in order of preference (as in decoders)
+encoders = [("pigz", ["-c", "-p", "%(threads)i"]),
+            ("gzip", ["-c"])]
+
+class CompressedOutput(object):
+    """File compressed by an external program (written through a pipe).
+    """
+    def __init__(self, command, fileName):
+        self.fileName = fileName
+        self.out  = open(fileName, "wb")
+        self.proc = subprocess.Popen(command, stdin = subprocess.PIPE, stdout = self.out, bufsize = 1 << 20, close_fds = True)
+
+    def write(self, s):
+        self.proc.stdin.write(s)
+
+    def close(self):
+        if self.proc is None:
+            return
+        self.proc.stdin.close()
+        status = self.proc.wait()
+        self.out.close()
+        self.proc = None
+        if status != 0:
+            raise IOError("error compressing %s (exit status %i)"%(self.fileName, status))
+
+def openOutput(fileName, threads = None):
+    """Creates a gzip compressed output file.
+    Args:
+        fileName: file to be created.
+        threads: threads used by the compression program (default: config.decompressThreads).
+    Returns:
+        a file-like object (supports write() and close()).
+    """
+    if threads is None:
+        threads = config.decompressThreads
+    for program, arguments in encoders:
+        path = which(program)
+        if path is not None:
+            return CompressedOutput([path] + [a%{'threads': threads} for a in arguments], fileName)
+    return gzip.open(fileName, "wb")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python %s fileName"%sys.argv[0]
+        print "Writes a (possibly compressed) file to the standard output"
+        sys.exit(1)
+    for l in openInput(sys.argv[1]):
+        sys.stdout.write(l)
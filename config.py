@@ -8,9 +8,36 @@ here"""
 plugins = {
         'caravela':   'getTaxonomy_caravela',
         'centrifuge': 'getTaxonomy_centrifuge',
+        'centrifugeLCA': 'getTaxonomy_centrifugeLCA',
         'clark':      'getTaxonomy_clark',
         'clarkS':     'getTaxonomy_clarkS',
         'kraken':     'getTaxonomy_kraken',
+        'kraken2':    'getTaxonomy_kraken2',
         'onecodex':   'getTaxonomy_onecodex',
         'usearch':    'getTaxonomy_usearch',
         }
+
+"""Path to a taxonomy snapshot created with taxonomySnapshot.py from the NCBI taxdump. If set, it is
+used instead of ete3's NCBITaxa database (it can also be given with the -taxonomy option of metaTax.py)"""
+taxonomySnapshot = None
+
+"""Number of threads used to decompress compressed inputs (reads files and classifier outputs) and to
+compress outputs, when the external program supports it (see compressedFiles.py)"""
+decompressThreads = 4
+
+"""Concurrent samples (-samples option of metaTax.py, see sampleScheduler.py): fraction of the physical
+memory used as memory budget, and estimated memory of a sample in MB: sampleBaseMemory plus
+sampleMemoryFactor times the size of its classifier outputs in MB (the size of compressed outputs is
+multiplied by compressionRatio)"""
+memoryBudget       = 0.8
+sampleBaseMemory   = 200
+sampleMemoryFactor = 4.0
+compressionRatio   = 4.0
+
+"""Maximum number of buckets of the classifier tables of a sample spilled to disk (-max-memory option of
+metaTax.py, see bucketTables.py). It is also capped by the limit of open files of the process
+(RLIMIT_NOFILE) less reservedFiles, and filesPerWorker for each worker process, as each bucket is an open file
+while the tables are spilled"""
+maxBuckets     = 1024
+reservedFiles  = 64
+filesPerWorker = 4
@@ -0,0 +1,153 @@
+"""Instrumentation of MetaTax runs: time spent in each stage, counters, progress (reads/s and ETA)
+and peak memory, written as a JSON report for each sample. When instrumentation is disabled
+NullReport is used instead of RunReport, whose methods do nothing.
+"""
+
+import sys, time, json, resource
+from collections import OrderedDict
+
+# ----------------------------------------------
+class _Stage(object):
+    """Context manager that adds the time spent inside it to a stage of a report.
+    """
+    def __init__(self, report, name):
+        self.report = report
+        self.name   = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.report.add(self.name, time.time() - self.start)
+        return False
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_nullStage = _NullStage()
+
+def peakRSS():
+    """Returns the peak resident memory (in MB) of this process and of its (finished) child processes.
+    """
+    kb = 1024.0 if sys.platform != "darwin" else 1024.0*1024.0 # ru_maxrss is in bytes in Mac OS
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/kb,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/kb)
+
+# ----------------------------------------------
+class RunReport(object):
+    """Timings and counters of the classification of one sample.
+    Args:
+        sample: name of the sample (reads file).
+        progressInterval: seconds between progress messages (0 disables them).
+        out: stream where progress messages are written.
+    """
+    enabled = True
+
+    def __init__(self, sample, progressInterval = 10.0, out = sys.stderr):
+        self.sample   = sample
+        self.times    = OrderedDict()
+        self.counters = OrderedDict()
+        self.start    = time.time()
+        self.progressInterval = progressInterval
+        self.lastProgress     = self.start
+        self.out   = out
+        self.reads = 0
+        self.total = None
+        self.totalApproximate = False # True if total is an estimate (e.g. reads reported by the classifiers)
+
+    def stage(self, name):
+        """Returns a context manager that measures the time of a stage ('with report.stage("voting"): ...').
+        Times of stages with the same name are added.
+        """
+        return _Stage(self, name)
+
+    def add(self, name, seconds):
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, times, counters):
+        """Adds the times and counters measured by a worker process.
+        """
+        for name, seconds in times.iteritems():
+            self.add(name, seconds)
+        for name, n in counters.iteritems():
+            self.count(name, n)
+
+    def progress(self, reads):
+        """Adds 'reads' classified reads and writes a progress message if progressInterval seconds have
+        passed since the last one. The ETA is shown if the total number of reads is known (self.total), labeled
+        as approximate if the total is an estimate (self.totalApproximate).
+        """
+        self.reads += reads
+        now = time.time()
+        if self.progressInterval > 0 and now - self.lastProgress >= self.progressInterval:
+            self.lastProgress = now
+            rate = self.reads/max(now - self.start, 1e-9)
+            msg  = "%s: %i reads, %0.0f reads/s"%(self.sample, self.reads, rate)
+            if self.total and self.total > self.reads:
+                msg += ", %s %0.0f s"%("approximate ETA" if self.totalApproximate else "ETA", (self.total - self.reads)/max(rate, 1e-9))
+            self.out.write(msg + "\n")
+            self.out.flush()
+
+    def report(self):
+        """Returns the report as a dictionary.
+        """
+        elapsed = time.time() - self.start
+        rss, childrenRSS = peakRSS()
+        return OrderedDict([('sample', self.sample), ('elapsed', elapsed), ('reads', self.reads),
+                            ('readsPerSecond', self.reads/max(elapsed, 1e-9)), ('stages', self.times),
+                            ('counters', self.counters), ('peakRSSMB', rss), ('peakChildrenRSSMB', childrenRSS)])
+
+    def write(self, fileName):
+        """Writes the report as a JSON file.
+        """
+        f = open(fileName, "wt")
+        json.dump(self.report(), f, indent = 1)
+        f.write("\n")
+        f.close()
+
+class NullReport(object):
+    """Same interface as RunReport, doing nothing.
+    """
+    enabled = False
+    total   = None
+    totalApproximate = False
+
+    def stage(self, name):
+        return _nullStage
+
+    def add(self, name, seconds):
+        pass
+
+    def count(self, name, n = 1):
+        pass
+
+    def merge(self, times, counters):
+        pass
+
+    def progress(self, reads):
+        pass
+
+    def write(self, fileName):
+        pass
+
+def timed(iterable, report, name):
+    """Iterates over 'iterable', adding the time spent getting each element to the stage 'name' of the report.
+    """
+    iterator = iter(iterable)
+    while True:
+        start = time.time()
+        try:
+            x = next(iterator)
+        except StopIteration:
+            report.add(name, time.time() - start)
+            return
+        report.add(name, time.time() - start)
+        yield x
@@ -1,10 +1,8 @@
-import sys, os, csv, importlib, argparse, traceback, numpy as np
+import sys, os, time, json, argparse, traceback, itertools, collections, multiprocessing
 from os.path import join
-from Bio import SeqIO
-from ete3 import NCBITaxa
 from util import *
 from config import *
-import multiLevelVoting
+import config, pluginRegistry, multiLevelVoting, streaming, classifierTables, readsScanner, resultWriters, instrumentation, tableCache, sampleScheduler, bucketTables
 
 myPath = os.path.split( os.path.abspath(__file__) )[0]
 sys.path.append(join(myPath, "plugins"))
@@ -28,7 +26,7 @@ def loadInput(inputFile):
     Returns:
     - a dictionary with data about the reads. Keys are the reads file names.
     """
-    reads        = {}
+    reads        = collections.OrderedDict()
     reader = open(inputFile, "rt")
     while True:
         try:
@@ -38,9 +36,9 @@ def loadInput(inputFile):
             for i in range(n):
                 classif = {}
                 classif['classifName'] = reader.next().strip()
-                if classif['classifName'] in plugins.keys():
+                if pluginRegistry.isTool(classif['classifName']):
                     classif['classifData' ] = reader.next().strip()
-                    classif['module']       = importlib.import_module(plugins[classif['classifName']])
+                    classif['module']       = pluginRegistry.getPlugin(classif['classifName'])
                 else:
                     print "I do not understand output from %s, exiting"%classif['classifName']
                     sys.exit(1)
@@ -49,131 +47,394 @@ def loadInput(inputFile):
             break
     return reads
 
-# ------------------------------------------------------------------------------- #
-# MAIN FUNCTION
-# ------------------------------------------------------------------------------- #
-if __name__ == "__main__":
-    """Main function of the method. It receives an input file with data about reads and their classification 
-    by different tools, and produces an output dir with meta-classification.
+def readNames(readsFile, shard = None):
+    """Returns a generator with the names of the reads in a FASTA or FASTQ file (can be compressed), 
+    without the mate suffix ("/1" or "/2"). If shard is an (i, N) tuple, only the names of the reads of
+    shard i of N are returned (see util.readBucket()).
+    """
+    for name in readsScanner.scanReadNames(readsFile):
+        name = name.split("/")[0]
+        if shard is None or readBucket(name, shard[1]) == shard[0]:
+            yield name
+
+def classifyReads(readsCalls, classifNames, voter, batchSize = 10000, times = None):
+    """Runs the voting algorithm for the reads, in batches.
+
+    Parameters:
+    - readsCalls: iterator of (read name, taxon IDs) tuples, with one taxon ID (or None, if the read was not
+      reported) for each classifier
+    - classifNames: names of the classifiers
+    - voter: voting method, i.e. an object with a getClassifications() method (multiLevelVoting.VotingCache 
+      or multiLevelVoting.BatchVoting)
+    - batchSize: number of reads classified at once
+    - times: if given, a dictionary where the seconds spent resolving lineages ('lineages') and voting ('voting')
+      are added
+    Returns:
+    - a generator of (read name, lineages, classifiers, classification) tuples, where lineages are the non NA
+      lineages of the read, classifiers are the names of the tools that gave them, and classification is 
+      (rank, taxon ID, votes, weight, full lineage), or None if there are no lineages.
+    """
+    lineageDict = resolveLineages([])
+    batch = []
+    for rname, calls in itertools.chain(readsCalls, [(None, None)]):
+        if rname is not None:
+            batch.append((rname, calls))
+            if len(batch) < batchSize:
+                continue
+        elif len(batch) == 0:
+            break
+        if times is not None: start = time.time()
+        # Taxon IDs not seen before (streaming mode) are resolved at once
+        newIds = set(t for _, calls in batch for t in calls if t is not None and t not in lineageDict)
+        if len(newIds) > 0:
+            lineageDict = resolveLineages(newIds)
+        reads = []
+        for name, calls in batch:
+            lineageList = []
+            usedClassif = []
+            for i, taxId in enumerate(calls): # Get classification from each classifier
+                if taxId is not None and not isNA(lineageDict[taxId]): # None: read was not classified
+                    lineageList.append(lineageDict[taxId])
+                    usedClassif.append(classifNames[i])
+            reads.append((name, lineageList, usedClassif))
+        if times is not None:
+            times['lineages'] = times.get('lineages', 0.0) + time.time() - start
+            start = time.time()
+        classifications = voter.getClassifications([r[1] for r in reads], [calls for _, calls in batch])
+        if times is not None:
+            times['voting'] = times.get('voting', 0.0) + time.time() - start
+        for r, classification in zip(reads, classifications):
+            yield r + (classification,)
+        batch = []
+
+# Formatted lineages ("rank|name|taxid" separated by tabs), shared by all samples
+_lineageStrings = {}
+
+def formatLineage(lineage):
+    """Returns a lineage formatted as in the output files (rank|name|taxid for each rank, separated by
+    tabs). Each distinct lineage is formatted only once; names are taken from resolveNames().
+    """
+    key = tuple(lineage.items())
+    s = _lineageStrings.get(key)
+    if s is None:
+        names = resolveNames(lineage.values())
+        s = "\t".join(["%s|%s|%s"%(rank, names[tid], tid) for rank, tid in key])
+        _lineageStrings[key] = s
+    return s
+
+# Settings of the sample being classified. They are set before creating the worker processes, which
+# inherit them (together with the classifier tables and the lineages already resolved)
+_job = {}
+
+def classifyChunk(chunk):
+    """Classifies a chunk of reads and formats the results with the writer of the sample. It runs in the main
+    process or in a worker process.
+
+    Parameters:
+    - chunk: list of (read name, taxon IDs) tuples
+    Returns:
+    - a dictionary with the formatted results ('results', see resultWriters.py), the text to be written to the
+      log file ('log'), the number of reads ('reads'), the counters of the voter ('counters', e.g. hits and
+      misses of the voting cache) and, if the run is instrumented, the seconds spent in each stage ('times').
+    """
+    classifNames = _job['classifNames']
+    classTree    = _job['voter']
+    votingMethod = _job['votingMethod']
+    LOG          = _job['log']
+    counters     = voterCounters(classTree)
+    times        = {} if _job['report'] else None
+    records, logF = [], []
+    for rname, lineageList, usedClassif, classification in classifyReads(chunk, classifNames, classTree, len(chunk), times):
+        if LOG:
+            logF.append("<==================================================================>\n")
+            logF.append("Classifying read \'%s\'\n"%rname)
+        if classification is not None: # At least one classification not NA
+            rank, tid, votes, weight, completeLin = classification
+            if LOG:
+                for i, lineage in enumerate(lineageList):
+                    logF.append("<------------------------------\n")
+                    logF.append("Classification according to %s:\n"%(usedClassif[i]))
+                    logF.append("%s\n"%(",".join( ["%s:%s"%(k, lineage[k]) for k in lineage.keys()] )))
+                    logF.append("------------------------------>\n")
+                logF.append("Final classification by method \'%s\': %s: %s with %i votes and weight %0.2f\n"%(votingMethod, rank, tid, votes, weight))
+            if rank == "NA":
+                records.append((rname, resultWriters.NA, len(lineageList), votes, weight, None, None))
+            elif rank == "disagreement":
+                records.append((rname, resultWriters.DISAGREEMENT, len(lineageList), votes, weight, None, None))
+            elif weight < classTree.minw: #args.minw:
+                records.append((rname, resultWriters.LOW_WEIGHT, len(lineageList), votes, weight, None, None))
+            else:
+                label = None
+                if not _job['writeFullLineage']:
+                    label = "|".join([rank, resolveNames([tid])[int(tid)], tid])
+                records.append((rname, resultWriters.CLASSIFIED, len(lineageList), votes, weight, formatLineage(completeLin), label))
+        else:
+            records.append((rname, resultWriters.NA, 0, 0, 0.0, None, None))
+            if LOG: logF.append("Read without classification: NA\n")
+        if LOG: logF.append("<==================================================================>\n")
+    if times is not None: start = time.time()
+    results = _job['writer'].format(records)
+    if times is not None: times['format'] = time.time() - start
+    return {'results': results, 'log': "".join(logF), 'reads': len(chunk), 'times': times,
+            'counters': dict((k, v - counters[k]) for k, v in voterCounters(classTree).iteritems())}
+
+def voterCounters(voter):
+    """Returns the counters of a voter: hits and misses of the voting cache and number of pruning iterations.
+    """
+    return dict((k, getattr(voter, k)) for k in ["hits", "misses", "pruned"] if hasattr(voter, k))
+
+def chunks(iterable, chunkSize):
+    """Splits an iterator in lists of chunkSize elements (the last one can be smaller).
+    """
+    chunk = []
+    for x in iterable:
+        chunk.append(x)
+        if len(chunk) == chunkSize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def orderedMap(pool, function, iterable, window):
+    """Same as pool.imap(function, iterable), but with at most 'window' tasks submitted and not
+    yet returned, so that the input is not read faster than it is processed.
+    """
+    pending = collections.deque()
+    for x in iterable:
+        pending.append(pool.apply_async(function, (x,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+    while len(pending) > 0:
+        yield pending.popleft().get()
+
+def classifySample(readName, tools, args, cache = None, loadTime = 0.0):
+    """Classifies the reads of a sample and writes its output files (and its log file and report, if requested).
+
+    Parameters:
+    - readName: reads file of the sample
+    - tools: list of classifiers of the sample, as returned by loadInput()
+    - args: command line arguments of metaTax.py
+    - cache: a tableCache.TableCache, or None
+    - loadTime: seconds spent loading the input file (added to the report)
+    """
+    outDir           = args.o
+    votingMethod     = args.voting # Future extensions should allow for different voting methods, including the WEVOTE method
+    chunkSize        = 10000
+    writeFullLineage = True
+    LOG  = args.log and not args.report
+    ncbi = getNCBI()
+    # Creating output files
+    prefix = readName[readName.rfind('/')+1:]
+    if args.report:
+        report = instrumentation.RunReport(readName)
+        report.add("loadInput", loadTime)
+    else:
+        report = instrumentation.NullReport()
+    classifNames = [c['classifName'] for c in tools]
+    if LOG:
+        logF      = open(join(outDir, prefix+"_log.txt")         , "wt")
+        logF.write("<=========================================================>\n")
+        logF.write("Analyzing read file: %s\n"%readName)
+        logF.write("Classifiers:\n")
+        for c in tools:
+            logF.write("\t%s\t->\t%s\n"%(c['classifName'], c['classifData']))
+    buckets = 1
+    classifiers = None # In-memory tables, if any
+    if args.max_memory and not args.stream:
+        buckets = bucketTables.bucketCount([c['classifData'] for c in tools], args.max_memory, min(args.loaders, len(tools)))
+    if args.stream:
+        taxIdIterators = [classifierTables.iterTaxIds(c['module'], c['classifData'], args.shard) for c in tools]
+        readsCalls = streaming.streamTaxIds(readNames(readName, args.shard), taxIdIterators, args.stream == "sorted", classifNames)
+    elif buckets > 1: # Tables partitioned on disk, classified one bucket at a time
+        spilled = bucketTables.BucketTables(buckets, outDir, args.shard)
+        sources = [(c['module'].__name__, c['classifData']) for c in tools]
+        parseTimes = []
+        with report.stage("spill"):
+            spilled.addClassifiers(sources, args.loaders, parseTimes)
+            if not args.no_reads:
+                spilled.addReads(readNames(readName, args.shard))
+        for name, seconds in zip(classifNames, parseTimes):
+            report.add("parse:%s"%name, seconds)
+        report.total = spilled.reads
+        readsCalls = spilled.calls()
+        if LOG: logF.write("Classifier tables split in %i buckets\n"%buckets)
+    else:
+        classifiers = classifierTables.ClassifierTables()
+        sources = [(c['module'].__name__, c['classifData']) for c in tools]
+        parseTimes = []
+        with report.stage("loadClassifiers"):
+            for taxIds in classifierTables.loadClassifiers(sources, args.loaders, parseTimes, cache, args.shard, outDir):
+                classifiers.add(taxIds)
+        for name, seconds in zip(classifNames, parseTimes):
+            report.add("parse:%s"%name, seconds)
+        with report.stage("lineages"):
+            # Resolve the lineages of all classifiers at once (shared by all plugins and samples)
+            classifiers.resolve(ncbi)
+            # Names of all taxa that can appear in the output, at once (inherited by worker processes)
+            resolveNames(set(tid for lineage in classifiers.lineages for tid in lineage.values()), ncbi)
+        # Reads reported by any classifier: exact with -no-reads, an estimate of the reads of the reads file otherwise
+        report.total = len(classifiers.readIndex)
+        report.totalApproximate = not args.no_reads
+        if args.no_reads: # Reads reported by any classifier, in the order they were loaded
+            readsCalls = classifiers.calls(classifiers.readIndex.names())
+        else:
+            readsCalls = classifiers.calls(readNames(readName, args.shard))
+    writers = []
+    if args.profile_only:
+        pass
+    elif args.output_format == "columnar":
+        writers.append(resultWriters.ColumnarWriter(outDir, prefix, len(classifNames)))
+    else:
+        writers.append(resultWriters.TsvWriter(outDir, prefix, len(classifNames), args.lineage, writeFullLineage,
+                                               compress = args.output_format == "tsv.gz"))
+    if args.profile or args.profile_only:
+        writers.append(resultWriters.ProfileWriter(outDir, prefix, len(classifNames), saveState = args.shard is not None))
+    writer = writers[0] if len(writers) == 1 else resultWriters.MultiWriter(writers)
+    if votingMethod == "multilevel":
+        classTree = multiLevelVoting.VotingCache(args.pedantic, args.vote_cache)
+    elif votingMethod == "batch":
+        classTree = multiLevelVoting.BatchVoting(args.pedantic, classifiers)
+    _job.update(classifNames = classifNames, voter = classTree, votingMethod = votingMethod, log = LOG,
+                writer = writer, writeFullLineage = writeFullLineage, report = report.enabled)
+    # Chunks of reads are classified in order, by this process or by worker processes
+    readChunks = chunks(readsCalls, chunkSize)
+    if report.enabled:
+        readChunks = instrumentation.timed(readChunks, report, "input")
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers, initializer = resetNCBI)
+        results = orderedMap(pool, classifyChunk, readChunks, 2*args.workers)
+    else:
+        results = itertools.imap(classifyChunk, readChunks)
+    counters = {}
+    for out in results:
+        with report.stage("output"):
+            writer.write(out['results'])
+            if LOG: logF.write(out['log'])
+        for k, v in out['counters'].iteritems():
+            counters[k] = counters.get(k, 0) + v
+        if report.enabled:
+            report.merge(out['times'], {})
+            report.progress(out['reads'])
+    if args.workers > 1:
+        pool.close()
+        pool.join()
+    with report.stage("output"):
+        writer.close()
+    if buckets > 1:
+        spilled.close()
+    report.merge({}, counters)
+    report.write(join(outDir, prefix+"_report.json"))
+    if LOG:
+        if votingMethod == "multilevel":
+            logF.write("Voting cache: %i hits, %i misses\n"%(counters['hits'], counters['misses']))
+        logF.write("<=========================================================>\n")
+        logF.close()
+
+def argumentParser():
+    """Returns the parser of the command line arguments of metaTax.py.
     """
-    # Parsing arguments
     argp = argparse.ArgumentParser()
     argp.add_argument('i', help = 'Input file with information about read files and classification results')
     argp.add_argument('o', help = 'Dir to write the results of meta-classification')
     argp.add_argument('-log', help = 'Write log information (this could create a very big file!)', required = False, action="store_true")
     argp.add_argument('-lineage', help = 'Create a file with the full linage but without statistics', required = False, action="store_true")
+    argp.add_argument('-output-format', help = 'Format of the results: TSV files (tsv), gzip compressed TSV files (tsv.gz) or binary columns with a lineage dictionary (columnar, see resultWriters.py; -lineage is not needed)', required = False, choices = ["tsv", "tsv.gz", "columnar"], default = "tsv")
+    argp.add_argument('-profile', help = 'Also write the abundance profile of each sample: reads, mean votes and mean weight of each taxon at each rank (file_name_profile.tsv)', required = False, action="store_true")
+    argp.add_argument('-profile-only', help = 'Write only the abundance profile of each sample, without the files with the results of each read', required = False, action="store_true")
     argp.add_argument('-pedantic', help = 'Uses a more strict weight threshold to consider valid classifications', required = False, action="store_true")
+    argp.add_argument('-stream', help = 'Classify one read at a time, reading classifier outputs in step with the reads file. Outputs must be in the same order as the reads (ordered) or reads and outputs must be sorted by read name (sorted, see streaming.py)', required = False, choices = ["ordered", "sorted"])
+    argp.add_argument('-no-reads', help = 'Do not read the reads file: classify the reads reported by any classifier (reads not reported by any tool are not written to the NAs file)', required = False, action="store_true")
+    argp.add_argument('-voting', help = 'Voting engine: multilevel (one read at a time) or batch (vectorized, same results)', required = False, choices = ["multilevel", "batch"], default = "multilevel")
+    argp.add_argument('-vote-cache', help = 'Maximum number of distinct combinations of classifications whose vote is memoized (default: 100000, 0 disables the cache)', required = False, type = int, default = 100000)
+    argp.add_argument('-workers', '-threads', help = 'Number of worker processes used to classify the reads (default: 1)', required = False, type = int, default = 1)
+    argp.add_argument('-loaders', help = 'Maximum number of classifier outputs loaded at the same time, in worker processes (default: number of CPUs)', required = False, type = int, default = multiprocessing.cpu_count())
+    argp.add_argument('-report', help = 'Write a JSON report with the time of each stage, counters and peak memory of each sample (file_name_report.json), and show the progress. The log file is not written', required = False, action="store_true")
+    argp.add_argument('-taxonomy', help = 'Taxonomy snapshot built with taxonomySnapshot.py (default: ete3 NCBITaxa database)', required = False)
+    argp.add_argument('-cache', help = 'Directory where parsed classifier outputs and their lineages are cached, so later runs do not parse them again (see tableCache.py; not used with -stream)', required = False)
+    argp.add_argument('-cache-hash', help = 'Identify cached classifier outputs by the SHA-1 of their contents instead of their size and modification time', required = False, action="store_true")
+    argp.add_argument('-samples', help = 'Maximum number of samples (reads files) classified at the same time, each one in its own process (default: 1)', required = False, type = int, default = 1)
+    argp.add_argument('-max-memory', help = 'Maximum memory (in MB) of each sample: if its classifier tables would not fit, they are split in buckets by the hash of the read name, written to disk and classified one bucket at a time, and reads are written bucket by bucket (see bucketTables.py; not used with -stream)', required = False, type = float)
+    argp.add_argument('-shard', '--shard', help = 'Classify only the reads of shard i of N (i/N, with i from 0 to N-1), chosen by the hash of the read name; the outputs of the N shards are merged with shardMerge.py', required = False, type = shardArgument)
+    argp.add_argument('-memory-budget', help = 'Memory (in MB) available for the samples classified at the same time; samples are started when their estimated memory fits (default: %i%%%% of the physical memory, see config.py)'%(config.memoryBudget*100), required = False, type = float)
+    return argp
 
-    args = argp.parse_args()
+def shardArgument(value):
+    """Parses the value of the -shard option ("i/N"). Returns the (i, N) tuple.
+    """
+    try:
+        i, n = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must be i/N, e.g. 0/4")
+    if n < 1 or i < 0 or i >= n:
+        raise argparse.ArgumentTypeError("shard %s: i must be between 0 and N-1"%value)
+    return i, n
 
+def parseArguments(argv = None, argp = None):
+    """Parses and checks the command line arguments of metaTax.py (default: sys.argv[1:]), with argp (default:
+    the parser returned by argumentParser()). Exits with an error message if they are not valid.
+    """
+    if argp is None:
+        argp = argumentParser()
+    args = argp.parse_args(argv)
+    if args.no_reads and args.stream:
+        argp.error("-no-reads can not be used with -stream")
+    return args
+
+def run(args):
+    """Produces an output dir with the meta-classification of the reads files of an input file.
+
+    Parameters:
+    - args: command line arguments, as returned by parseArguments()
+    Returns:
+    - the list of samples (reads files) whose classification failed, when several samples are classified
+      at the same time (-samples). Otherwise, errors are raised.
+    """
     inputFile    = args.i
     outDir       = args.o
-    votingMethod = "multilevel" # Future extensions should allow for different voting methods, including the WEVOTE method
     if not os.path.isdir(outDir):
         try:
             os.makedirs(outDir)
         except: 
             traceback.print_exc()
             sys.exit(1)
-    LOG = args.log
-    writeFullLineage = True
-    ncbi = NCBITaxa()
+    if args.taxonomy:
+        config.taxonomySnapshot = args.taxonomy
+    if args.shard:
+        # Read by shardMerge.py to check that all the shards are merged
+        json.dump({'shard': args.shard[0], 'shards': args.shard[1], 'noReads': args.no_reads, 'maxMemory': args.max_memory,
+                   'outputFormat': args.output_format},
+                  open(join(outDir, "shard.json"), "wt"))
+    ncbi = getNCBI()
+    cache = None
+    if args.cache and not args.stream:
+        cache = tableCache.TableCache(args.cache, taxonomyIdentity(), args.cache_hash)
 
     # Get reads information, including reads file name and data from different classifiers
+    start = time.time()
     readsDict = loadInput(inputFile)
+    loadTime  = time.time() - start
 
     # Analizing each read file and its corresponding classification data
+    if args.samples > 1 and len(readsDict) > 1:
+        samples = [(readName, sampleScheduler.estimateFootprint([c['classifData'] for c in readsDict[readName]]))
+                   for readName in readsDict.keys()]
+        if args.max_memory:
+            samples = [(readName, min(footprint, args.max_memory)) for readName, footprint in samples]
+        return sampleScheduler.runSamples(samples, lambda readName: classifySample(readName, readsDict[readName], args, cache, loadTime),
+                                          args.memory_budget, args.samples, sys.stderr if args.report else None)
     for readName in readsDict.keys():
-        # Creating output files
-        prefix = readName[readName.rfind('/')+1:]
-        classifiedF   = open(join(outDir, prefix+"_classified.tsv")  , "wt")
-        lowWeightF    = open(join(outDir, prefix+"_low_weight.tsv")  , "wt")
-        disagreeF     = open(join(outDir, prefix+"_disagreement.tsv"), "wt")
-        naF           = open(join(outDir, prefix+"_NAs.tsv")         , "wt")
-        if args.lineage:
-            lineageF  = open(join(outDir, prefix+"_lineage.tsv")     , "wt")
-        if LOG:
-            logF      = open(join(outDir, prefix+"_log.txt")         , "wt")
-        else:
-            logF      = open(os.devnull, "w")
-        logF.write("<=========================================================>\n")
-        logF.write("Analyzing read file: %s\n"%readName)
-        logF.write("Classifiers:\n")
-        classifiers  = []
-        classifNames = []
-        for c in readsDict[readName]:
-            logF.write("\t%s\t->\t%s\n"%(c['classifName'], c['classifData']))
-            classifNames.append(c['classifName'])
-            fullLineage = c['module'].getTaxonomy(c['classifData'])
-            classifiers.append(fullLineage)
-        if writeFullLineage:
-            classifiedF.write("Read\tToolsN\tTotalClassif\tVotes\tPercentVotes\tWeight\tFullLineage\n")
-        else:
-            classifiedF.write("Read\tToolsN\tTotalClassif\tVotes\tPercentVotes\tWeight\tLineage\n")
-        if readName.endswith(".fa") or readName.endswith(".fasta"):
-            ext = "fasta"
-        else:
-            ext = "fastq"
-        reads = SeqIO.parse( open(readName, "rU"), ext )
-        # For each read
-        for r in reads:
-            if votingMethod == "multilevel":
-                classTree = multiLevelVoting.ClassTree(args.pedantic)
-            lineageList = []
-            usedClassif = []
-            rname = r.name.split("/")[0]
-            logF.write("<==================================================================>\n")
-            logF.write("Classifying read \'%s\'\n"%rname)
-            for i, classifier in enumerate(classifiers): # Get classification from each classifier
-                try:
-                    lineage = classifier[rname]
-                    if not isNA(lineage):
-                        lineageList.append(lineage)
-                        usedClassif.append(classifNames[i])
-                except: # Read was not classified
-                    pass
-            if len(lineageList) > 0: # At least one classification not NA
-                # Add each lineage to the classification algorithm
-                for i, lineage in enumerate(lineageList):
-                    classTree.addClassification(lineage)
-                    logF.write("<------------------------------\n")
-                    logF.write("Classification according to %s:\n"%(usedClassif[i]))
-                    logF.write("%s\n"%(",".join( ["%s:%s"%(k, lineage[k]) for k in lineage.keys()] )))
-                    logF.write("------------------------------>\n")
-                rank, tid, votes, weight, completeLin = classTree.getClassification()
-                logF.write("Final classification by method \'%s\': %s: %s with %i votes and weight %0.2f\n"%(votingMethod, rank, tid, votes, weight))
-                if rank == "NA":
-                    naF.write("%s\n"%rname)
-                elif rank == "disagreement":
-                    disagreeF.write("%s\n"%rname)
-                elif weight < classTree.minw: #args.minw:
-                    lowWeightF.write("%s\t%0.2f\n"%(rname, weight))
-                else:
-                    stringList = None
-                    if args.lineage:
-                        ll = list(completeLin.values())
-                        names = ncbi.get_taxid_translator(ll)
-                        stringList = []
-                        for i in range(len(completeLin)):
-                            key_i = completeLin.keys()[i]
-                            stringList.append("%s|%s|%s"%(key_i, names[ completeLin[key_i] ], completeLin[key_i]))
-                        lineageF.write("%s\t%s\n"%(rname, "\t".join(stringList)))
-                    if writeFullLineage:
-                        if stringList == None:
-                            ll = list(completeLin.values())
-                            names = ncbi.get_taxid_translator(ll)
-                            stringList = []
-                            for i in range(len(completeLin)):
-                                key_i = completeLin.keys()[i]
-                                stringList.append("%s|%s|%s"%(key_i, names[ completeLin[key_i] ], completeLin[key_i]))
-                        classifiedF.write("%s\t%i\t%i\t%i\t%0.2f\t%0.2f\t%s\n"%(rname, len(classifiers), len(lineageList), votes, votes*100.0/len(classifiers), weight, "\t".join(stringList)))
-                    else:
-                        name = ncbi.get_taxid_translator([tid])
-                        name = name[int(tid)]
-                        classifiedF.write("%s\t%i\t%i\t%i\t%0.2f\t%0.2f\t%s\n"%(rname, len(lineageList), votes, int(votes*100/len(classifiers)), "|".join([rank, name, tid])))
-            else:
-                naF.write("%s\n"%rname)
-                logF.write("Read without classification: NA\n")
-            logF.write("<==================================================================>\n")
-        logF.write("<=========================================================>\n")
+        classifySample(readName, readsDict[readName], args, cache, loadTime)
+    return []
 
+# ------------------------------------------------------------------------------- #
+# MAIN FUNCTION
+# ------------------------------------------------------------------------------- #
+if __name__ == "__main__":
+    """Main function of the method. It receives an input file with data about reads and their classification 
+    by different tools, and produces an output dir with meta-classification.
+    """
+    args   = parseArguments()
+    failed = run(args)
+    if len(failed) > 0:
+        print "Classification failed for %i samples: %s"%(len(failed), ", ".join(failed))
+        sys.exit(1)
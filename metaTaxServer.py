@@ -0,0 +1,262 @@
+"""MetaTax server: a long-running process that loads the taxonomy, the plugins and the other modules
+once, and classifies jobs submitted through a local Unix socket. Each job is an input file (in the
+format read by metaTax.loadInput()), an output directory and the options of metaTax.py. Jobs run
+concurrently, each one in a process forked from the server (see sampleScheduler.Scheduler), so they
+start with the taxonomy open and with the lineages and names resolved by the jobs that finished
+before them.
+
+The protocol is one JSON object per line: the client sends a request and the server answers with
+one line and closes the connection. Requests:
+    {"command": "submit", "input": ..., "output": ..., "options": [...], "cwd": ...}
+        -> {"job": job ID, "state": "queued"} or {"error": ...}
+    {"command": "status"}                 -> {"jobs": [job, ...], "lineages": n, "names": n}
+    {"command": "status", "job": job ID}  -> {"job": job} or {"error": ...}
+    {"command": "stop"}                   -> {"state": "stopping"}
+where each job is a dictionary with its ID, state (queued, running, finished or failed), input,
+output, options, times (submitted, started and finished) and error (if it failed).
+
+Usage example:
+    python metaTaxServer.py start /tmp/metatax.sock -taxonomy taxonomy.snap -jobs 8 &
+    python metaTaxServer.py submit -wait /tmp/metatax.sock input.txt outDir -lineage
+    python metaTaxServer.py status /tmp/metatax.sock
+    python metaTaxServer.py stop /tmp/metatax.sock
+"""
+
+import sys, os, time, json, socket, argparse, threading, Queue, SocketServer
+from os.path import join
+from collections import OrderedDict
+import config, metaTax, pluginRegistry, sampleScheduler
+from getTaxonomyFromEte3 import getNCBI, resolveLineages, resolveNames
+
+QUEUED, RUNNING, FINISHED, FAILED = "queued", "running", "finished", "failed"
+
+class _OptionsError(Exception):
+    pass
+
+def _optionsError(message):
+    raise _OptionsError(message)
+
+def _helpError(file = None):
+    raise _OptionsError("-h/--help is not accepted by the server (see python metaTax.py --help)")
+
+# ----------------------------------------------
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        try:
+            reply = self.server.metaTax.handle(json.loads(self.rfile.readline()))
+        except SystemExit, e: # sys.exit() while checking a job must not end the thread without an answer
+            reply = {'error': "SystemExit: %s"%e}
+        except Exception, e:
+            reply = {'error': "%s: %s"%(type(e).__name__, e)}
+        self.wfile.write(json.dumps(reply) + "\n")
+
+class _UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+class MetaTaxServer(object):
+    """Server that runs the jobs submitted through a Unix socket.
+    Args:
+        socketPath: path of the Unix socket.
+        budget: memory budget in MB of the jobs running at once (see sampleScheduler.Scheduler).
+        maxJobs: maximum number of jobs running at once (default: number of CPUs).
+        out: if given, stream where the start and end of each job are written.
+    """
+    def __init__(self, socketPath, budget = None, maxJobs = None, out = None):
+        self.socketPath = socketPath
+        self.scheduler  = sampleScheduler.Scheduler(budget, maxJobs, out)
+        self.jobs       = OrderedDict() # Job ID -> job
+        self.submitted  = Queue.Queue()
+        self.lock       = threading.Lock()
+        self.stopping   = False
+
+    def preload(self):
+        """Opens the taxonomy and imports the plugins, so jobs inherit them.
+        """
+        getNCBI()
+        for tool in config.plugins.keys():
+            pluginRegistry.getPlugin(tool)
+
+    def submit(self, inputFile, outDir, options = [], cwd = None):
+        """Checks and queues a job. Relative paths are relative to cwd (default: the current directory).
+        Returns:
+            the job ID.
+        """
+        cwd = cwd or os.getcwd()
+        argp = metaTax.argumentParser()
+        argp.error = _optionsError
+        argp.print_help = _helpError # -h would print the help in the server and exit
+        metaTax.parseArguments([inputFile, outDir] + list(options), argp)
+        try:
+            readsDict = metaTax.loadInput(join(cwd, inputFile))
+        except SystemExit:
+            raise _OptionsError("%s: unknown classifier"%inputFile)
+        footprint = max([sampleScheduler.estimateFootprint([join(cwd, c['classifData']) for c in tools])
+                         for tools in readsDict.values()] + [0])
+        with self.lock:
+            jobId = "job%i"%(len(self.jobs) + 1)
+            self.jobs[jobId] = OrderedDict([('id', jobId), ('state', QUEUED), ('input', inputFile), ('output', outDir),
+                                            ('options', list(options)), ('cwd', cwd), ('samples', len(readsDict)),
+                                            ('footprint', footprint), ('submitted', time.time()),
+                                            ('started', None), ('finished', None), ('error', None)])
+        self.submitted.put(jobId)
+        return jobId
+
+    def status(self, jobId = None):
+        with self.lock:
+            if jobId is None:
+                return {'jobs': self.jobs.values(), 'lineages': len(resolveLineages([])), 'names': len(resolveNames([]))}
+            if jobId not in self.jobs:
+                return {'error': "unknown job %s"%jobId}
+            return {'job': self.jobs[jobId]}
+
+    def handle(self, request):
+        """Answers a request (in the thread of its connection).
+        """
+        command = request.get('command')
+        if command == "submit":
+            if self.stopping:
+                return {'error': "the server is stopping"}
+            try:
+                jobId = self.submit(request['input'], request['output'], request.get('options', []), request.get('cwd'))
+            except (_OptionsError, IOError, OSError), e:
+                return {'error': str(e)}
+            return {'job': jobId, 'state': QUEUED}
+        elif command == "status":
+            return self.status(request.get('job'))
+        elif command == "stop":
+            self.stopping = True
+            return {'state': "stopping"}
+        return {'error': "unknown command %s"%command}
+
+    def _runJob(self, jobId):
+        """Runs a job (in its own process).
+        """
+        job = self.jobs[jobId]
+        os.chdir(job['cwd'])
+        failed = metaTax.run(metaTax.parseArguments([job['input'], job['output']] + job['options']))
+        if len(failed) > 0:
+            raise RuntimeError("Classification failed for %i samples: %s"%(len(failed), ", ".join(failed)))
+
+    def serve(self):
+        """Runs the server until a stop request is received and the jobs already submitted finish.
+        """
+        if os.path.exists(self.socketPath):
+            os.remove(self.socketPath)
+        server = _UnixServer(self.socketPath, _Handler)
+        server.metaTax = self
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            while not self.stopping or self.scheduler.busy() or not self.submitted.empty():
+                try:
+                    while True:
+                        jobId = self.submitted.get(timeout = 0.2 if not self.scheduler.busy() else 0.0)
+                        self.scheduler.submit(jobId, self.jobs[jobId]['footprint'], self._runJob)
+                except Queue.Empty:
+                    pass
+                finished = self.scheduler.step(0.2)
+                with self.lock:
+                    for jobId in self.scheduler.running:
+                        if self.jobs[jobId]['state'] == QUEUED:
+                            self.jobs[jobId]['state']   = RUNNING
+                            self.jobs[jobId]['started'] = time.time()
+                    for jobId, error in finished:
+                        job = self.jobs[jobId]
+                        job['state']    = FINISHED if error is None else FAILED
+                        job['error']    = error
+                        job['finished'] = time.time()
+                        if job['started'] is None:
+                            job['started'] = job['finished']
+        finally:
+            server.shutdown()
+            server.server_close()
+            os.remove(self.socketPath)
+
+# ----------------------------------------------
+def request(socketPath, message):
+    """Sends a request to a server and returns its answer.
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.connect(socketPath)
+    f = s.makefile("rwb")
+    f.write(json.dumps(message) + "\n")
+    f.flush()
+    reply = json.loads(f.readline())
+    f.close()
+    s.close()
+    return reply
+
+def submit(socketPath, inputFile, outDir, options = []):
+    """Submits a job to a server. Relative paths are relative to the current directory.
+    Returns:
+        the answer of the server ({"job": job ID, ...} or {"error": ...}).
+    """
+    return request(socketPath, {'command': "submit", 'input': inputFile, 'output': outDir, 'options': list(options),
+                                'cwd': os.getcwd()})
+
+def wait(socketPath, jobId, interval = 0.5):
+    """Waits until a job finishes, and returns it.
+    """
+    while True:
+        reply = request(socketPath, {'command': "status", 'job': jobId})
+        if 'error' in reply or reply['job']['state'] in [FINISHED, FAILED]:
+            return reply.get('job', reply)
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description = "MetaTax server, and client to submit jobs to it")
+    commands = argp.add_subparsers(dest = "command")
+    start = commands.add_parser("start", help = "Start a server")
+    start.add_argument('socket', help = 'Path of the Unix socket')
+    start.add_argument('-taxonomy', help = 'Taxonomy snapshot built with taxonomySnapshot.py (default: ete3 NCBITaxa database)')
+    start.add_argument('-jobs', help = 'Maximum number of jobs running at once (default: number of CPUs)', type = int)
+    start.add_argument('-memory-budget', help = 'Memory (in MB) available for the jobs running at once (default: %i%%%% of the physical memory, see config.py)'%(config.memoryBudget*100), type = float)
+    sub = commands.add_parser("submit", help = "Submit a job: metaTax.py input file, output dir and options")
+    sub.add_argument('-wait', help = 'Wait until the job finishes (the exit code is 1 if it fails)', action = "store_true")
+    sub.add_argument('socket', help = 'Path of the Unix socket')
+    sub.add_argument('i', help = 'Input file with information about read files and classification results')
+    sub.add_argument('o', help = 'Dir to write the results of meta-classification')
+    sub.add_argument('options', help = 'Other options of metaTax.py', nargs = argparse.REMAINDER)
+    status = commands.add_parser("status", help = "Show the state of the jobs")
+    status.add_argument('socket', help = 'Path of the Unix socket')
+    status.add_argument('job', help = 'Job ID (default: all jobs)', nargs = "?")
+    stop = commands.add_parser("stop", help = "Stop the server when the submitted jobs finish")
+    stop.add_argument('socket', help = 'Path of the Unix socket')
+    args = argp.parse_args()
+
+    if args.command == "start":
+        if args.taxonomy:
+            config.taxonomySnapshot = args.taxonomy
+        server = MetaTaxServer(args.socket, args.memory_budget, args.jobs, sys.stderr)
+        server.preload()
+        print "MetaTax server listening on %s"%args.socket
+        sys.stdout.flush()
+        server.serve()
+    elif args.command == "submit":
+        reply = submit(args.socket, args.i, args.o, args.options)
+        if 'error' in reply:
+            print "Error: %s"%reply['error']
+            sys.exit(1)
+        print reply['job']
+        if args.wait:
+            job = wait(args.socket, reply['job'])
+            print "%s: %s"%(job['id'], job['state'])
+            if job['state'] != FINISHED:
+                print job['error']
+                sys.exit(1)
+    elif args.command == "status":
+        reply = request(args.socket, {'command': "status", 'job': args.job})
+        if 'error' in reply:
+            print "Error: %s"%reply['error']
+            sys.exit(1)
+        jobs = [reply['job']] if args.job else reply['jobs']
+        for job in jobs:
+            elapsed = (job['finished'] or time.time()) - (job['started'] or time.time())
+            print "%s\t%s\t%0.1f s\t%s\t%s"%(job['id'], job['state'], elapsed, job['input'], job['output'])
+            if job['error']:
+                print job['error']
+        if not args.job:
+            print "Lineages: %i, names: %i"%(reply['lineages'], reply['names'])
+    elif args.command == "stop":
+        print request(args.socket, {'command': "stop"})['state']
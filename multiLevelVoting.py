@@ -1,12 +1,17 @@
-import numpy as np, sys
+import numpy as np, sys, math
 from util import *
 import config
-import scipy.stats
 
 EQUAL        = 1
 COMPATIBLE   = 2
 INCOMPATIBLE = 3
 
+# Weight given to a classification whose lowest level is d levels away from the lowest level of the
+# branch it supports: the density of a normal distribution with mean 0 and std WEIGHT_SD at d (the
+# same values as scipy.stats.norm(0, WEIGHT_SD).pdf(d)), precomputed for d = 0, 1, ...
+WEIGHT_SD = 0.5
+WEIGHTS   = [math.exp(-(d/WEIGHT_SD)**2/2.0)/math.sqrt(2*math.pi)/WEIGHT_SD for d in range(64)]
+
 # ----------------------------------------------
 class Node(object):
     """Represents a single branch of the taxon ID tree. 
@@ -31,11 +36,11 @@ class ClassTree(object):
     def __init__(self, pedantic=False):
         self.roots    = []
         self.lineages = []
-        self.norm = scipy.stats.norm(0, 0.5)
+        self.pruned   = 0 # Number of pruning iterations of the last classification
         if pedantic:
-            self.minw = sum(self.norm.pdf([0, 0]))
+            self.minw = WEIGHTS[0] + WEIGHTS[0]
         else:
-            self.minw = sum(self.norm.pdf([0, 1]))
+            self.minw = WEIGHTS[0] + WEIGHTS[1]
 
     def compare(self, lineage1, lineage2):
         """Compares two lineages, assuming that the first one has the lowest level 
@@ -74,7 +79,7 @@ class ClassTree(object):
         """
         if not isNA(lineage): # Discard NA classification
             if len(self.roots) == 0: # If it is the first lineage, make it a root
-                self.roots.append(Node(lineage, self.norm.pdf(0)))
+                self.roots.append(Node(lineage, WEIGHTS[0]))
             else:
                 # Find if lineage is equal to any axisting root or the largest root compatible with it
                 compat = []
@@ -85,7 +90,7 @@ class ClassTree(object):
                     if result == EQUAL:
                         equal = True
                         node.equalC += 1
-                        node.weight += self.norm.pdf(0) # 1.0
+                        node.weight += WEIGHTS[0]
                         break
                     elif result == COMPATIBLE:
                         node.compatC += 1
@@ -95,10 +100,10 @@ class ClassTree(object):
                         if False:
                             weight = 1.0/(abs(index1-index2)+1)
                         else:
-                            weight = self.norm.pdf(abs(index1-index2))
+                            weight = WEIGHTS[abs(index1-index2)]
                         node.weight += weight
                 if not equal and not compat:
-                    self.roots.append(Node(lineage, self.norm.pdf(0)))
+                    self.roots.append(Node(lineage, WEIGHTS[0]))
 
     def getLowestLevel(self, lineages, levels):
         """Lazy method to find the lowest level (e.g. species, genus, ...) present it at least
@@ -174,6 +179,7 @@ class ClassTree(object):
             if rank == "disagreement":
                 # No classification, prune the last level if possible
                 newLineages = self.pruneLowestLevel(lineages)
+                self.pruned += 1
                 if len(newLineages) > 0:
                     lineages = newLineages
                 else:
@@ -206,6 +212,495 @@ class ClassTree(object):
         else: # We have a tie, then return "disagreement" so the algorithm can prune the tree 
             return "disagreement", "disagreement", 0, 0.0, None
 
+# ----------------------------------------------
+_rankWeights = {}
+
+def rankWeights(pedantic=False):
+    """Returns the weights used by ClassTree, computed only once: a list with the weight given to a
+    branch whose lowest level is d levels above the lowest level of the root (d = 0, 1, ...), and the
+    minimum weight of a valid classification.
+    """
+    if not pedantic in _rankWeights:
+        _rankWeights[pedantic] = WEIGHTS[:len(config.allowedRank)], ClassTree(pedantic).minw
+    return _rankWeights[pedantic]
+
+# ----------------------------------------------
+class TrieNode(object):
+    """Node of the prefix tree used by PrefixTree: a taxon ID at a given rank.
+    Args:
+        pos: index of the rank in config.allowedRank.
+        parent: node of the previous rank in the lineage (None for the first rank).
+        lineage: Ordered dict with the lineage that ends at this node.
+    """
+    def __init__(self, pos, parent, lineage):
+        self.pos     = pos
+        self.parent  = parent
+        self.lineage = lineage
+
+    def ancestors(self):
+        node = self.parent
+        while node is not None:
+            yield node
+            node = node.parent
+
+# ----------------------------------------------
+class PrefixTree(object):
+    """Voting core that returns exactly the same classification as ClassTree, without copying and
+    comparing lineages at each pruning level. Each lineage is inserted once in a rank-ordered prefix
+    tree; equal lineages end at the same node and compatible lineages are ancestors of it. Pruning
+    the lowest level just moves the lineages that end at that level to the parent node, and the votes
+    and weights of all roots are resolved bottom-up in one pass over the tree. If a lineage is 
+    preceded (in the order used by ClassTree) by one of its ancestors, ClassTree's result depends on
+    the order of the roots, so the roots are scanned in that order. Lineages that do not fit in a 
+    prefix tree (unknown ranks, or the same taxon ID with different ancestors) are classified by
+    ClassTree.
+    """
+    def __init__(self, pedantic=False):
+        self.pedantic = pedantic
+        self.lineages = []
+        self.pruned   = 0 # Number of pruning iterations of the last classification
+        self.pdf, self.minw = rankWeights(pedantic)
+
+    def addClassification(self, lineage):
+        """Append a lineage (branch) to the classification algorithm
+        Args:
+            lineage: branch to be added.
+        """
+        self.lineages.append(lineage)
+
+    def buildTree(self, lineages):
+        """Inserts the lineages in a prefix tree.
+        Returns:
+            the node where each lineage ends, or None if the lineages do not fit in a prefix tree.
+        """
+        rankPos = dict((r, i) for i, r in enumerate(config.allowedRank))
+        nodes   = {}
+        leaves  = []
+        for l in lineages:
+            parent = None
+            for k, v in l.iteritems():
+                pos = rankPos.get(k)
+                if pos is None or (parent is not None and pos <= parent.pos):
+                    return None
+                node = nodes.get((k, v))
+                if node is None:
+                    node = TrieNode(pos, parent, OrderedDict(parent.lineage.items() + [(k, v)]) if parent else OrderedDict([(k, v)]))
+                    nodes[(k, v)] = node
+                elif node.parent is not parent:
+                    return None
+                parent = node
+            leaves.append(parent)
+        return leaves
+
+    def getClassification(self):
+        """Returns the same classification as ClassTree.getClassification(): lowest rank, corresponding
+        taxon ID, number of votes, weight and full lineage.
+        """
+        # Same order as ClassTree: lowest level first, then larger lineages, then inverse input order
+        keys = []
+        for i, l in enumerate(self.lineages):
+            lowest = [r for r in reversed(config.allowedRank) if r in l]
+            keys.append((len(config.allowedRank) - 1 - config.allowedRank.index(lowest[0]) if lowest else 0, -len(l), -i))
+        sortedLineages = [self.lineages[i] for i in sorted(range(len(keys)), key=lambda i: keys[i])]
+        current = self.buildTree(sortedLineages)
+        if current is None:
+            classTree = ClassTree(self.pedantic)
+            for l in self.lineages:
+                classTree.addClassification(l)
+            result = classTree.getClassification()
+            self.pruned = classTree.pruned
+            return result
+        while True:
+            winner = self.__resolve(current)
+            if winner is not None:
+                node, votes, weight = winner
+                return node.lineage.keys()[-1], node.lineage.values()[-1], votes, weight, node.lineage
+            # No classification, prune the last level if possible
+            self.pruned += 1
+            lowest  = max(n.pos for n in current)
+            current = [n.parent if n.pos == lowest else n for n in current]
+            current = [n for n in current if n is not None]
+            if len(current) == 0:
+                return "disagreement", "disagreement", 0, 0.0, None
+
+    def __resolve(self, current):
+        """Computes the roots for the lineages ending at the nodes in 'current' (sorted as in ClassTree).
+        Returns:
+            (node, votes, weight) of the winner root, or None if there is a tie.
+        """
+        pdf = self.pdf
+        seen = set()
+        ordered = True
+        for n in current:
+            for a in n.ancestors():
+                if a in seen:
+                    ordered = False
+            seen.add(n)
+        roots = []
+        if ordered:
+            # Roots are the nodes without descendants. Each root receives its equal lineages first and 
+            # then the compatible ones, from the lowest to the highest level
+            counts = {}
+            inner  = set()
+            for n in current:
+                if n not in counts:
+                    counts[n] = 0
+                    inner.update(n.ancestors())
+                counts[n] += 1
+            for n in current:
+                if n in inner:
+                    continue
+                inner.add(n) # Each root is resolved once
+                equalC = counts[n]
+                weight = pdf[0]
+                for i in range(equalC - 1):
+                    weight += pdf[0]
+                compatC = 0
+                for a in n.ancestors():
+                    c = counts.get(a, 0)
+                    for i in range(c):
+                        weight += pdf[n.pos - a.pos]
+                    compatC += c
+                roots.append((n, float(equalC) + compatC, weight))
+        else:
+            # Same as ClassTree.__addClassification, comparing nodes instead of lineages
+            for n in current:
+                anc = set(n.ancestors())
+                matched = False
+                for root in roots:
+                    if root[0] is n:
+                        root[1] += 1
+                        root[3] += pdf[0]
+                        matched = True
+                        break
+                    elif n in root[4]:
+                        root[2] += 1
+                        root[3] += pdf[root[0].pos - n.pos]
+                        matched = True
+                if not matched:
+                    roots.append([n, 1.0, 0.0, pdf[0], anc])
+            roots = [(r[0], r[1] + r[2], r[3]) for r in roots]
+        weights = [r[2] for r in roots]
+        maxW = max(weights)
+        if weights.count(maxW) == 1:
+            return roots[weights.index(maxW)]
+        return None
+
+# ----------------------------------------------
+class VotingCache(object):
+    """Memoizes the result of ClassTree.getClassification(). In real metagenomes most reads fall into
+    a few thousands of distinct combinations of classifications, so the vote is computed once for 
+    each combination. A combination is identified by the tuple of the lowest taxon IDs of its (non NA)
+    lineages, in the order of the classifiers: the lineage of a taxon ID is always the same, and the
+    order matters, as ClassTree breaks ties between lineages with missing ranks by their order. The
+    least recently used combinations are discarded when there are more than 'maxSize' of them.
+    Args:
+        pedantic: as in ClassTree.
+        maxSize: maximum number of combinations kept (0 disables the cache).
+    """
+    def __init__(self, pedantic=False, maxSize=100000):
+        self.pedantic = pedantic
+        self.maxSize  = maxSize
+        self.cache    = OrderedDict()
+        self.hits     = 0
+        self.misses   = 0
+        self.pruned   = 0 # Pruning iterations of the classifications computed (misses)
+        _, self.minw  = rankWeights(pedantic)
+
+    def getClassification(self, lineages):
+        """Returns the classification of a read, as ClassTree.getClassification().
+        Args:
+            lineages: list of (non NA) lineages given to the read by the classifiers.
+        """
+        key = tuple([l.values()[-1] for l in lineages])
+        result = self.cache.pop(key, None)
+        if result is None:
+            self.misses += 1
+            classTree = PrefixTree(self.pedantic)
+            for l in lineages:
+                classTree.addClassification(l)
+            result = classTree.getClassification()
+            self.pruned += classTree.pruned
+            if self.maxSize <= 0:
+                return result
+            if len(self.cache) >= self.maxSize:
+                self.cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self.cache[key] = result
+        return result
+
+    def getClassifications(self, lineageLists, calls=None):
+        """Returns the classification of several reads (None for reads without lineages).
+        Args:
+            lineageLists: one list of (non NA) lineages for each read.
+            calls: not used (see BatchVoting.getClassifications()).
+        """
+        return [self.getClassification(l) if len(l) > 0 else None for l in lineageLists]
+
+# ----------------------------------------------
+DISAGREEMENT = -1
+NO_LINEAGE   = -2
+
+def lineagesToMatrix(lineageLists, nTools, levels=None):
+    """Converts lineages to the integer matrix used by batchClassification().
+    Args:
+        lineageLists: one list of (non NA) lineages for each read, with at most nTools lineages.
+        nTools: size of the second dimension of the matrix.
+        levels: list of ranks (default: config.allowedRank).
+    Returns:
+        an int64 matrix (reads x nTools x ranks) with the taxon ID of each rank of each lineage
+        (0 if the lineage does not have the rank or there is no lineage).
+    """
+    if levels is None:
+        levels = config.allowedRank
+    rankIdx = dict((r, i) for i, r in enumerate(levels))
+    matrix  = np.zeros((len(lineageLists), nTools, len(levels)), dtype=np.int64)
+    for n, lineages in enumerate(lineageLists):
+        for t, lineage in enumerate(lineages):
+            for k, v in lineage.iteritems():
+                matrix[n, t, rankIdx[k]] = int(v)
+    return matrix
+
+def batchClassification(matrix, pdf):
+    """Vectorized version of ClassTree.getClassification(), that classifies a batch of reads at once.
+    It runs the same multilevel algorithm for all reads: lineages are sorted, added to the roots 
+    (equal and compatible counts and weights are accumulated in the same order as in ClassTree, so
+    results are identical) and, for the reads without a winner, the lowest level is pruned and the 
+    roots are computed again.
+    Args:
+        matrix: integer matrix (reads x tools x ranks) with the taxon ID of each rank, as returned
+            by lineagesToMatrix(). Ranks are sorted from high to low levels. Missing classifications
+            are rows of zeros.
+        pdf: pdf[d] is the weight given to a compatible branch whose lowest level is d levels 
+            above the lowest level of the root (pdf[0] is the weight of equal branches).
+    Returns:
+        rank: index of the lowest rank of the classification, DISAGREEMENT or NO_LINEAGE.
+        taxId: lowest taxon ID of the classification (0 if there is no classification).
+        votes: number of votes (equal + compatible branches).
+        weight: weight of the classification.
+        lineages: matrix (reads x ranks) with the (pruned) lineage of the classification.
+    """
+    M = np.array(matrix, dtype=np.int64)
+    N, T, R = M.shape
+    pdf = np.asarray(pdf, dtype=np.float64)
+    rank     = np.full(N, NO_LINEAGE, dtype=np.int64)
+    taxId    = np.zeros(N, dtype=np.int64)
+    votes    = np.zeros(N, dtype=np.float64)
+    weight   = np.zeros(N, dtype=np.float64)
+    lineages = np.zeros((N, R), dtype=np.int64)
+    if N == 0 or T == 0:
+        return rank, taxId, votes, weight, lineages
+    # Sort lineages as ClassTree: lowest level first, then larger lineages first, then inverse input order
+    present = M != 0
+    lowIdx  = np.argmax(present[:, :, ::-1], axis=2)
+    length  = present.sum(2)
+    pos     = np.tile(np.arange(T), (N, 1))
+    order   = np.lexsort((-pos, -length, lowIdx))
+    M = M[np.arange(N)[:, None], order]
+
+    pending = np.nonzero(present.any(2).any(1))[0]
+    while len(pending) > 0:
+        n   = len(pending)
+        sub = M[pending]
+        present  = sub != 0
+        valid    = present.any(2)
+        lowIdx   = np.argmax(present[:, :, ::-1], axis=2)
+        lastPos  = R - 1 - lowIdx
+        lastTax  = sub[np.arange(n)[:, None], np.arange(T)[None, :], lastPos]
+        isRoot   = np.zeros((n, T), dtype=bool)
+        equalC   = np.zeros((n, T), dtype=np.float64)
+        compatC  = np.zeros((n, T), dtype=np.float64)
+        w        = np.zeros((n, T), dtype=np.float64)
+        for j in range(T):
+            vj = valid[:, j]
+            if not vj.any():
+                continue
+            stopped = np.zeros(n, dtype=bool)
+            matched = np.zeros(n, dtype=bool)
+            for k in range(j):
+                act = vj & isRoot[:, k] & ~stopped
+                if not act.any():
+                    continue
+                eq   = act & (lastPos[:, k] == lastPos[:, j]) & (lastTax[:, k] == lastTax[:, j])
+                comp = act & ~eq & ((sub[:, j] == 0) | (sub[:, k] == sub[:, j])).all(1)
+                equalC[eq, k] += 1
+                w[eq, k]      += pdf[0]
+                compatC[comp, k] += 1
+                w[comp, k]       += pdf[np.abs(lowIdx[comp, k] - lowIdx[comp, j])]
+                stopped |= eq
+                matched |= eq | comp
+            new = vj & ~matched
+            isRoot[new, j] = True
+            equalC[new, j] = 1
+            w[new, j]      = pdf[0]
+        # Winner: the root with the largest weight, if there are no ties
+        rootW  = np.where(isRoot, w, -np.inf)
+        maxW   = rootW.max(1)
+        win    = np.argmax(rootW, 1)
+        unique = (rootW == maxW[:, None]).sum(1) == 1
+        idx    = pending[unique]
+        winU   = win[unique]
+        rows   = np.nonzero(unique)[0]
+        rank[idx]     = lastPos[rows, winU]
+        taxId[idx]    = lastTax[rows, winU]
+        votes[idx]    = equalC[rows, winU] + compatC[rows, winU]
+        weight[idx]   = w[rows, winU]
+        lineages[idx] = sub[rows, winU]
+        # Disagreement: prune the lowest level of all lineages and try again
+        rows = np.nonzero(~unique)[0]
+        sub  = sub[rows]
+        lowest = R - 1 - np.argmax(present[rows].any(1)[:, ::-1], axis=1)
+        sub[np.arange(len(rows)), :, lowest] = 0
+        M[pending[rows]] = sub
+        left = (sub != 0).any(2).any(1)
+        rank[pending[rows[~left]]] = DISAGREEMENT
+        pending = pending[rows[left]]
+    return rank, taxId, votes, weight, lineages
+
+class BatchVoting(object):
+    """Classifies batches of reads with batchClassification(), returning the same results as 
+    ClassTree.getClassification().
+    Args:
+        pedantic: as in ClassTree.
+        tables: classifierTables.ClassifierTables of the reads, or None. If given, the matrix of each batch
+            is indexed from its lineage matrix (see ClassifierTables.batchMatrix()) instead of being built
+            from the lineages.
+    """
+    def __init__(self, pedantic=False, tables=None):
+        self.pdf, self.minw = rankWeights(pedantic)
+        self.tables = tables
+
+    def getClassifications(self, lineageLists, calls=None):
+        """Returns the classification of several reads (None for reads without lineages).
+        Args:
+            lineageLists: one list of (non NA) lineages for each read.
+            calls: the taxon IDs of each read, as returned by ClassifierTables.calls(), used with 'tables'.
+        """
+        matrix = None
+        if self.tables is not None and calls is not None and len(calls) > 0:
+            matrix = self.tables.batchMatrix(calls)
+        if matrix is None:
+            nTools = max([len(l) for l in lineageLists] + [0])
+            matrix = lineagesToMatrix(lineageLists, nTools)
+        rank, taxId, votes, weight, lineages = batchClassification(matrix, self.pdf)
+        results = []
+        for n in range(len(lineageLists)):
+            if rank[n] == NO_LINEAGE:
+                results.append(None)
+            elif rank[n] == DISAGREEMENT:
+                results.append(("disagreement", "disagreement", 0, 0.0, None))
+            else:
+                lineage = OrderedDict((config.allowedRank[r], int(t)) for r, t in enumerate(lineages[n]) if t != 0)
+                results.append((config.allowedRank[rank[n]], int(taxId[n]), float(votes[n]), float(weight[n]), lineage))
+        return results
+
+def randomLineageLists(nReads, nTools=7, seed=0, consistent=True):
+    """Random combinations of lineages (with missing ranks and repeated lineages) used to check the
+    voting engines against ClassTree.
+    Args:
+        nReads: number of combinations.
+        nTools: maximum number of lineages in each combination.
+        seed: random seed.
+        consistent: if True, lineages come from a random taxonomy tree (as lineages from NCBI). If 
+            False, the same taxon ID may appear with different ancestors.
+    Returns:
+        a list of lists of lineages.
+    """
+    rnd = np.random.RandomState(seed)
+    levels = config.allowedRank
+    # A small random taxonomy, so that lineages are often equal or compatible
+    taxa = []
+    if consistent:
+        nodes = [OrderedDict()]
+        while len(taxa) < 200:
+            parent = nodes[rnd.randint(0, len(nodes))]
+            pos = levels.index(parent.keys()[-1]) + 1 if len(parent) > 0 else 0
+            if rnd.rand() < 0.15: # missing rank
+                pos += 1
+            if pos >= len(levels):
+                continue
+            lineage = OrderedDict(parent.items() + [(levels[pos], len(nodes))])
+            nodes.append(lineage)
+            taxa.append(lineage)
+    else:
+        for n in range(200):
+            lineage = OrderedDict()
+            parent  = 0
+            for i, r in enumerate(levels):
+                parent = parent*3 + rnd.randint(1, 4)
+                if rnd.rand() < 0.15 and i > 0: # missing rank
+                    continue
+                lineage[r] = parent
+            depth = rnd.randint(1, len(levels)+1)
+            lineage = OrderedDict(lineage.items()[:depth])
+            if len(lineage) > 0:
+                taxa.append(lineage)
+    lineageLists = []
+    for n in range(nReads):
+        k = rnd.randint(0, nTools+1)
+        pool = rnd.randint(1, len(taxa)+1)
+        lineageLists.append([taxa[rnd.randint(0, min(pool, 6))] if rnd.rand() < 0.5 else taxa[rnd.randint(0, pool)] for i in range(k)])
+    return lineageLists
+
+def classTreeClassifications(lineageLists):
+    """Reference classification of several reads with ClassTree (None for reads without lineages).
+    """
+    results = []
+    for lineages in lineageLists:
+        if len(lineages) == 0:
+            results.append(None)
+        else:
+            classTree = ClassTree()
+            for l in lineages:
+                classTree.addClassification(l)
+            results.append(classTree.getClassification())
+    return results
+
+def checkBatchClassification(nReads=5000, nTools=7, seed=0):
+    """Differential check of BatchVoting against ClassTree, with consistent and inconsistent lineages.
+    Returns:
+        the number of reads with different results.
+    """
+    errors = 0
+    for consistent in [True, False]:
+        lineageLists = randomLineageLists(nReads, nTools, seed, consistent)
+        expected = classTreeClassifications(lineageLists)
+        errors += sum(e != r for e, r in zip(expected, BatchVoting().getClassifications(lineageLists)))
+    return errors
+
+def checkPrefixTree(nReads=5000, nTools=7, seed=0):
+    """Differential check of PrefixTree against ClassTree, with consistent and inconsistent lineages.
+    Returns:
+        the number of reads with different results.
+    """
+    errors = 0
+    for consistent in [True, False]:
+        lineageLists = randomLineageLists(nReads, nTools, seed, consistent)
+        expected = classTreeClassifications(lineageLists)
+        for lineages, e in zip(lineageLists, expected):
+            if len(lineages) > 0:
+                prefixTree = PrefixTree()
+                for l in lineages:
+                    prefixTree.addClassification(l)
+                if prefixTree.getClassification() != e:
+                    errors += 1
+    return errors
+
+def checkVotingCache(nReads=5000, nTools=7, seed=0):
+    """Differential check of VotingCache against ClassTree. Consistent lineages are classified with one
+    cache, and inconsistent ones (the same taxon ID with other lineages) without memoization.
+    Returns:
+        the number of reads with different results.
+    """
+    errors = 0
+    for consistent in [True, False]:
+        lineageLists = randomLineageLists(nReads, nTools, seed, consistent)
+        expected = classTreeClassifications(lineageLists)
+        voter = VotingCache(maxSize = 100000 if consistent else 0)
+        errors += sum(e != r for e, r in zip(expected, voter.getClassifications(lineageLists)))
+    return errors
+
 if __name__ == "__main__":
     from collections import OrderedDict
     
@@ -224,4 +719,12 @@ if __name__ == "__main__":
     for c in l:
         classTree.addClassification(c)
     print classTree.getClassification()
+    batchErrors  = checkBatchClassification()
+    prefixErrors = checkPrefixTree()
+    cacheErrors  = checkVotingCache()
+    print "Differential check of BatchVoting against ClassTree: %i errors"%batchErrors
+    print "Differential check of PrefixTree against ClassTree: %i errors"%prefixErrors
+    print "Differential check of VotingCache against ClassTree: %i errors"%cacheErrors
+    if batchErrors + prefixErrors + cacheErrors > 0:
+        sys.exit(1)
 
@@ -0,0 +1,29 @@
+"""Registry of the plugins that read the output of each classifier (see config.plugins). A plugin is
+imported the first time it is requested, i.e. when a sample uses its tool, and only once per process.
+"""
+
+import sys, os, importlib
+from os.path import join
+import config
+
+myPath = os.path.split( os.path.abspath(__file__) )[0]
+if join(myPath, "plugins") not in sys.path:
+    sys.path.append(join(myPath, "plugins"))
+
+_modules = {}
+
+def isTool(name):
+    """Returns True if there is a plugin for the tool 'name'.
+    """
+    return name in config.plugins
+
+def getPlugin(name):
+    """Returns the plugin module of a tool, importing it if needed.
+    Args:
+        name: name of the tool (a key of config.plugins) or of the plugin module.
+    """
+    moduleName = config.plugins.get(name, name)
+    module = _modules.get(moduleName)
+    if module is None:
+        module = _modules[moduleName] = importlib.import_module(moduleName)
+    return module
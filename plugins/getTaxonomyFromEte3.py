@@ -1,10 +1,140 @@
-import sys, os, csv
-from ete3 import NCBITaxa
+import sys, os
 from os.path import join, isfile
 from collections import OrderedDict
 sys.path.append("../")
 import config
 
+_ncbi         = None
+_lineageCache = {}
+_nameCache    = {}
+
+def getNCBI():
+    '''
+    getNCBI: returns the taxonomy database shared by all plugins, creating it on the first call. It is a
+    TaxonomySnapshot if config.taxonomySnapshot is set, or an instance of NCBITaxa() from ete3 otherwise.
+    '''
+    global _ncbi
+    if _ncbi is None:
+        if config.taxonomySnapshot:
+            from taxonomySnapshot import TaxonomySnapshot
+            _ncbi = TaxonomySnapshot(config.taxonomySnapshot)
+        else:
+            from ete3 import NCBITaxa
+            _ncbi = NCBITaxa()
+    return _ncbi
+
+def taxonomyIdentity():
+    '''
+    taxonomyIdentity: returns a string that identifies the taxonomy database used by getNCBI() (file name and
+    modification time), so that data derived from it (e.g. cached lineages) can be invalidated when it changes.
+    '''
+    if config.taxonomySnapshot:
+        fileName = os.path.abspath(config.taxonomySnapshot)
+    else:
+        fileName = getNCBI().dbfile
+    return "%s:%s"%(fileName, os.path.getmtime(fileName))
+
+def resetNCBI():
+    '''
+    resetNCBI: forgets the shared taxonomy database, so that the next call to getNCBI() opens it again. Worker
+    processes call it, so they do not share the SQLite connection of their parent process.
+    '''
+    global _ncbi
+    _ncbi = None
+
+def naLineage():
+    '''
+    naLineage: returns the lineage used for reads without classification.
+    '''
+    return OrderedDict([("root", "0")])
+
+def resolveLineages(taxIds, ncbi = None, allowedRank = None):
+    '''
+    resolveLineages: returns the full lineage of many taxon IDs at once, using a few bulk queries to the
+    taxonomy database instead of several queries per taxon ID.
+
+    Parameters:
+    - taxIds: iterable with taxon ids (int)
+    - ncbi: an instance of NCBITaxa() class from ete3 package (default: the instance returned by getNCBI())
+    - allowedRank: a list of rank names (e.g. ["phylum", ...]) to be considered (default: config.allowedRank)
+
+    Returns: a dictionary taxon id -> OrderedDict() with the full lineage. It contains (at least) every
+    requested taxon id, and taxon id 0 is mapped to the NA lineage.
+
+    Remarks: the dictionary is memoized by the set of allowed ranks, so it is shared by all plugins and only
+    taxon ids not seen before are queried. Merged taxon ids are translated through the 'merged' table
+    of the database.
+    '''
+    if allowedRank is None:
+        allowedRank = config.allowedRank
+    lineageDict = _lineageCache.setdefault(frozenset(allowedRank), {0: naLineage()})
+    missing = set(int(id) for id in taxIds) - set(lineageDict.keys())
+    if len(missing) == 0:
+        return lineageDict
+    if ncbi is None:
+        ncbi = getNCBI()
+    _, merged = ncbi._translate_merged(missing)
+    tracks    = ncbi.get_lineage_translator([merged.get(id, id) for id in missing])
+    ancestors = set()
+    for track in tracks.values():
+        ancestors.update(track)
+    ranks = ncbi.get_rank(list(ancestors))
+    names = ncbi.get_taxid_translator([1])
+    for id in missing:
+        track = tracks.get(merged.get(id, id), [])
+        if len(track) == 0 or (len(track) == 1 and names.get(track[0]) == "root"): # Unknown or only root
+            lineageDict[id] = naLineage()
+            continue
+        lineage = OrderedDict()
+        for lin in track:
+            if lin != 0:
+                rank = ranks.get(lin)
+                if rank in allowedRank:
+                    lineage[rank] = lin
+        if len(lineage) == 0:
+            lineage['root'] = '0'
+        lineageDict[id] = lineage
+    return lineageDict
+
+def resolveNames(taxIds, ncbi = None):
+    '''
+    resolveNames: returns the scientific names of many taxon IDs at once, with a single query to the taxonomy database.
+
+    Parameters:
+    - taxIds: iterable with taxon ids (int)
+    - ncbi: an instance of NCBITaxa() class from ete3 package (default: the instance returned by getNCBI())
+
+    Returns: a dictionary taxon id -> name. It contains every requested taxon id found in the database.
+
+    Remarks: as in resolveLineages(), the dictionary is shared by all callers and only taxon ids not seen before
+    are queried.
+    '''
+    missing = set(int(id) for id in taxIds if id not in _nameCache)
+    if len(missing) > 0:
+        if ncbi is None:
+            ncbi = getNCBI()
+        _nameCache.update(ncbi.get_taxid_translator(list(missing)))
+    return _nameCache
+
+def addLineages(lineages, names = None, allowedRank = None):
+    '''
+    addLineages: adds lineages obtained elsewhere (e.g. from a cache) to the lineages shared by resolveLineages(),
+    and the names of their taxa to the names shared by resolveNames().
+
+    Parameters:
+    - lineages: dictionary taxon id -> list of (rank, taxon id) items of its lineage
+    - names: dictionary taxon id -> scientific name (optional)
+    - allowedRank: the list of rank names the lineages were resolved with (default: config.allowedRank)
+    '''
+    if allowedRank is None:
+        allowedRank = config.allowedRank
+    lineageDict = _lineageCache.setdefault(frozenset(allowedRank), {0: naLineage()})
+    for id, items in lineages.iteritems():
+        if id not in lineageDict:
+            lineageDict[id] = OrderedDict(items)
+    if names is not None:
+        _nameCache.update(names)
+
 def getLineageDict(originalId, ncbi, allowedRank):
     '''
     getLineageDict: returns the full lineage of a taxon ID as an ordered dictionary
@@ -18,132 +148,28 @@ def getLineageDict(originalId, ncbi, allowedRank):
 
     Returns: an OrderedDict() instance with the full lineage. 
 
-    Remarks: I just found that some taxon ids have been merged and ete3 does not handle them well, e.g 269483 was 
-    merged with 482957, but get_lineage(269483) returns [1]. The workaround is to translate taxid to name
-    and then back to taxid.
-    '''
-    nameList = ncbi.get_taxid_translator([originalId])
-    if len(nameList) == 0:
-        return OrderedDict([("root", "0")])
-    name = nameList[originalId]
-    idL = ncbi.get_name_translator([name])[name]
-    if originalId in idL:
-        id = originalId
-    else:
-        id = idL[-1]
-    #if id != originalId:
-    #    print originalId, id, name
-    lineage = ncbi.get_lineage(id)
-    if len(lineage) == 1 and ncbi.get_taxid_translator(lineage)[lineage[0]] == "root": # Only root
-        lineageDict = OrderedDict([("root", "0")])
-    else:
-        lineageDict = OrderedDict()
-        for lin in lineage:
-            if lin != 0:
-                name = ncbi.get_taxid_translator([lin])[lin]
-                rank = ncbi.get_rank([lin])[lin]
-                if rank in allowedRank:
-                    lineageDict[rank] = lin
-        if len(lineageDict) == 0:
-            lineageDict['root'] = '0'
-    return lineageDict
+    Remarks: this is a thin wrapper around resolveLineages(); prefer calling resolveLineages() with all taxon
+    ids at once.
+    '''
+    return resolveLineages([originalId], ncbi, allowedRank)[originalId]
 
 
-def getTaxonomy(srcFile, readNameColumn, taxIdColumn, skipHeader = True, sep = "\t", secondOption = -1, skipLines = False, log = False):
-    '''getTaxonomy: parses a taxonomy file (output from some classifier) and returns a dictionary with the full lineage for each read. 
-    
-    Paramenters:
-    - srcFile: file with the taxonomy classification
-    - readNameColumn: column index (zero-based) of the read name
-    - taxIdColumn: column index (zer0-based) of the taxon ID
-    - skipHeader: whether the file contains a header (true) or not
-    - sep: symbol used as separator in the input file (tab, comma, semicolon, etc...)
-    - secondOption: index of a second taxon ID to consider. This was included due to Clark-S 
-    returning 2 classifications. In the first is NA, then we consider the second (default = -1, no 
-    second option available)
-    - skipLines: some classifiers output 2 lines for each read (such as MyTaxa). 
-    Set this to true if it is the case.
-    - log: set to True to see messages in the terminal output
+def normalizeReadName(name):
+    '''normalizeReadName: removes the description, the FASTA/FASTQ markers and the mate suffix (/1 or /2) from a read name,
+    so that names from the reads file and from all classifiers can be matched.
+    '''
+    cleanReadName = name.split(" ")[0].replace("@", "").replace(">", "").strip()
+    if cleanReadName.endswith("/1") or cleanReadName.endswith("/2"):
+        cleanReadName = cleanReadName[0:-2]
+    return cleanReadName
 
-    Returns: a dictionary where read names are the keys, and the values are OrderedDict objects with the full lineage.
+def lineageTable(taxIdDict, lineageDict):
+    '''lineageTable: maps the taxon IDs returned by readTaxIds() (see parserEngine.py) to their lineages.
 
-    Remarks: This function calls "getLineageDict", which receives a list of allowed ranks.
-    '''
-    # Validating directory
-    if not os.path.isfile(srcFile):
-        print "Source file %s not found"%srcFile
-        return {}
-    ncbi = NCBITaxa()
-    taxIds   = []
-    if log: print "Reading entries from file : ", f
-    fileIn = csv.reader(open(srcFile, "rt"), delimiter=sep)
-    if skipHeader:
-        fileIn.next()
-    skipThisLine = False
-    for i, l in enumerate(fileIn):
-        if skipLines and skipThisLine:
-            skipThisLine = not skipThisLine
-            continue
-        skipThisLine = not skipThisLine
-        taxId = 0
-        try:
-            taxId = int(l[taxIdColumn])
-        except:
-            if secondOption != -1:
-                try:
-                    taxId = int(l[secondOption])
-                except:
-                    continue
-            else:
-                continue
-        if taxId != 0:
-            taxIds.append(taxId)
-    if log: print "Total number of entries   : ", len(taxIds)
-    singletonList = list(set(taxIds))
-    if log: print "Number of unique IDs      : ", len(singletonList)
-    lineageDict = dict()
-    for i, id in enumerate(singletonList):
-        # getting complete lineage
-        lineageDict[id] = getLineageDict(id, ncbi, allowedRank = config.allowedRank)
-    if log: print "Number of lineages created: ", len(lineageDict.keys())
-    # =============================================
-    # Populate file entries
-    if log: print "Number of lineages loaded: ", len( lineageDict.keys() )
-    # Create table with lineage for each read
-    if log: print "getting full lineage for %s"%(srcFile)
-    fileIn = csv.reader(open(srcFile, "rt"), delimiter=sep)
-    if skipHeader:
-        fileIn.next()
-
-    outDict = {}
-    # fout   = open(os.path.join(outDir, f+"_with_lineage.tsv"), "wt")
-    skipThisLine = False
-    conut = 0
-    for l in fileIn:
-        if skipLines and skipThisLine:
-            skipThisLine = not skipThisLine
-            continue
-        skipThisLine = not skipThisLine
-        try:
-            taxId = int(l[taxIdColumn])
-        except:
-            if secondOption != -1:
-                try:
-                    taxId = int(l[secondOption])
-                except:
-                    continue
-            else:
-                continue
-        if taxId != 0:
-            lin = lineageDict[taxId]
-        else:
-            lin = OrderedDict([("root", "0")])
-        cleanReadName = l[readNameColumn].split(" ")[0].replace("@", "").replace(">", "").strip()
-        if cleanReadName.endswith("/1") or cleanReadName.endswith("/2"):
-            cleanReadName = cleanReadName[0:-2]
-        # fout.write("%s\t%s\n"%(l[readNameColumn].split(" ")[0].replace("@", "").replace(">", "").strip(), lin))
-        outDict[cleanReadName] = lin
-    return outDict
-
-if __name__ == "__main__":
-    print getTaxonomy("../../../kraken_db_test/results_classifiers/clark/HiSeq_accuracy_classif_clark.csv", readNameColumn=0, taxIdColumn=2, skipHeader = False, sep = ",")
+    Parameters:
+    - taxIdDict: dictionary read name -> taxon ID, as returned by readTaxIds()
+    - lineageDict: dictionary taxon ID -> lineage, as returned by resolveLineages()
+
+    Returns: a dictionary where read names are the keys, and the values are OrderedDict objects with the full lineage.
+    '''
+    return dict((read, lineageDict[taxId]) for read, taxId in taxIdDict.iteritems())
@@ -0,0 +1,6 @@
+from parserEngine import bindSpec
+
+# Centrifuge output with several hits per read (-k > 1): each read is assigned to the lowest common ancestor of its hits
+params = dict(readNameColumn = 0, taxIdColumn = 2, skipHeader = True, multiHit = "lca")
+
+bindSpec(__name__)
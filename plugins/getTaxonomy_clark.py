@@ -1,5 +1,5 @@
-import sys, os, csv, pickle, time
-from getTaxonomyFromEte3 import getTaxonomy as gt
+from parserEngine import bindSpec
 
-def getTaxonomy(srcFile):
-    return gt(srcFile, readNameColumn = 0, taxIdColumn = 2, skipHeader = False, sep=",")
+params = dict(readNameColumn = 0, taxIdColumn = 2, skipHeader = False, sep=",")
+
+bindSpec(__name__)
@@ -1,6 +1,5 @@
-import sys, os, csv, pickle, time
-sys.path.append("../")
-from getTaxonomyFromEte3 import getTaxonomy as gt
+from parserEngine import bindSpec
 
-def getTaxonomy(srcFile):
-    return gt(srcFile, readNameColumn = 1, taxIdColumn = 2, skipHeader = False)
+params = dict(readNameColumn = 1, taxIdColumn = 2, skipHeader = False, statusColumn = 0, unclassified = ['U'])
+
+bindSpec(__name__)
@@ -0,0 +1,6 @@
+from parserEngine import bindSpec
+
+# Kraken 2 standard output; with --use-names the taxon ID column is 'name (taxid N)'
+params = dict(readNameColumn = 1, taxIdColumn = 2, skipHeader = False, statusColumn = 0, unclassified = ['U'], taxIdLabel = 'taxid ')
+
+bindSpec(__name__)
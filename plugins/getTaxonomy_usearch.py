@@ -1,6 +1,5 @@
-import sys, os, csv, pickle, time
-sys.path.append("../")
-from getTaxonomyFromEte3 import getTaxonomy as gt
+from parserEngine import bindSpec
 
-def getTaxonomy(srcFile):
-    return gt(srcFile, readNameColumn = 0, taxIdColumn = 1, skipHeader = False)
+params = dict(readNameColumn = 0, taxIdColumn = 1, skipHeader = False)
+
+bindSpec(__name__)
@@ -0,0 +1,300 @@
+'''
+Parser engine of the classifier plugins. Each plugin is a declarative spec (the 'params' dictionary of
+the plugin module) and the engine parses its outputs in large chunks: each chunk of the file is split
+in columns at once (all lines of a chunk usually have the same number of columns), taxon IDs are
+converted to an integer column with numpy and read names are normalized on the joined column. Lines
+are only handled one at a time when the chunk has lines with different numbers of columns.
+
+Keys of a spec:
+- readNameColumn: column index (zero-based) of the read name
+- taxIdColumn: column index (zero-based) of the taxon ID
+- skipHeader: whether the file contains a header (default: True)
+- sep: column separator (default: tab). Quotes are not interpreted.
+- secondOption: index of a second taxon ID column, used when the first one is not a number, as in
+  Clark-S (default: -1, none)
+- skipLines: True if the classifier writes 2 lines for each read (such as MyTaxa); every second line is skipped
+- commentPrefix: lines starting with it are skipped (default: None)
+- statusColumn, unclassified: column index of the classification status, and list of the values of
+  reads that were not classified (e.g. "U" in Kraken); these reads are reported with taxon ID 0 (NA)
+- taxIdLabel: if given, the taxon ID is the number after the last occurrence of this label in the
+  taxon ID column, up to an optional ')' (e.g. "taxid " for "Escherichia coli (taxid 562)")
+- multiHit: what to do when consecutive lines report the same read (e.g. Centrifuge): 'last' (default,
+  the last line is used), 'first' (the first line is used) or 'lca' (the lowest common ancestor of
+  the taxa of all lines, at the ranks of config.allowedRank)
+Lines without a valid taxon ID are skipped.
+
+All functions can also parse only the entries of the reads of one shard (see util.readBucket()): the
+other rows are dropped in each chunk, right after the read names are normalized.
+
+A plugin module only declares its spec and calls bindSpec(__name__), that adds the functions of the plugin
+interface, getTaxonomy(), readTaxIds(), iterTaxIds() and readTable(), bound to it.
+'''
+
+import sys, os, re, itertools, numpy as np
+import config
+from compressedFiles import openInput
+from util import readBuckets
+from getTaxonomyFromEte3 import normalizeReadName, resolveLineages, lineageTable
+
+_mateSuffix = re.compile(r"/[12]\n")
+
+def normalizeReadNames(names):
+    '''
+    normalizeReadNames: same as normalizeReadName() for a list of read names, done on the joined names
+    when they have no whitespace.
+    '''
+    text = "\n".join(names)
+    if len(names) == 0 or re.search(r"[ \t\r\x0b\x0c]", text):
+        return [normalizeReadName(n) for n in names]
+    text = _mateSuffix.sub("\n", text.replace("@", "").replace(">", "") + "\n")
+    return text[:-1].split("\n")
+
+def _taxIdColumn(values, label = None):
+    '''
+    _taxIdColumn: converts a column to taxon IDs. Returns (taxon IDs as an int64 array, mask of valid values).
+    '''
+    if label is not None:
+        values = [v.rpartition(label)[2].rstrip(")") if v is not None else "" for v in values]
+    if all(v is not None and v.isdigit() for v in values):
+        return np.fromiter(itertools.imap(int, values), dtype = np.int64, count = len(values)), np.ones(len(values), dtype = bool)
+    values = [v.strip() if v is not None else "" for v in values]
+    valid  = np.fromiter((v.isdigit() for v in values), dtype = bool, count = len(values))
+    taxIds = np.fromiter((int(v) if v.isdigit() else 0 for v in values), dtype = np.int64, count = len(values))
+    return taxIds, valid
+
+def _columns(text, sep, needed):
+    '''
+    _columns: splits the lines of a block of text (joined by '\\n') in columns. Returns a dictionary with the
+    values of each column of 'needed' (None for missing values).
+    '''
+    data = np.frombuffer(text, dtype = np.uint8)
+    seps = np.flatnonzero(data == ord(sep))
+    ends = np.append(np.flatnonzero(data == ord("\n")), len(text))
+    counts = np.diff(np.concatenate([[0], np.searchsorted(seps, ends)]))
+    seps = ends = data = None
+    if (counts == counts[0]).all(): # The same number of columns in all lines
+        n = counts[0] + 1
+        tokens = text.replace("\n", sep).split(sep)
+        return dict((c, tokens[c::n] if c < n else [None]*len(counts)) for c in needed)
+    rows = [l.split(sep) for l in text.split("\n")]
+    return dict((c, [r[c] if c < len(r) else None for r in rows]) for c in needed)
+
+def _lines(srcFile, spec, chunkSize):
+    '''
+    _lines: returns a generator with the lines of a classifier output, in blocks of about chunkSize bytes
+    joined by '\\n', without the header, comments, empty lines and skipped lines. Lines are only split when
+    some of them are removed from the middle of a block.
+    '''
+    fileIn = openInput(srcFile, "rt")
+    header = spec.get('skipHeader', True)
+    prefix = spec.get('commentPrefix')
+    skipLines = spec.get('skipLines', False)
+    parity = 0
+    rest   = ""
+    while True:
+        data = fileIn.read(chunkSize)
+        eof  = data == ""
+        if eof:
+            if rest == "":
+                break
+            text, rest = rest, ""
+        else:
+            end = data.rfind("\n")
+            if end == -1:
+                rest += data
+                continue
+            text, rest = rest + data[:end], data[end + 1:]
+        data = None
+        if "\r" in text:
+            text = text.replace("\r", "")
+        if header:
+            end    = text.find("\n")
+            header = False
+            if end == -1: # Only the header
+                continue
+            text = text[end + 1:]
+        comments = prefix is not None and (text.startswith(prefix) or "\n" + prefix in text)
+        if skipLines or comments or "\n\n" in text or text.startswith("\n") or text.endswith("\n"):
+            lines = text.split("\n")
+            if skipLines:
+                n = len(lines)
+                lines  = lines[parity::2]
+                parity = (parity + n)%2
+            if comments:
+                lines = [l for l in lines if not l.startswith(prefix)]
+            text = "\n".join([l for l in lines if l != ""])
+        if text != "":
+            yield text
+        if eof:
+            break
+    fileIn.close()
+
+def _lca(taxIds, lineageDict):
+    '''
+    _lca: returns the lowest common ancestor of several taxon IDs, at the ranks of config.allowedRank (0 if
+    they have no common ancestor).
+    '''
+    lineages = [lineageDict[t] for t in taxIds]
+    lca = 0
+    for rank in config.allowedRank:
+        values = set(l.get(rank) for l in lineages)
+        if len(values) > 1:
+            break
+        value = values.pop()
+        if value is not None:
+            lca = int(value)
+    return lca
+
+def _multiHit(names, taxIds, mode):
+    '''
+    _multiHit: keeps one entry for each group of consecutive entries of the same read (see 'multiHit').
+    '''
+    nameArray = np.array(names, dtype = object)
+    starts = np.flatnonzero(np.concatenate([[True], nameArray[1:] != nameArray[:-1]]))
+    if len(starts) == len(names):
+        return names, taxIds
+    if mode == "first":
+        return nameArray[starts].tolist(), taxIds[starts]
+    ends   = np.append(starts[1:], len(names))
+    result = taxIds[starts].copy()
+    lineageDict = None
+    for i in np.flatnonzero(ends - starts > 1):
+        group = set(taxIds[starts[i]:ends[i]].tolist())
+        if len(group) > 1:
+            if lineageDict is None:
+                lineageDict = resolveLineages(set(taxIds.tolist()))
+            result[i] = _lca(group, lineageDict)
+    return nameArray[starts].tolist(), result
+
+def parseChunks(srcFile, spec, chunkSize = 1 << 24, shard = None):
+    '''
+    parseChunks: parses a classifier output in chunks.
+
+    Parameters:
+    - srcFile: classifier output (can be compressed, see compressedFiles.py)
+    - spec: dictionary with the format of the output (see above)
+    - chunkSize: approximate size in bytes of each chunk
+    - shard: (i, N) tuple to parse only the entries of the reads of shard i of N, or None
+
+    Returns: a generator of (normalized read names, taxon IDs) tuples for each chunk, where read names is a
+    list and taxon IDs an int32 numpy array.
+    '''
+    if not os.path.isfile(srcFile):
+        print "Source file %s not found"%srcFile
+        return
+    sep        = spec.get('sep', "\t")
+    nameCol    = spec['readNameColumn']
+    taxIdCol   = spec['taxIdColumn']
+    secondCol  = spec.get('secondOption', -1)
+    statusCol  = spec.get('statusColumn')
+    unclassified = spec.get('unclassified', [])
+    multiHit   = spec.get('multiHit', "last")
+    needed     = set([nameCol, taxIdCol] + [c for c in [secondCol, statusCol] if c is not None and c != -1])
+    unclassified = set(unclassified)
+    carry      = None # Entries of the last read of the previous chunk, with multiHit
+    for text in itertools.chain(_lines(srcFile, spec, chunkSize), [None]):
+        end = text is None
+        if not end:
+            columns = _columns(text, sep, needed)
+            taxIds, valid = _taxIdColumn(columns[taxIdCol], spec.get('taxIdLabel'))
+            if secondCol != -1 and not valid.all():
+                second, secondValid = _taxIdColumn(columns[secondCol], spec.get('taxIdLabel'))
+                taxIds = np.where(valid, taxIds, second)
+                valid |= secondValid
+            if statusCol is not None and len(unclassified) > 0:
+                notClassified = np.fromiter((v in unclassified for v in columns[statusCol]), dtype = bool, count = len(taxIds))
+                taxIds[notClassified] = 0
+                valid |= notClassified
+            names = columns[nameCol]
+            text = columns = None # Only the names and taxon IDs are kept
+            if not valid.all():
+                names  = list(itertools.compress(names, valid))
+                taxIds = taxIds[valid]
+            names  = normalizeReadNames(names)
+            taxIds = taxIds.astype(np.int32)
+            if shard is not None:
+                inShard = np.array(readBuckets(names, shard[1])) == shard[0]
+                names   = list(itertools.compress(names, inShard))
+                taxIds  = taxIds[inShard]
+        if multiHit == "last":
+            if not end:
+                yield names, taxIds
+            continue
+        if carry is not None:
+            if end:
+                names, taxIds = carry
+            else:
+                names  = carry[0] + names
+                taxIds = np.concatenate([carry[1], taxIds])
+        elif end:
+            break
+        if not end and len(names) > 0: # The last read can continue in the next chunk
+            last = len(names) - 1
+            while last > 0 and names[last - 1] == names[-1]:
+                last -= 1
+            carry = (names[last:], taxIds[last:])
+            names, taxIds = names[:last], taxIds[:last]
+        if len(names) > 0:
+            yield _multiHit(names, taxIds, multiHit)
+
+def readTable(srcFile, shard = None, **spec):
+    '''
+    readTable: parses a classifier output (see parseChunks()), or the entries of the reads of a shard.
+
+    Returns: (list of normalized read names, int32 numpy array with their taxon IDs), in file order.
+    '''
+    names  = []
+    taxIds = []
+    for chunkNames, chunkTaxIds in parseChunks(srcFile, spec, shard = shard):
+        names.extend(chunkNames)
+        taxIds.append(chunkTaxIds)
+    return names, np.concatenate(taxIds) if len(taxIds) > 0 else np.zeros(0, dtype = np.int32)
+
+def iterTaxIds(srcFile, log = False, shard = None, **spec):
+    '''
+    iterTaxIds: parses a classifier output and yields the read name and taxon ID of each entry, in file order.
+
+    Returns: a generator of (read name, taxon ID) tuples (taxon ID is an int, 0 means NA).
+    '''
+    if log: print "Reading entries from file : ", srcFile
+    for names, taxIds in parseChunks(srcFile, spec, shard = shard):
+        for entry in itertools.izip(names, taxIds.tolist()):
+            yield entry
+
+def readTaxIds(srcFile, log = False, **spec):
+    '''
+    readTaxIds: parses a classifier output and returns a dictionary with the taxon ID of each read (if a
+    read appears several times, the last entry is used).
+    '''
+    outDict = dict(iterTaxIds(srcFile, log, **spec))
+    if log: print "Total number of entries   : ", len(outDict)
+    return outDict
+
+def getTaxonomy(srcFile, log = False, **spec):
+    '''
+    getTaxonomy: parses a classifier output and returns a dictionary read name -> OrderedDict with the full
+    lineage (see resolveLineages()).
+    '''
+    taxIdDict = readTaxIds(srcFile, log, **spec)
+    lineageDict = resolveLineages(set(taxIdDict.itervalues()), allowedRank = config.allowedRank)
+    if log: print "Number of lineages loaded: ", len(lineageDict)
+    return lineageTable(taxIdDict, lineageDict)
+
+def bindSpec(module):
+    '''
+    bindSpec: adds to a plugin module (or the module with that name, e.g. __name__ at the end of the plugin)
+    the functions of this engine bound to its spec (module.params), except the ones the module defines itself.
+
+    Returns: the module.
+    '''
+    if isinstance(module, str):
+        module = sys.modules[module]
+    spec = module.params
+    functions = dict(getTaxonomy = lambda srcFile: getTaxonomy(srcFile, **spec),
+                     readTaxIds  = lambda srcFile: readTaxIds(srcFile, **spec),
+                     iterTaxIds  = lambda srcFile, shard = None: iterTaxIds(srcFile, shard = shard, **spec),
+                     readTable   = lambda srcFile, shard = None: readTable(srcFile, shard = shard, **spec))
+    for name, function in functions.iteritems():
+        if not hasattr(module, name):
+            setattr(module, name, function)
+    return module
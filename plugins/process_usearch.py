@@ -1,47 +1,39 @@
-import sys, os, subprocess, csv
-from bisect import bisect_left
-import sqlite3
-from PyEntrezId import Conversion
+import sys, os, itertools, argparse, multiprocessing
+from collections import namedtuple
+sys.path.append(os.path.join(os.path.split(os.path.abspath(__file__))[0], ".."))
+from compressedFiles import openInput, compression
+from accessionIndex import AccessionIndex, NOT_FOUND
 
-minE          = 1e-4
-minIdentity   = 80
-minSizeFactor = 0.5
-readSize      = 100
+# Default values of the best hit criteria (see the command line options)
+defaultCriteria = dict(maxE = 1e-4, minIdentity = 80, minSizeFactor = 0.5, readSize = 100)
 
-class Hit(object):
-    def __init__(self, rname, ident, tam, e, taxid):
-        self.rname = rname
-        self.ident = ident
-        self.tam   = tam
-        self.e     = e
-        self.taxid = taxid
-        
-def matchCriteria(hit):
-    if hit.taxid != -1 and hit.ident >= minIdentity and hit.e <= minE:
+Hit = namedtuple("Hit", ["rname", "ident", "tam", "e", "taxid"])
+
+def matchCriteria(hit, criteria = defaultCriteria):
+    if hit.taxid != NOT_FOUND and hit.ident >= criteria['minIdentity'] and hit.e <= criteria['maxE'] and \
+       hit.tam >= criteria['minSizeFactor']*criteria['readSize']:
         return True
     return False
 
-def getTaxId(an):
-    sql = 'SELECT taxid FROM gi_taxid WHERE gi=%s'%an
-    c.execute(sql)
-    all_rows = c.fetchall()
-    if len(all_rows) == 0:
-        return -1
-    return all_rows[0][0]
+def getTaxId(an, index):
+    return index.get(an)
+
+def formatHit(hit):
+    return "%s\t%s\t%f\t%f\n"%(hit.rname, hit.taxid, hit.ident, hit.e)
 
 def writeFile(fout, hit):
-    fout.write("%s\t%s\t%f\t%f\n"%(hit.rname, hit.taxid, hit.ident, hit.e))
+    fout.write(formatHit(hit))
 
-def processUsearch(srcFname, outFname):
-    ans  = []
-    fin  = open(srcFname, "rt")
-    fout = open(outFname, "wt")
-    bestHit = Hit("", 0, 0, 0.0, "")
-    conv = Conversion("diaztula@iq.usp.br")
-    if not os.path.isfile("acc_2_taxid.tsv"):
-        # First collect all accesion numbers
-        accNumbers = []
-        for l in fin:
+def readHits(fin, index, chunkSize = 1000000):
+    """Returns a generator with the hits of a blast6out file, in file order. The accession numbers of
+    each chunk of chunkSize lines are translated to taxon IDs at once with the accession index.
+    """
+    while True:
+        chunk = list(itertools.islice(fin, chunkSize))
+        if len(chunk) == 0:
+            break
+        rows = []
+        for l in chunk:
             tupla = l.split("\t")
             if len(tupla) == 12:
                 rname = tupla[0].split("/")[0].replace("@", "")
@@ -49,60 +41,122 @@ def processUsearch(srcFname, outFname):
                 e     = float(tupla[10])
                 tam   = int(tupla[3])
                 an    = tupla[1].split("|")[3].split(".")[0].strip()
-                accNumbers.append(an)
-        accNumbers = list(set(accNumbers))
-        print len(accNumbers)
-        d = dict()
-        for acc in accNumbers:
-            taxid = conv.convert_accession_to_taxid(acc)
-            if taxid > 0:
-                d[acc] = taxid
-        tmpFile = open("acc_2_taxid.tsv", "wt")
-        for k in d.keys():
-            tmpFile.write("%s\t%s\n"%(k, d[k]))
-        return
+                rows.append((rname, ident, tam, e, an))
+        taxIds = index.lookup([r[4] for r in rows]).tolist()
+        for (rname, ident, tam, e, an), taxid in zip(rows, taxIds):
+            if taxid == NOT_FOUND:
+                print "No taxid for accession number |%s|"%an, " read = ", rname
+            yield Hit(rname, ident, tam, e, taxid)
+
+def selectBestHits(hits, criteria = defaultCriteria):
+    """Returns a generator with the best hit of each read (hits of a read must be consecutive). Among the
+    hits that satisfy matchCriteria(), we choose the one with the highest identity and, if several ones
+    have the same identity, the one with the lowest E-value.
+    """
+    bestHit = None
+    current = None
+    for hit in hits:
+        if hit.rname != current:
+            if bestHit is not None:
+                yield bestHit
+            current = hit.rname
+            bestHit = None
+        if matchCriteria(hit, criteria) and (bestHit is None or hit.ident > bestHit.ident or (hit.ident == bestHit.ident and hit.e < bestHit.e)):
+            bestHit = hit
+    if bestHit is not None:
+        yield bestHit
+
+def _readName(line):
+    return line.split("\t", 1)[0].split("/")[0].replace("@", "")
+
+def splitFile(srcFname, nChunks):
+    """Splits a (not compressed) blast6out file in about nChunks byte ranges, so that all the hits of a
+    read are in the same range.
+    Returns:
+        a list of (start, end) offsets.
+    """
+    size = os.path.getsize(srcFname)
+    f = open(srcFname, "rb")
+    bounds = [0]
+    for i in range(1, nChunks):
+        pos = max(bounds[-1], size*i//nChunks)
+        if pos >= size:
+            break
+        f.seek(pos)
+        if pos > 0:
+            f.readline() # Skip the rest of the line
+        first = f.readline()
+        pos = f.tell()
+        # Move the limit to the first line of the next read
+        while first != "":
+            l = f.readline()
+            if l == "" or _readName(l) != _readName(first):
+                pos = f.tell() - len(l)
+                break
+        if pos > bounds[-1] and pos < size:
+            bounds.append(pos)
+    f.close()
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+def _lines(srcFname, start, end):
+    f = open(srcFname, "rb")
+    f.seek(start)
+    pos = start
+    while pos < end:
+        l = f.readline()
+        if l == "":
+            break
+        pos += len(l)
+        yield l
+    f.close()
+
+_index = {}
+
+def _bestHitsInRange(task):
+    """Selects the best hits of the reads in a byte range of the file (in a worker process).
+    Returns:
+        the lines of the output, as a single string.
+    """
+    srcFname, start, end, indexFile, criteria = task
+    if indexFile not in _index:
+        _index[indexFile] = AccessionIndex(indexFile)
+    return "".join(formatHit(hit) for hit in selectBestHits(readHits(_lines(srcFname, start, end), _index[indexFile]), criteria))
+
+def processUsearch(srcFname, outFname, indexFile, criteria = defaultCriteria, workers = 1):
+    """Writes the best hit (read name, taxon ID, identity and E-value) of each read of a blast6out file.
+    Parameters:
+    - srcFname: blast6out file (can be compressed)
+    - outFname: output file
+    - indexFile: accession index built with accessionIndex.py
+    - criteria: dictionary with maxE, minIdentity, minSizeFactor and readSize (see defaultCriteria)
+    - workers: number of processes. The file is split in byte ranges that are processed in parallel and
+      the results are written in the order of the file. Compressed files are processed by a single process.
+    """
+    fout = open(outFname, "wt")
+    if workers > 1 and compression(srcFname) is None:
+        tasks = [(srcFname, start, end, indexFile, criteria) for start, end in splitFile(srcFname, 4*workers)]
+        pool  = multiprocessing.Pool(workers)
+        for text in pool.imap(_bestHitsInRange, tasks):
+            fout.write(text)
+        pool.close()
+        pool.join()
     else:
-        print "carregando dicionario"
-        d = dict()
-        for l in csv.reader(open("acc_2_taxid.tsv", "rt"), delimiter="\t"):
-            d[l[0]] = l[1]
-        for l in fin:
-            tupla = l.split("\t")                                                                                                                                                                           
-            if len(tupla) == 12:
-                rname = tupla[0].split("/")[0].replace("@", "")
-                ident = float(tupla[2])
-                e     = float(tupla[10])
-                tam   = int(tupla[3])
-                an    = tupla[1].split("|")[3].split(".")[0].strip()
-                try:
-                    taxid = d[an]
-                except:
-                    taxid = conv.convert_accession_to_taxid(an)
-                    d[an] = taxid
+        index = AccessionIndex(indexFile)
+        for hit in selectBestHits(readHits(openInput(srcFname, "rt"), index), criteria):
+            writeFile(fout, hit)
+    fout.close()
 
-                hit = Hit(rname, ident, tam, e, taxid)
-                if taxid == -1:
-                    print an
-                if taxid == -1:
-                    print "No taxid for accession number |%s|"%an, " read = ", hit.rname
-                if bestHit.rname == "" and matchCriteria(hit):
-                    bestHit = hit
-                elif bestHit.rname != hit.rname:
-                    if bestHit.rname != "":
-                        writeFile(fout, bestHit)
-                    if matchCriteria(hit):
-                        bestHit = hit
-                    else:
-                        bestHit = Hit("", 0, 0, 0.0, "")
-                else:
-                    if hit.ident > bestHit.ident or (hit.ident == bestHit.ident and hit.e < bestHit.e):
-                        bestHit = hit
-        tmpFile = open("acc_2_taxid.tsv", "wt")
-        for k in d.keys():
-            tmpFile.write("%s\t%s\n"%(k, d[k]))
-    
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print "Usage: python %s srcFileName outFileName"%sys.argv[0]
-        sys.exit(1)
-    processUsearch(sys.argv[1], sys.argv[2])
+    argp = argparse.ArgumentParser(description = "Selects the best hit of each read of a USEARCH/Blastn output (blast6out format)")
+    argp.add_argument('src', help = 'USEARCH/Blastn output (blast6out format, can be compressed)')
+    argp.add_argument('out', help = 'Output file, to be used as input of MetaTax')
+    argp.add_argument('index', help = 'Accession index built with accessionIndex.py from the NCBI accession2taxid files')
+    argp.add_argument('-max-e', help = 'Maximum E-value to consider a hit (default: %(default)g)', type = float, default = defaultCriteria['maxE'])
+    argp.add_argument('-min-identity', help = 'Minimum percent of identity to consider a hit (default: %(default)g)', type = float, default = defaultCriteria['minIdentity'])
+    argp.add_argument('-min-size-factor', help = 'Minimum alignment length relative to the mean read size (default: %(default)g)', type = float, default = defaultCriteria['minSizeFactor'])
+    argp.add_argument('-read-size', help = 'Mean length of the reads (default: %(default)i)', type = int, default = defaultCriteria['readSize'])
+    argp.add_argument('-workers', help = 'Number of worker processes (default: 1)', type = int, default = 1)
+    args = argp.parse_args()
+    criteria = dict(maxE = args.max_e, minIdentity = args.min_identity, minSizeFactor = args.min_size_factor, readSize = args.read_size)
+    processUsearch(args.src, args.out, args.index, criteria, args.workers)
@@ -0,0 +1,64 @@
+"""Fast scanner of read names in FASTA and FASTQ files (optionally compressed, see compressedFiles.py). Only header lines
+are parsed, so it is much faster than building a SeqRecord (sequence and qualities) for each read,
+as Bio.SeqIO does. Names are the same as the 'name' attribute of the records created by Bio.SeqIO
+(the header up to the first white space, without the '>' or '@' marker).
+"""
+
+import sys
+from compressedFiles import openInput
+
+def _name(header):
+    fields = header[1:].split(None, 1)
+    return fields[0] if len(fields) > 0 else ""
+
+def _fastaNames(lines):
+    for l in lines:
+        if l.startswith(">"):
+            yield _name(l)
+
+def _fastqNames(lines):
+    # Sequence and quality can span several lines, and quality lines can start with '@', so the
+    # length of the sequence is used to skip the quality lines
+    lines = iter(lines)
+    for l in lines:
+        if not l.startswith("@"):
+            if l.strip() == "":
+                continue
+            raise ValueError("FASTQ record does not start with '@': %s"%l.rstrip())
+        yield _name(l)
+        seqLen = 0
+        for l in lines:
+            if l.startswith("+"):
+                break
+            seqLen += len(l.rstrip())
+        qualLen = 0
+        while qualLen < seqLen:
+            qualLen += len(next(lines).rstrip())
+
+def scanReadNames(readsFile):
+    """Returns a generator with the names of the reads in a FASTA or FASTQ file (detected from the first
+    character of the file), that can be compressed.
+    """
+    f = openInput(readsFile, "rU")
+    first = f.readline()
+    lines = _chain(first, f)
+    if first.startswith(">"):
+        return _fastaNames(lines)
+    elif first.startswith("@"):
+        return _fastqNames(lines)
+    elif first == "":
+        return iter([])
+    raise ValueError("%s is not a FASTA or FASTQ file"%readsFile)
+
+def _chain(first, lines):
+    yield first
+    for l in lines:
+        yield l
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print "Usage: python %s readsFile"%sys.argv[0]
+        print "Prints the names of the reads in a FASTA or FASTQ file (can be compressed)"
+        sys.exit(1)
+    for name in scanReadNames(sys.argv[1]):
+        print name
@@ -0,0 +1,278 @@
+"""Output formats of MetaTax. The results of each chunk of reads are a list of records
+    (read name, status, total classifications, votes, weight, lineage, label)
+where status is one of CLASSIFIED, LOW_WEIGHT, DISAGREEMENT or NA, lineage is the formatted lineage
+("rank|name|taxid" separated by tabs) of classified reads and label is "rank|name|taxid" of the
+classification (only used by the short TSV format). Records are formatted by the processes that
+classify the reads (format()) and written in order by the main process (write()).
+
+TsvWriter writes the usual TSV files (optionally gzip compressed). ColumnarWriter writes a directory
+with one binary file per column (see loadColumnar()), where each lineage is stored once and reads
+refer to it by its index. ProfileWriter writes no per-read file, only the number of reads (and the
+mean votes and weight) of each taxon at each rank. MultiWriter writes the results with several writers.
+"""
+
+import json, numpy as np
+import config
+from array import array
+from os.path import join, isdir
+from os import makedirs
+from compressedFiles import openOutput
+
+CLASSIFIED, LOW_WEIGHT, DISAGREEMENT, NA = range(4)
+STATUS = ["classified", "low_weight", "disagreement", "NA"]
+
+# ----------------------------------------------
+class TsvWriter(object):
+    """Writes the _classified, _low_weight, _disagreement, _NAs and (optionally) _lineage TSV files.
+    Args:
+        outDir, prefix: output files are outDir/prefix_classified.tsv, etc.
+        toolsN: number of classifiers.
+        lineage: True to write the _lineage file.
+        writeFullLineage: True to write the full lineage in the _classified file (otherwise only the label).
+        compress: True to write gzip compressed files (with .gz extension).
+        bufferSize: size of the buffer of each file.
+    """
+    def __init__(self, outDir, prefix, toolsN, lineage = False, writeFullLineage = True, compress = False, bufferSize = 1 << 20):
+        self.toolsN  = toolsN
+        self.lineage = lineage
+        self.writeFullLineage = writeFullLineage
+        names = ["classified", "low_weight", "disagreement", "NAs"] + (["lineage"] if lineage else [])
+        if compress:
+            self.files = [openOutput(join(outDir, "%s_%s.tsv.gz"%(prefix, n))) for n in names]
+        else:
+            self.files = [open(join(outDir, "%s_%s.tsv"%(prefix, n)), "wt", bufferSize) for n in names]
+        if writeFullLineage:
+            self.files[0].write("Read\tToolsN\tTotalClassif\tVotes\tPercentVotes\tWeight\tFullLineage\n")
+        else:
+            self.files[0].write("Read\tToolsN\tTotalClassif\tVotes\tPercentVotes\tWeight\tLineage\n")
+
+    def format(self, records):
+        """Formats a list of records. Returns a list with the text of each file.
+        """
+        toolsN = self.toolsN
+        out = [[] for f in self.files]
+        classifiedF, lowWeightF, disagreeF, naF = out[:4]
+        lineageF = out[4] if self.lineage else None
+        for rname, status, totalClassif, votes, weight, lineage, label in records:
+            if status == CLASSIFIED:
+                if lineageF is not None:
+                    lineageF.append("%s\t%s\n"%(rname, lineage))
+                if self.writeFullLineage:
+                    classifiedF.append("%s\t%i\t%i\t%i\t%0.2f\t%0.2f\t%s\n"%(rname, toolsN, totalClassif, votes, votes*100.0/toolsN, weight, lineage))
+                else:
+                    classifiedF.append("%s\t%i\t%i\t%i\t%0.2f\t%0.2f\t%s\n"%(rname, totalClassif, votes, int(votes*100/toolsN), label))
+            elif status == LOW_WEIGHT:
+                lowWeightF.append("%s\t%0.2f\n"%(rname, weight))
+            elif status == DISAGREEMENT:
+                disagreeF.append("%s\n"%rname)
+            else:
+                naF.append("%s\n"%rname)
+        return ["".join(o) for o in out]
+
+    def write(self, formatted):
+        """Writes the text returned by format().
+        """
+        for f, text in zip(self.files, formatted):
+            f.write(text)
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+# ----------------------------------------------
+COLUMNS = [("status", "u1"), ("total_classif", "u1"), ("votes", "u1"), ("weight", "<f4"), ("lineage", "<i4")]
+
+class ColumnarWriter(object):
+    """Writes the results as binary columns in the directory outDir/prefix_results:
+        reads.txt: read names, one per line.
+        status.u1, total_classif.u1, votes.u1, weight.f4, lineage.i4: one value per read. lineage is the
+            index of the lineage of the read in lineages.tsv (-1 if the read was not classified).
+        lineages.tsv: index and formatted lineage ("rank|name|taxid" separated by tabs) of each lineage.
+        meta.json: number of reads and classifiers, names of the status codes and data type of each column.
+    Args:
+        outDir, prefix: output directory is outDir/prefix_results.
+        toolsN: number of classifiers.
+        bufferSize: size of the buffer of each file.
+    """
+    def __init__(self, outDir, prefix, toolsN, bufferSize = 1 << 20):
+        self.dirName = join(outDir, prefix + "_results")
+        if not isdir(self.dirName):
+            makedirs(self.dirName)
+        self.toolsN   = toolsN
+        self.reads    = 0
+        self.lineages = {}
+        self.namesF   = open(join(self.dirName, "reads.txt"), "wt", bufferSize)
+        self.files    = [open(join(self.dirName, "%s.%s"%(name, dtype[-2:])), "wb", bufferSize) for name, dtype in COLUMNS]
+
+    def format(self, records):
+        """Converts a list of records to columns. Lineages are indexed locally (the index of the chunk's
+        lineages), and translated to the index of the sample by write().
+        """
+        names    = []
+        columns  = [array('B'), array('B'), array('B'), array('f'), array('i')]
+        status, totalClassif, votes, weight, lineageIdx = columns
+        lineages = {}
+        for rname, s, t, v, w, lineage, label in records:
+            names.append(rname)
+            status.append(s)
+            totalClassif.append(int(t))
+            votes.append(int(v))
+            weight.append(w)
+            if lineage is None:
+                lineageIdx.append(-1)
+            else:
+                lineageIdx.append(lineages.setdefault(lineage, len(lineages)))
+        localLineages = [None]*len(lineages)
+        for lineage, i in lineages.iteritems():
+            localLineages[i] = lineage
+        return names, [c.tostring() for c in columns], localLineages
+
+    def write(self, formatted):
+        names, columns, localLineages = formatted
+        translation = np.array([self.lineages.setdefault(l, len(self.lineages)) for l in localLineages] + [-1], dtype="<i4")
+        columns[-1] = translation[np.frombuffer(columns[-1], dtype=np.int32)].tostring()
+        if len(names) > 0:
+            self.namesF.write("\n".join(names) + "\n")
+        for f, c in zip(self.files, columns):
+            f.write(c)
+        self.reads += len(names)
+
+    def close(self):
+        self.namesF.close()
+        for f in self.files:
+            f.close()
+        lineagesF = open(join(self.dirName, "lineages.tsv"), "wt")
+        for lineage, i in sorted(self.lineages.iteritems(), key = lambda x: x[1]):
+            lineagesF.write("%i\t%s\n"%(i, lineage))
+        lineagesF.close()
+        meta = {'reads': self.reads, 'toolsN': self.toolsN, 'status': STATUS,
+                'columns': dict((name, dtype) for name, dtype in COLUMNS)}
+        json.dump(meta, open(join(self.dirName, "meta.json"), "wt"), indent = 1)
+
+def loadColumnar(dirName):
+    """Loads the results written by ColumnarWriter.
+    Returns:
+        a dictionary with the read names ('reads', a list), one numpy array for each column (mapped from
+        the files), the list of formatted lineages ('lineages') and the number of classifiers ('toolsN').
+    """
+    meta = json.load(open(join(dirName, "meta.json"), "rt"))
+    results = {'toolsN': meta['toolsN']}
+    results['reads'] = open(join(dirName, "reads.txt"), "rt").read().split("\n")[:meta['reads']]
+    for name, dtype in COLUMNS:
+        fileName = join(dirName, "%s.%s"%(name, dtype[-2:]))
+        if meta['reads'] > 0:
+            results[name] = np.memmap(fileName, dtype = dtype, mode = "r", shape = (meta['reads'],))
+        else:
+            results[name] = np.zeros(0, dtype = dtype)
+    results['lineages'] = [l.rstrip("\n").split("\t", 1)[1] for l in open(join(dirName, "lineages.tsv"), "rt")]
+    return results
+
+# ----------------------------------------------
+class ProfileWriter(object):
+    """Writes the abundance profile of the sample, outDir/prefix_profile.tsv: for each rank of
+    config.allowedRank and each taxon of that rank, the number of classified reads in the clade of the
+    taxon ('Reads', also as a percent of all reads), the reads classified exactly at the taxon
+    ('Assigned'), and the mean votes and weight of the reads in the clade. The number of reads of each
+    status other than classified are written as taxa of rank 'unclassified'.
+    Each chunk is reduced to the count, votes and weight of each distinct lineage (in the processes that
+    classify the reads), so the profile is built without writing or reading per-read results.
+    Args:
+        outDir, prefix: output file is outDir/prefix_profile.tsv.
+        toolsN: number of classifiers.
+        saveState: True to also write the counts of each lineage to outDir/prefix_profile_state.json (see
+            loadState()), so that the profiles of several shards of a sample can be merged.
+    """
+    def __init__(self, outDir, prefix, toolsN, saveState = False):
+        self.fileName = join(outDir, prefix + "_profile.tsv")
+        self.stateFileName = join(outDir, prefix + "_profile_state.json") if saveState else None
+        self.toolsN   = toolsN
+        self.status   = [0]*len(STATUS)
+        self.lineages = {} # Formatted lineage -> [reads, votes, weight]
+
+    def format(self, records):
+        """Reduces a list of records to the number of reads of each status and the (reads, votes, weight)
+        of each lineage.
+        """
+        status   = [0]*len(STATUS)
+        lineages = {}
+        for rname, s, totalClassif, votes, weight, lineage, label in records:
+            status[s] += 1
+            if s == CLASSIFIED:
+                counts = lineages.get(lineage)
+                if counts is None:
+                    counts = lineages[lineage] = [0, 0, 0.0]
+                counts[0] += 1
+                counts[1] += votes
+                counts[2] += weight
+        return status, lineages
+
+    def write(self, formatted):
+        status, lineages = formatted
+        for s, n in enumerate(status):
+            self.status[s] += n
+        for lineage, (reads, votes, weight) in lineages.iteritems():
+            counts = self.lineages.get(lineage)
+            if counts is None:
+                self.lineages[lineage] = [reads, votes, weight]
+            else:
+                counts[0] += reads
+                counts[1] += votes
+                counts[2] += weight
+
+    def loadState(self, fileName):
+        """Adds the counts saved by another ProfileWriter (with saveState).
+        """
+        state = json.load(open(fileName, "rt"))
+        self.write((state['status'], dict((l.encode("utf-8"), counts) for l, counts in state['lineages'].iteritems())))
+
+    def profile(self):
+        """Returns the profile: a dictionary (rank, taxon ID) -> [name, reads, assigned reads, votes, weight],
+        where votes and weight are the sums over the reads of the clade.
+        """
+        taxa = {}
+        for lineage, (reads, votes, weight) in self.lineages.iteritems():
+            items = lineage.split("\t")
+            for i, item in enumerate(items):
+                rank, rest = item.split("|", 1)
+                name, taxId = rest.rsplit("|", 1)
+                counts = taxa.get((rank, taxId))
+                if counts is None:
+                    counts = taxa[(rank, taxId)] = [name, 0, 0, 0, 0.0]
+                counts[1] += reads
+                if i == len(items) - 1: # Taxon of the classification
+                    counts[2] += reads
+                counts[3] += votes
+                counts[4] += weight
+        return taxa
+
+    def close(self):
+        total = max(sum(self.status), 1)
+        rankOrder = dict((rank, i) for i, rank in enumerate(config.allowedRank))
+        taxa = sorted(self.profile().iteritems(), key = lambda x: (rankOrder.get(x[0][0], len(rankOrder)), -x[1][1], x[0][1]))
+        f = open(self.fileName, "wt")
+        f.write("Rank\tTaxId\tName\tReads\tPercentReads\tAssigned\tMeanVotes\tMeanWeight\n")
+        for (rank, taxId), (name, reads, assigned, votes, weight) in taxa:
+            f.write("%s\t%s\t%s\t%i\t%0.4f\t%i\t%0.2f\t%0.2f\n"%(rank, taxId, name, reads, reads*100.0/total, assigned,
+                                                              float(votes)/reads, weight/reads))
+        for s in [LOW_WEIGHT, DISAGREEMENT, NA]:
+            f.write("unclassified\t0\t%s\t%i\t%0.4f\t%i\t0.00\t0.00\n"%(STATUS[s], self.status[s], self.status[s]*100.0/total, self.status[s]))
+        f.close()
+        if self.stateFileName is not None:
+            json.dump({'toolsN': self.toolsN, 'status': self.status, 'lineages': self.lineages}, open(self.stateFileName, "wt"))
+
+class MultiWriter(object):
+    """Writes the results with several writers (e.g. a TsvWriter and a ProfileWriter).
+    """
+    def __init__(self, writers):
+        self.writers = writers
+
+    def format(self, records):
+        return [w.format(records) for w in self.writers]
+
+    def write(self, formatted):
+        for w, f in zip(self.writers, formatted):
+            w.write(f)
+
+    def close(self):
+        for w in self.writers:
+            w.close()
@@ -0,0 +1,145 @@
+"""Concurrent classification of several samples. Each sample runs in its own (forked) process, so all
+samples share the taxonomy database opened by the main process and the lineages and names already
+resolved. The lineages and names resolved by a sample are sent back to the main process when the
+sample finishes, so samples started later inherit them too.
+
+A sample is started when there are less than 'maxSamples' samples running and its estimated memory
+footprint (see estimateFootprint()) fits in the memory budget, together with the footprints of the
+samples already running. Samples are started in the order of the input file; a sample larger than
+the budget is run alone. The Scheduler class is also used by metaTaxServer.py to run jobs.
+"""
+
+import sys, os, time, traceback, multiprocessing, Queue
+import config
+from compressedFiles import compression
+from getTaxonomyFromEte3 import resetNCBI, resolveLineages, resolveNames, addLineages
+
+def physicalMemory():
+    """Returns the physical memory of the node, in MB.
+    """
+    return os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")/float(1 << 20)
+
+def estimateFootprint(fileNames):
+    """Returns the estimated peak memory (in MB) of the classification of a sample. It grows with the size
+    of the classifier outputs of the sample (i.e. with the number of reads times the number of tools):
+    config.sampleBaseMemory + config.sampleMemoryFactor * (size of the outputs in MB). The size of
+    compressed outputs is multiplied by config.compressionRatio.
+    Args:
+        fileNames: classifier output files of the sample.
+    """
+    size = 0.0
+    for fileName in fileNames:
+        fileSize = os.path.getsize(fileName)
+        if compression(fileName) is not None:
+            fileSize *= config.compressionRatio
+        size += fileSize
+    return config.sampleBaseMemory + config.sampleMemoryFactor*size/(1 << 20)
+
+def _runSample(name, function, messages):
+    """Body of the process of a sample: runs function(name) and sends the new lineages and names (or the
+    error) to the main process.
+    """
+    try:
+        resetNCBI() # Do not share the SQLite connection of the main process
+        lineages = resolveLineages([])
+        names    = resolveNames([])
+        knownLineages, knownNames = set(lineages.keys()), set(names.keys())
+        function(name)
+        newLineages = dict((t, l.items()) for t, l in lineages.iteritems() if t not in knownLineages)
+        newNames    = dict((t, n) for t, n in names.iteritems() if t not in knownNames)
+        messages.put((name, None, newLineages, newNames))
+    except BaseException:
+        messages.put((name, traceback.format_exc(), None, None))
+
+class Scheduler(object):
+    """Runs functions in new processes (one per sample or job), several at once, within a memory budget.
+    Args:
+        budget: memory budget in MB (default: config.memoryBudget of the physical memory).
+        maxSamples: maximum number of samples running at once (default: number of CPUs).
+        out: if given, stream where the start and end of each sample are written.
+    """
+    def __init__(self, budget = None, maxSamples = None, out = None):
+        if budget is None:
+            budget = config.memoryBudget*physicalMemory()
+        if maxSamples is None:
+            maxSamples = multiprocessing.cpu_count()
+        self.budget     = budget
+        self.maxSamples = maxSamples
+        self.out        = out
+        self.messages   = multiprocessing.Queue()
+        self.pending    = []
+        self.running    = {} # Sample name -> (process, footprint, start time)
+        self.used       = 0.0
+
+    def busy(self):
+        """Returns True if there are samples waiting or running.
+        """
+        return len(self.pending) > 0 or len(self.running) > 0
+
+    def submit(self, name, footprint, function):
+        """Adds a sample, that will run function(name) in a new process. Names must be unique.
+        """
+        self.pending.append((name, footprint, function))
+
+    def step(self, timeout = 1.0):
+        """Starts the samples that fit in the budget and waits up to 'timeout' seconds for samples to finish.
+        Returns:
+            a list of (sample name, error) tuples of the samples that finished, where error is None or the
+            traceback of the error.
+        """
+        # Admit samples while they fit in the budget
+        while len(self.pending) > 0 and len(self.running) < self.maxSamples and \
+              (len(self.running) == 0 or self.used + self.pending[0][1] <= self.budget):
+            name, footprint, function = self.pending.pop(0)
+            process = multiprocessing.Process(target = _runSample, args = (name, function, self.messages))
+            process.start()
+            self.running[name] = (process, footprint, time.time())
+            self.used += footprint
+            if self.out is not None:
+                self.out.write("%s: started (estimated %0.0f MB, %0.0f of %0.0f MB in use)\n"%(name, footprint, self.used, self.budget))
+        if len(self.running) == 0:
+            return []
+        # Wait for a sample to finish
+        try:
+            finished = [self.messages.get(timeout = timeout)]
+        except Queue.Empty:
+            dead = [name for name, (process, _, _) in self.running.iteritems() if not process.is_alive()]
+            finished = []
+            try: # Messages sent just before the processes finished
+                while True:
+                    finished.append(self.messages.get_nowait())
+            except Queue.Empty:
+                pass
+            for name in set(dead) - set(m[0] for m in finished): # Finished without sending a message (e.g. killed)
+                finished.append((name, "%s: process finished with exit code %s\n"%(name, self.running[name][0].exitcode), None, None))
+        result = []
+        for name, error, lineages, names in finished:
+            process, footprint, start = self.running.pop(name)
+            process.join()
+            self.used -= footprint
+            if error is None:
+                addLineages(lineages, names)
+            if self.out is not None:
+                self.out.write("%s: %s in %0.1f s\n"%(name, "failed" if error else "finished", time.time() - start))
+            result.append((name, error))
+        return result
+
+def runSamples(samples, function, budget = None, maxSamples = None, out = None):
+    """Runs function(name) for each sample, several samples at once (see Scheduler).
+    Args:
+        samples: list of (sample name, estimated footprint in MB) tuples.
+        function: function called with the name of each sample, in a new process.
+        budget, maxSamples, out: see Scheduler.
+    Returns:
+        the list of the names of the samples that failed.
+    """
+    scheduler = Scheduler(budget, maxSamples, out)
+    for name, footprint in samples:
+        scheduler.submit(name, footprint, function)
+    failed = []
+    while scheduler.busy():
+        for name, error in scheduler.step():
+            if error is not None:
+                failed.append(name)
+                sys.stderr.write(error)
+    return failed
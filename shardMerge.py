@@ -0,0 +1,162 @@
+"""Merge of the outputs of a run split in shards (-shard i/N option of metaTax.py), e.g. on several
+nodes. Each shard classifies only the reads whose name hashes to it (see util.readBucket()), and writes
+its results in the order of the reads file. The merge reads the reads file of each sample again and,
+for each read, takes the next line of the shard of the read, so the merged files are the same files a
+single run would write. Shards run with -no-reads or -max-memory are concatenated in shard order
+instead, as their results are not in the order of the reads file (the same reads are written, in
+another order).
+
+TSV (also gzip compressed) and columnar results are merged, and the abundance profiles (-profile) are
+added up. Log files and run reports are kept in the directories of the shards.
+
+Usage example (4 shards run as local processes):
+    for i in 0 1 2 3; do python metaTax.py input.txt out_$i -lineage -shard $i/4 & done; wait
+    python shardMerge.py input.txt out out_0 out_1 out_2 out_3
+"""
+
+import sys, os, json, argparse
+from os.path import join, isfile, isdir
+import metaTax, resultWriters
+from compressedFiles import openInput, openOutput
+from util import readBucket
+
+TSV_FILES = ["classified", "low_weight", "disagreement", "NAs", "lineage"]
+
+def loadShards(shardDirs):
+    """Reads the description of the shards written by metaTax.py (shard.json) and checks that there is one
+    directory for each shard.
+    Returns:
+        (list of directories ordered by shard, description of the first shard).
+    """
+    shards = {}
+    for d in shardDirs:
+        if not isfile(join(d, "shard.json")):
+            raise ValueError("%s is not the output directory of a shard (shard.json not found)"%d)
+        shards[d] = json.load(open(join(d, "shard.json"), "rt"))
+    first = shards[shardDirs[0]]
+    n = first['shards']
+    found = sorted(s['shard'] for s in shards.itervalues())
+    if any(s['shards'] != n for s in shards.itervalues()) or found != range(n):
+        raise ValueError("expected the directories of shards 0 to %i of %i, found shards %s"%(n - 1, n, ", ".join(map(str, found))))
+    options = lambda s: (s['noReads'], s.get('maxMemory'), s['outputFormat'])
+    if any(options(s) != options(first) for s in shards.itervalues()):
+        raise ValueError("shards were run with different options (-no-reads, -max-memory or -output-format)")
+    return sorted(shardDirs, key = lambda d: shards[d]['shard']), first
+
+def _readName(line):
+    return line.split("\t", 1)[0].rstrip("\n")
+
+def mergeTsv(readNames, shardDirs, outDir, prefix, compress = False):
+    """Merges the TSV files of a sample.
+    Args:
+        readNames: iterator of the (normalized) read names of the sample, in the order of the reads file, or
+            None to concatenate the shards.
+        shardDirs: output directories of the shards, ordered by shard.
+        outDir, prefix: the merged files are outDir/prefix_classified.tsv, etc.
+        compress: True if the files are gzip compressed (.tsv.gz).
+    """
+    extension = ".tsv.gz" if compress else ".tsv"
+    names = [n for n in TSV_FILES if isfile(join(shardDirs[0], "%s_%s%s"%(prefix, n, extension)))]
+    inputs  = [[openInput(join(d, "%s_%s%s"%(prefix, n, extension)), "rt") for d in shardDirs] for n in names]
+    outputs = [openOutput(join(outDir, "%s_%s%s"%(prefix, n, extension))) if compress else
+               open(join(outDir, "%s_%s%s"%(prefix, n, extension)), "wt", 1 << 20) for n in names]
+    for name, files, out in zip(names, inputs, outputs):
+        if name == "classified": # Header
+            out.write(files[0].readline())
+            for f in files[1:]:
+                f.readline()
+    if readNames is None:
+        for files, out in zip(inputs, outputs):
+            for f in files:
+                for l in f:
+                    out.write(l)
+    else:
+        current = [[f.readline() for f in files] for files in inputs]
+        n = len(shardDirs)
+        for rname in readNames:
+            shard = readBucket(rname, n)
+            for files, lines, out in zip(inputs, current, outputs):
+                l = lines[shard]
+                if l != "" and _readName(l) == rname:
+                    out.write(l)
+                    lines[shard] = files[shard].readline()
+        for name, lines in zip(names, current):
+            for shard, l in enumerate(lines):
+                if l != "":
+                    raise ValueError("%s: read %s of shard %i is not in the reads file, or not in its order"%(name, _readName(l), shard))
+    for files, out in zip(inputs, outputs):
+        for f in files:
+            f.close()
+        out.close()
+
+def mergeColumnar(readNames, shardDirs, outDir, prefix, chunkSize = 10000):
+    """Merges the columnar results of a sample (see mergeTsv() and resultWriters.ColumnarWriter).
+    """
+    shards = [resultWriters.loadColumnar(join(d, prefix + "_results")) for d in shardDirs]
+    writer = resultWriters.ColumnarWriter(outDir, prefix, shards[0]['toolsN'])
+    def record(results, i):
+        lineage = int(results['lineage'][i])
+        return (results['reads'][i], int(results['status'][i]), int(results['total_classif'][i]), int(results['votes'][i]),
+                float(results['weight'][i]), results['lineages'][lineage] if lineage >= 0 else None, None)
+    if readNames is None:
+        records = (record(results, i) for results in shards for i in xrange(len(results['reads'])))
+    else:
+        records = _columnarRecords(readNames, shards, record)
+    for chunk in metaTax.chunks(records, chunkSize):
+        writer.write(writer.format(chunk))
+    writer.close()
+
+def _columnarRecords(readNames, shards, record):
+    positions = [0]*len(shards)
+    for rname in readNames:
+        shard = readBucket(rname, len(shards))
+        i = positions[shard]
+        if i < len(shards[shard]['reads']) and shards[shard]['reads'][i] == rname:
+            positions[shard] += 1
+            yield record(shards[shard], i)
+    for shard, results in enumerate(shards):
+        if positions[shard] < len(results['reads']):
+            raise ValueError("read %s of shard %i is not in the reads file, or not in its order"%(results['reads'][positions[shard]], shard))
+
+def mergeProfile(shardDirs, outDir, prefix):
+    """Adds up the abundance profiles of the shards of a sample (see resultWriters.ProfileWriter).
+    """
+    states = [join(d, prefix + "_profile_state.json") for d in shardDirs]
+    writer = resultWriters.ProfileWriter(outDir, prefix, json.load(open(states[0], "rt"))['toolsN'])
+    for fileName in states:
+        writer.loadState(fileName)
+    writer.close()
+
+def mergeShards(inputFile, outDir, shardDirs):
+    """Merges the outputs of the shards of a run of metaTax.py.
+    Args:
+        inputFile: input file of the run (see metaTax.loadInput()).
+        outDir: directory of the merged outputs.
+        shardDirs: output directories of all the shards, in any order.
+    """
+    shardDirs, options = loadShards(shardDirs)
+    if not isdir(outDir):
+        os.makedirs(outDir)
+    ordered = not options['noReads'] and not options.get('maxMemory')
+    for readName in metaTax.loadInput(inputFile).keys():
+        prefix = readName[readName.rfind('/')+1:]
+        readNames = metaTax.readNames(readName) if ordered else None
+        if options['outputFormat'] == "columnar":
+            if isdir(join(shardDirs[0], prefix + "_results")):
+                mergeColumnar(readNames, shardDirs, outDir, prefix)
+        else:
+            mergeTsv(readNames, shardDirs, outDir, prefix, options['outputFormat'] == "tsv.gz")
+        if isfile(join(shardDirs[0], prefix + "_profile_state.json")):
+            mergeProfile(shardDirs, outDir, prefix)
+
+if __name__ == "__main__":
+    argp = argparse.ArgumentParser(description = "Merges the outputs of a run of metaTax.py split in shards (-shard i/N)")
+    argp.add_argument('i', help = 'Input file of the run, with information about read files and classification results')
+    argp.add_argument('o', help = 'Dir to write the merged results')
+    argp.add_argument('shards', help = 'Output dirs of all the shards', nargs = "+")
+    args = argp.parse_args()
+    try:
+        mergeShards(args.i, args.o, args.shards)
+    except ValueError, e:
+        print "Error: %s"%e
+        sys.exit(1)
@@ -0,0 +1,163 @@
+"""Streaming (merge-join) classification: the reads file and the outputs of all classifiers are
+read in step, one read at a time, so memory does not grow with the number of reads. This requires
+the classifier outputs to be either in the same order as the reads file ('ordered' mode) or sorted
+by read name, as the reads file ('sorted' mode). Use externalSort() (or run this script) to sort
+classifier outputs that are not in order.
+"""
+
+import sys, os, heapq, tempfile
+from os.path import join
+
+myPath = os.path.split( os.path.abspath(__file__) )[0]
+sys.path.append(join(myPath, "plugins"))
+from getTaxonomyFromEte3 import normalizeReadName
+from compressedFiles import openInput
+import pluginRegistry
+
+# ----------------------------------------------
+class ClassifierCursor(object):
+    """Position in the output of one classifier.
+    Args:
+        taxIds: iterator of (read name, taxon ID) tuples, as returned by the iterTaxIds() function of
+            the plugins.
+        sortedInput: True if the entries are sorted by read name.
+    """
+    def __init__(self, taxIds, sortedInput = False):
+        self.rows        = iter(taxIds)
+        self.sortedInput = sortedInput
+        self.current     = next(self.rows, None)
+        self.skipped     = 0
+
+    def __next(self):
+        """Consumes all consecutive entries of the current read and returns its taxon ID. As in
+        getTaxonomy(), if a read appears several times the last entry is used.
+        """
+        name, taxId = self.current
+        self.current = next(self.rows, None)
+        while self.current is not None and self.current[0] == name:
+            taxId = self.current[1]
+            self.current = next(self.rows, None)
+        if self.sortedInput and self.current is not None and self.current[0] < name:
+            raise ValueError("classifier output is not sorted by read name ('%s' after '%s')"%(self.current[0], name))
+        return taxId
+
+    def seek(self, rname):
+        """Returns the taxon ID given to read 'rname', or None if the classifier has no entry for it.
+        """
+        if self.sortedInput:
+            while self.current is not None and self.current[0] < rname:
+                self.__next()
+                self.skipped += 1
+        if self.current is not None and self.current[0] == rname:
+            return self.__next()
+        return None
+
+    def remaining(self):
+        """Consumes and returns the number of entries not matched to any read.
+        """
+        n = 0
+        while self.current is not None:
+            self.__next()
+            n += 1
+        return n + self.skipped
+
+def streamTaxIds(readNames, taxIdIterators, sortedInput = False, classifNames = None):
+    """Merge-join of the reads with the outputs of the classifiers.
+    Args:
+        readNames: iterator of (normalized) read names, in the order of the reads file.
+        taxIdIterators: one iterator of (read name, taxon ID) tuples for each classifier.
+        sortedInput: True if reads and classifier outputs are sorted by read name, False if the
+            classifier outputs follow the order of the reads file.
+        classifNames: names of the classifiers, used in warnings.
+    Returns:
+        a generator of (read name, taxon IDs) tuples, where taxon IDs has one taxon ID (or None if the
+        read was not reported) for each classifier.
+    """
+    cursors = [ClassifierCursor(t, sortedInput) for t in taxIdIterators]
+    if classifNames is None:
+        classifNames = [str(i) for i in range(len(cursors))]
+    previous = None
+    taxIds   = None
+    for rname in readNames:
+        if rname == previous: # Mates of a paired read share the same classifications
+            yield rname, taxIds
+            continue
+        if sortedInput and previous is not None and rname < previous:
+            raise ValueError("reads file is not sorted by read name ('%s' after '%s')"%(rname, previous))
+        taxIds = [c.seek(rname) for c in cursors]
+        previous = rname
+        yield rname, taxIds
+    for i, c in enumerate(cursors):
+        n = c.remaining()
+        if n > 0:
+            print "Warning: %i entries from %s did not match any read (is the output in the same order as the reads?)"%(n, classifNames[i])
+
+# ----------------------------------------------
+def _records(fileIn, skipLines):
+    """Groups the lines of a classifier output in records (2 lines per record if skipLines).
+    """
+    for l in fileIn:
+        if skipLines:
+            l += next(fileIn, "")
+        if not l.endswith("\n"):
+            l += "\n"
+        yield l
+
+def _keyed(chunk, readNameColumn, sep, skipLines, chunkIdx):
+    for i, r in enumerate(_records(chunk, skipLines)):
+        yield normalizeReadName(r.split(sep)[readNameColumn]), chunkIdx, i, r
+
+def _writeChunk(records, tmpDir):
+    records.sort()
+    f = tempfile.TemporaryFile(dir = tmpDir)
+    for r in records:
+        f.write(r[-1])
+    f.seek(0)
+    return f
+
+def externalSort(srcFile, outFile, readNameColumn, skipHeader = True, sep = "\t", skipLines = False, chunkSize = 1000000, tmpDir = None, **kwargs):
+    """Sorts the output of a classifier by (normalized) read name, keeping the original format, so it can
+    be used in 'sorted' streaming mode. At most chunkSize records are kept in memory; sorted chunks are
+    written to temporary files and then merged. Entries of the same read keep their relative order.
+    Args:
+        srcFile: classifier output.
+        outFile: sorted file to be created.
+        readNameColumn, skipHeader, sep, skipLines: as in the spec of the plugin (see parserEngine.py; other
+            keys of the spec are accepted and ignored).
+        chunkSize: number of records sorted in memory.
+        tmpDir: directory for the temporary files (default: system temporary directory).
+    """
+    fileIn  = openInput(srcFile, "rt")
+    fileOut = open(outFile, "wt")
+    if skipHeader:
+        fileOut.write(fileIn.next())
+    chunks  = []
+    records = []
+    for r in _records(fileIn, skipLines):
+        records.append((normalizeReadName(r.split(sep)[readNameColumn]), len(chunks), len(records), r))
+        if len(records) >= chunkSize:
+            chunks.append(_writeChunk(records, tmpDir))
+            records = []
+    if len(chunks) == 0:
+        records.sort()
+        for r in records:
+            fileOut.write(r[-1])
+    else:
+        if len(records) > 0:
+            chunks.append(_writeChunk(records, tmpDir))
+        records = None
+        # Chunks are already sorted, so records of each chunk are read one at a time
+        for r in heapq.merge(*[_keyed(c, readNameColumn, sep, skipLines, i) for i, c in enumerate(chunks)]):
+            fileOut.write(r[-1])
+    fileOut.close()
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print "Usage: python %s classifierName srcFileName outFileName"%sys.argv[0]
+        print "Sorts a classifier output by read name, to be used with 'metaTax.py -stream sorted'"
+        sys.exit(1)
+    if not pluginRegistry.isTool(sys.argv[1]):
+        print "I do not understand output from %s, exiting"%sys.argv[1]
+        sys.exit(1)
+    module = pluginRegistry.getPlugin(sys.argv[1])
+    externalSort(sys.argv[2], sys.argv[3], **module.params)
@@ -0,0 +1,100 @@
+"""On-disk cache of parsed classifier outputs. For each classifier output, the cache keeps the read
+names and taxon IDs parsed by its plugin, and the lineages of its taxon IDs with the names of their
+taxa, so later runs (e.g. with
+-pedantic or with other tools) neither parse the file nor query the taxonomy again.
+
+There is one cache file per (plugin, classifier output) pair. It stores the key it was built with:
+the path, size and modification time (or the SHA-1 of the contents) of the classifier output, the
+plugin and its parameters, config.allowedRank, the taxonomy database and the cache format version.
+Tables of a shard of the reads (-shard option of metaTax.py) are cached separately, one file per shard.
+If any of them changes, the entry is stale: it is ignored and replaced after parsing the file again.
+"""
+
+import os, hashlib, cPickle, tempfile
+from os.path import join, abspath
+import config, pluginRegistry
+
+VERSION = 1
+
+def fileDigest(fileName, blockSize = 1 << 22):
+    """Returns the SHA-1 of the contents of a file.
+    """
+    h = hashlib.sha1()
+    f = open(fileName, "rb")
+    while True:
+        block = f.read(blockSize)
+        if block == "":
+            break
+        h.update(block)
+    f.close()
+    return h.hexdigest()
+
+class TableCache(object):
+    """Cache of parsed classifier outputs in a directory.
+    Args:
+        cacheDir: directory of the cache files (created if needed).
+        taxonomy: identity of the taxonomy database (see getTaxonomyFromEte3.taxonomyIdentity()).
+        hashContents: True to identify classifier outputs by the SHA-1 of their contents, instead of their
+            size and modification time.
+    """
+    def __init__(self, cacheDir, taxonomy, hashContents = False):
+        self.cacheDir     = cacheDir
+        self.taxonomy     = taxonomy
+        self.hashContents = hashContents
+        if not os.path.isdir(cacheDir):
+            os.makedirs(cacheDir)
+
+    def key(self, moduleName, srcFile, shard = None):
+        """Returns the key of the cache entry of a classifier output (or of a shard (i, N) of its reads).
+        """
+        st  = os.stat(srcFile)
+        key = [VERSION, abspath(srcFile), st.st_size, moduleName, sorted(getattr(pluginRegistry.getPlugin(moduleName), "params", {}).items()),
+               list(config.allowedRank), self.taxonomy]
+        if self.hashContents:
+            key.append(fileDigest(srcFile))
+        else:
+            key.append(st.st_mtime)
+        if shard is not None:
+            key.append(list(shard))
+        return key
+
+    def fileName(self, moduleName, srcFile, shard = None):
+        name = "%s\t%s"%(moduleName, abspath(srcFile))
+        if shard is not None:
+            name += "\t%i/%i"%shard
+        return join(self.cacheDir, hashlib.sha1(name).hexdigest() + ".cache")
+
+    def load(self, moduleName, srcFile, key = None, shard = None):
+        """Returns the cached entry of a classifier output: (read names joined by '\\n', number of entries,
+        taxon IDs as int32 bytes, dictionary taxon ID -> lineage items, dictionary taxon ID -> scientific name),
+        or None if there is no valid entry.
+        The key can be given, if it was already computed with key().
+        """
+        fileName = self.fileName(moduleName, srcFile, shard)
+        if not os.path.isfile(fileName):
+            return None
+        try:
+            f = open(fileName, "rb")
+            if key is None:
+                key = self.key(moduleName, srcFile, shard)
+            if cPickle.load(f) != key:
+                f.close()
+                return None
+            entry = cPickle.load(f)
+            f.close()
+        except Exception: # Truncated or corrupted entry
+            return None
+        return entry
+
+    def save(self, moduleName, srcFile, names, n, taxIds, lineages, taxonNames, key = None, shard = None):
+        """Stores the entry of a classifier output (same fields returned by load()). The entry is written
+        to a temporary file that is then renamed, so concurrent runs never read a partial entry.
+        """
+        fd, tmpName = tempfile.mkstemp(dir = self.cacheDir, suffix = ".tmp")
+        f = os.fdopen(fd, "wb")
+        if key is None:
+            key = self.key(moduleName, srcFile, shard)
+        cPickle.dump(key, f, 2)
+        cPickle.dump((names, n, taxIds, lineages, taxonNames), f, 2)
+        f.close()
+        os.rename(tmpName, self.fileName(moduleName, srcFile, shard))
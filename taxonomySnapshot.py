@@ -0,0 +1,197 @@
+"""Compact taxonomy snapshot built from the NCBI taxdump (nodes.dmp, names.dmp and merged.dmp).
+
+The snapshot is a single binary file with the following sections (all little endian, each one
+aligned to 8 bytes):
+    header:     magic, number of taxon ids (n = max taxid + 1), size of the rank names block,
+                size of the name pool, number of merged taxon ids
+    parent:     int32[n], parent of each taxon id (-1 if the taxon id does not exist)
+    rank:       uint8[n], index of the rank of each taxon id in the rank names block
+    nameOffset: uint32[n+1], the scientific name of taxon id i is namePool[nameOffset[i]:nameOffset[i+1]]
+    rankNames:  rank names separated by '\\n'
+    namePool:   all scientific names, concatenated
+    mergedOld:  int32[m], merged (old) taxon ids, sorted
+    mergedNew:  int32[m], the taxon id each old one was merged into
+
+The file is mmap'ed (read only), so loading it is almost free and forked worker processes share
+the same pages. TaxonomySnapshot implements the subset of ete3's NCBITaxa interface used by MetaTax.
+"""
+
+import sys, os, mmap, struct, tarfile, numpy as np
+
+MAGIC  = "MTAXSNP1"
+HEADER = struct.Struct("<8sQQQQ")
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+def _openDump(taxdump, name):
+    """Returns an iterator over the lines of 'name' (e.g. nodes.dmp) in taxdump, that can be
+    a directory or a taxdump.tar.gz file.
+    """
+    if os.path.isdir(taxdump):
+        return open(os.path.join(taxdump, name), "rt")
+    return tarfile.open(taxdump, "r").extractfile(name)
+
+def _fields(line):
+    return [f.strip() for f in line.rstrip("\n").rstrip("|").split("|")]
+
+def buildSnapshot(taxdump, outFile):
+    """Builds a taxonomy snapshot.
+    Args:
+        taxdump: directory with nodes.dmp, names.dmp and merged.dmp, or the taxdump.tar.gz file
+            downloaded from NCBI.
+        outFile: snapshot file to be created.
+    Returns:
+        the number of taxon ids written.
+    """
+    parents = {}
+    ranks   = {}
+    for l in _openDump(taxdump, "nodes.dmp"):
+        f = _fields(l)
+        parents[int(f[0])] = int(f[1])
+        ranks[int(f[0])]   = f[2]
+    names = {}
+    for l in _openDump(taxdump, "names.dmp"):
+        f = _fields(l)
+        if f[3] == "scientific name":
+            names[int(f[0])] = f[1]
+    merged = []
+    for l in _openDump(taxdump, "merged.dmp"):
+        f = _fields(l)
+        merged.append((int(f[0]), int(f[1])))
+    merged.sort()
+
+    n = max(parents.keys()) + 1
+    parent = np.full(n, -1, dtype="<i4")
+    rank   = np.zeros(n, dtype="u1")
+    rankNames = [""] + sorted(set(ranks.values()))
+    rankCode  = dict((r, i) for i, r in enumerate(rankNames))
+    nameOffset = np.zeros(n + 1, dtype="<u4")
+    pool = []
+    size = 0
+    for tid in range(n):
+        nameOffset[tid] = size
+        if tid in parents:
+            parent[tid] = parents[tid]
+            rank[tid]   = rankCode[ranks[tid]]
+            name = names.get(tid, "")
+            pool.append(name)
+            size += len(name)
+    nameOffset[n] = size
+    rankBlock = "\n".join(rankNames)
+    mergedOld = np.array([m[0] for m in merged], dtype="<i4")
+    mergedNew = np.array([m[1] for m in merged], dtype="<i4")
+
+    out = open(outFile, "wb")
+    out.write(HEADER.pack(MAGIC, n, len(rankBlock), size, len(merged)))
+    for block in [parent.tostring(), rank.tostring(), nameOffset.tostring(), rankBlock, "".join(pool),
+                  mergedOld.tostring(), mergedNew.tostring()]:
+        out.write(block)
+        out.write("\0"*(_align(len(block)) - len(block)))
+    out.close()
+    return len(parents)
+
+class TaxonomySnapshot(object):
+    """Read only view of a snapshot created by buildSnapshot(). Lineages, ranks and names are
+    obtained by indexing arrays mapped from the file.
+    """
+    def __init__(self, snapshotFile):
+        self.fileName = snapshotFile
+        f = open(snapshotFile, "rb")
+        self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        f.close()
+        magic, n, rankSize, poolSize, nMerged = HEADER.unpack_from(self.buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a taxonomy snapshot"%snapshotFile)
+        offset = _align(HEADER.size)
+        self.parent = np.frombuffer(self.buf, dtype="<i4", count=n, offset=offset)
+        offset += _align(4*n)
+        self.rank = np.frombuffer(self.buf, dtype="u1", count=n, offset=offset)
+        offset += _align(n)
+        self.nameOffset = np.frombuffer(self.buf, dtype="<u4", count=n+1, offset=offset)
+        offset += _align(4*(n+1))
+        self.rankNames = self.buf[offset:offset+rankSize].split("\n")
+        offset += _align(rankSize)
+        self.poolOffset = offset
+        offset += _align(poolSize)
+        self.mergedOld = np.frombuffer(self.buf, dtype="<i4", count=nMerged, offset=offset)
+        offset += _align(4*nMerged)
+        self.mergedNew = np.frombuffer(self.buf, dtype="<i4", count=nMerged, offset=offset)
+        self.size = n
+
+    def exists(self, taxid):
+        """Returns True if the taxon id is a (non merged) node of the taxonomy.
+        """
+        return 0 < taxid < self.size and self.parent[taxid] != -1
+
+    def getName(self, taxid):
+        """Returns the scientific name of a (non merged) taxon id.
+        """
+        start = self.poolOffset + int(self.nameOffset[taxid])
+        return self.buf[start:self.poolOffset + int(self.nameOffset[taxid+1])]
+
+    def getLineage(self, taxid):
+        """Returns the list of taxon ids from the root to 'taxid' (a non merged taxon id).
+        """
+        track = [taxid]
+        parent = self.parent
+        while taxid != 1:
+            p = int(parent[taxid])
+            if p == taxid or p == -1:
+                break
+            track.append(p)
+            taxid = p
+        track.reverse()
+        return track
+
+    # ------------------------------------------------------------------
+    # Subset of ete3's NCBITaxa interface
+    # ------------------------------------------------------------------
+    def _translate_merged(self, all_taxids):
+        conv_all_taxids = set(map(int, all_taxids))
+        conversion = {}
+        if len(self.mergedOld) > 0:
+            for old in list(conv_all_taxids):
+                i = int(np.searchsorted(self.mergedOld, old))
+                if i < len(self.mergedOld) and self.mergedOld[i] == old:
+                    conv_all_taxids.discard(old)
+                    conv_all_taxids.add(int(self.mergedNew[i]))
+                    conversion[old] = int(self.mergedNew[i])
+        return conv_all_taxids, conversion
+
+    def get_rank(self, taxids):
+        return dict((int(t), self.rankNames[self.rank[int(t)]]) for t in taxids if self.exists(int(t)))
+
+    def get_lineage_translator(self, taxids):
+        return dict((int(t), self.getLineage(int(t))) for t in taxids if self.exists(int(t)))
+
+    def get_lineage(self, taxid):
+        taxid = int(taxid)
+        if not self.exists(taxid):
+            _, merged = self._translate_merged([taxid])
+            if taxid not in merged:
+                raise ValueError("%s taxid not found"%taxid)
+            taxid = merged[taxid]
+        return self.getLineage(taxid)
+
+    def get_taxid_translator(self, taxids, try_synonyms=True):
+        id2name = {}
+        notFound = []
+        for t in set(map(int, taxids)):
+            if self.exists(t):
+                id2name[t] = self.getName(t)
+            else:
+                notFound.append(t)
+        if len(notFound) > 0 and try_synonyms:
+            _, merged = self._translate_merged(notFound)
+            for old, new in merged.items():
+                if self.exists(new):
+                    id2name[old] = self.getName(new)
+        return id2name
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print "Usage: python %s taxdump_dir_or_taxdump.tar.gz snapshotFile"%sys.argv[0]
+        sys.exit(1)
+    n = buildSnapshot(sys.argv[1], sys.argv[2])
+    print "%i taxon ids written to %s"%(n, sys.argv[2])
@@ -0,0 +1,45 @@
+"""Synthetic taxonomy and samples of benchmark.py, small enough for the tests that run MetaTax end to end.
+The taxonomy snapshot is built once per process, in a temporary directory.
+"""
+
+import sys, os, atexit, shutil, tempfile
+from os.path import join
+myPath = os.path.split( os.path.abspath(__file__) )[0]
+sys.path.insert(0, os.path.join(myPath, ".."))
+sys.path.insert(0, os.path.join(myPath, "..", "plugins"))
+import benchmark
+
+_taxonomy = None
+
+def taxonomy():
+    """Returns (snapshot file, list of species taxon IDs, dictionary taxon ID -> parent) of a small taxonomy.
+    """
+    global _taxonomy
+    if _taxonomy is None:
+        dirName = tempfile.mkdtemp(prefix = "metaTaxTests")
+        atexit.register(shutil.rmtree, dirName, True)
+        _taxonomy = benchmark.makeTaxonomy(dirName, nSpecies = 40)
+    return _taxonomy
+
+def snapshot():
+    return taxonomy()[0]
+
+def writeSample(dirName, nReads = 400, nTools = 4, seed = 0):
+    """Writes a sample (reads file and the outputs of nTools classifiers, see benchmark.makeSample()) to dirName.
+    Returns:
+        the input file for metaTax.py.
+    """
+    _, species, parent = taxonomy()
+    return benchmark.makeSample(dirName, species, parent, nReads, nTools, disagreement = 0.3, missing = 0.1, seed = seed)
+
+def outputFiles(outDir):
+    """Returns a dictionary file name -> contents of the result files (TSV) of an output directory.
+    """
+    return dict((name, open(join(outDir, name), "rt").read()) for name in sorted(os.listdir(outDir))
+                if name.endswith(".tsv"))
+
+def sortedLines(outputs):
+    """Returns the outputs of outputFiles() with the lines of each file sorted (for runs that write the reads
+    in another order).
+    """
+    return dict((name, sorted(text.splitlines())) for name, text in outputs.iteritems())
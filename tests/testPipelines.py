@@ -0,0 +1,129 @@
+"""Equivalence of the other execution modes of metaTax.py with the default one (classifier tables in memory),
+on a small synthetic sample (see synthetic.py).
+"""
+
+import os, random, shutil, tempfile, resource, unittest
+from os.path import join
+import synthetic
+import config, metaTax, bucketTables, sampleScheduler, shardMerge, streaming, pluginRegistry
+from util import readBucket
+
+def setUpModule():
+    global dirName, inputFile, expected
+    dirName   = tempfile.mkdtemp(prefix = "metaTaxPipelines")
+    inputFile = synthetic.writeSample(dirName)
+    expected  = run("table")
+
+def tearDownModule():
+    shutil.rmtree(dirName, True)
+
+def run(outName, *options):
+    """Runs metaTax.py on the sample with -lineage and the given options, and returns its outputs (see
+    synthetic.outputFiles()).
+    """
+    return runInput(inputFile, outName, *options)
+
+def runInput(sourceFile, outName, *options):
+    outDir = join(dirName, outName)
+    failed = metaTax.run(metaTax.parseArguments([sourceFile, outDir, "-lineage", "-taxonomy", synthetic.snapshot()] + list(options)))
+    assert len(failed) == 0
+    return synthetic.outputFiles(outDir)
+
+def classifierOutputs():
+    return [c['classifData'] for c in metaTax.loadInput(inputFile).values()[0]]
+
+class BucketTablesTest(unittest.TestCase):
+    def maxMemory(self, buckets):
+        """Returns a -max-memory value that splits the tables of the sample in about 'buckets' buckets.
+        """
+        tables = sampleScheduler.estimateFootprint(classifierOutputs()) - config.sampleBaseMemory
+        return "%r"%(config.sampleBaseMemory + tables/buckets)
+
+    def testBuckets(self):
+        maxMemory = self.maxMemory(8)
+        self.assertTrue(bucketTables.bucketCount(classifierOutputs(), float(maxMemory)) > 1)
+        outputs = run("buckets", "-max-memory", maxMemory)
+        self.assertEqual(sorted(outputs.keys()), sorted(expected.keys()))
+        self.assertEqual(synthetic.sortedLines(outputs), synthetic.sortedLines(expected))
+
+    def testBucketsWorkers(self):
+        outputs = run("bucketsWorkers", "-max-memory", self.maxMemory(3), "-loaders", "2", "-workers", "2")
+        self.assertEqual(synthetic.sortedLines(outputs), synthetic.sortedLines(expected))
+
+    def testBucketsNoReads(self):
+        outputs = run("bucketsNoReads", "-max-memory", self.maxMemory(5), "-no-reads")
+        noReads = run("noReads", "-no-reads")
+        self.assertEqual(synthetic.sortedLines(outputs), synthetic.sortedLines(noReads))
+
+    def testOpenFilesLimit(self):
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (config.reservedFiles + 50, hard))
+        try:
+            self.assertEqual(bucketTables.maxBuckets(2), 50 - 2*config.filesPerWorker)
+            self.assertEqual(bucketTables.bucketCount(classifierOutputs(), config.sampleBaseMemory + 1e-6, 2), 50 - 2*config.filesPerWorker)
+            outputs = run("bucketsLimit", "-max-memory", self.maxMemory(1000))
+        finally:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+        self.assertEqual(synthetic.sortedLines(outputs), synthetic.sortedLines(expected))
+
+class ShardTest(unittest.TestCase):
+    def runShards(self, name, n, *options):
+        """Runs the n shards of the sample and merges them. Returns (outputs of each shard, merged outputs).
+        """
+        shards = [run("%s_%i"%(name, i), "-shard", "%i/%i"%(i, n), *options) for i in range(n)]
+        shardMerge.mergeShards(inputFile, join(dirName, name), [join(dirName, "%s_%i"%(name, i)) for i in reversed(range(n))])
+        return shards, synthetic.outputFiles(join(dirName, name))
+
+    def testMerge(self):
+        shards, merged = self.runShards("shards", 3)
+        self.assertEqual(merged, expected)
+        # Each read is classified by the shard its name hashes to
+        for i, outputs in enumerate(shards):
+            reads = [l.split("\t", 1)[0] for l in outputs["reads.fa_lineage.tsv"].splitlines()]
+            self.assertTrue(len(reads) > 0)
+            self.assertEqual([readBucket(r, 3) for r in reads], [i]*len(reads))
+
+    def testMergeProfile(self):
+        _, merged = self.runShards("shardsProfile", 2, "-profile")
+        self.assertEqual(merged, run("profile", "-profile"))
+
+    def testMergeBuckets(self):
+        tables = sampleScheduler.estimateFootprint(classifierOutputs()) - config.sampleBaseMemory
+        _, merged = self.runShards("shardsBuckets", 2, "-max-memory", "%r"%(config.sampleBaseMemory + tables/8))
+        self.assertEqual(synthetic.sortedLines(merged), synthetic.sortedLines(expected))
+
+    def testMissingShard(self):
+        self.runShards("shardsMissing", 2)
+        self.assertRaises(ValueError, shardMerge.mergeShards, inputFile, join(dirName, "shardsMissing"), [join(dirName, "shardsMissing_0")])
+
+class StreamingTest(unittest.TestCase):
+    def testOrdered(self):
+        self.assertEqual(run("ordered", "-stream", "ordered"), expected)
+
+    def testSorted(self):
+        """Reads sorted by name, and classifier outputs shuffled and then sorted with streaming.externalSort()
+        in several chunks.
+        """
+        rnd   = random.Random(0)
+        lines = open(inputFile, "rt").read().split("\n")
+        reads = open(lines[0], "rt").read().split("\n")[:-1]
+        records = sorted(zip(reads[0::2], reads[1::2]), key = lambda r: metaTax.normalizeReadName(r[0]))
+        os.mkdir(join(dirName, "sorted"))
+        lines[0] = join(dirName, "sorted", "reads.fa") # Same prefix of the outputs as the reads file of the sample
+        open(lines[0], "wt").write("".join("%s\n%s\n"%r for r in records))
+        for i in range(2, 2 + 2*int(lines[1]), 2):
+            spec = pluginRegistry.getPlugin(lines[i]).params
+            body = open(lines[i + 1], "rt").readlines()
+            header, body = (body[:1], body[1:]) if spec.get('skipHeader', True) else ([], body)
+            rnd.shuffle(body)
+            shuffled = join(dirName, "shuffled_%i"%i)
+            open(shuffled, "wt").write("".join(header + body))
+            lines[i + 1] = join(dirName, "sorted_%i"%i)
+            streaming.externalSort(shuffled, lines[i + 1], chunkSize = 50, **spec)
+        sortedInput = join(dirName, "sorted.txt")
+        open(sortedInput, "wt").write("\n".join(lines))
+        self.assertEqual(runInput(sortedInput, "sorted", "-stream", "sorted"), runInput(sortedInput, "sortedTable"))
+        self.assertEqual(synthetic.sortedLines(runInput(sortedInput, "sortedTable")), synthetic.sortedLines(expected))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+"""Test of the MetaTax server (metaTaxServer.py) with a local client: a server is started on a temporary
+Unix socket, and jobs are submitted, queried and the server stopped through the client functions.
+"""
+
+import sys, os, time, shutil, tempfile, subprocess, unittest
+from os.path import join
+import synthetic
+import metaTax, metaTaxServer
+
+ROOT = join(synthetic.myPath, "..")
+
+class ServerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dirName = tempfile.mkdtemp(prefix = "metaTaxServer")
+        cls.input   = synthetic.writeSample(cls.dirName)
+        cls.socket  = join(cls.dirName, "metatax.sock")
+        metaTax.run(metaTax.parseArguments([cls.input, join(cls.dirName, "table"), "-lineage", "-taxonomy", synthetic.snapshot()]))
+        cls.server = subprocess.Popen([sys.executable, join(ROOT, "metaTaxServer.py"), "start", cls.socket, "-taxonomy",
+                                       synthetic.snapshot(), "-jobs", "2"], stdout = open(os.devnull, "w"), stderr = subprocess.STDOUT)
+        start = time.time()
+        while not os.path.exists(cls.socket) and cls.server.poll() is None and time.time() - start < 60:
+            time.sleep(0.1)
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.server.poll() is None:
+            cls.server.kill()
+        cls.server.wait()
+        shutil.rmtree(cls.dirName, True)
+
+    def test1Submit(self):
+        outDir = join(self.dirName, "server")
+        reply  = metaTaxServer.submit(self.socket, self.input, outDir, ["-lineage"])
+        self.assertEqual(reply['state'], "queued", reply)
+        job = metaTaxServer.wait(self.socket, reply['job'], 0.1)
+        self.assertEqual(job['state'], "finished", job)
+        self.assertEqual(synthetic.outputFiles(outDir), synthetic.outputFiles(join(self.dirName, "table")))
+
+    def test2Status(self):
+        reply = metaTaxServer.request(self.socket, {'command': "status"})
+        self.assertEqual([job['state'] for job in reply['jobs']], ["finished"])
+        self.assertTrue(reply['lineages'] > 0)
+        self.assertEqual(metaTaxServer.request(self.socket, {'command': "status", 'job': "job1"})['job']['id'], "job1")
+        self.assertIn('error', metaTaxServer.request(self.socket, {'command': "status", 'job': "job9"}))
+
+    def test3InvalidJobs(self):
+        outDir = join(self.dirName, "invalid")
+        for options in [["--help"], ["-h"], ["-no-such-option"], ["-no-reads", "-stream", "ordered"]]:
+            self.assertIn('error', metaTaxServer.submit(self.socket, self.input, outDir, options), options)
+        self.assertIn('error', metaTaxServer.submit(self.socket, join(self.dirName, "missing.txt"), outDir))
+        self.assertIn('error', metaTaxServer.request(self.socket, {'command': "unknown"}))
+        self.assertEqual(len(metaTaxServer.request(self.socket, {'command': "status"})['jobs']), 1)
+
+    def test4Stop(self):
+        self.assertEqual(metaTaxServer.request(self.socket, {'command': "stop"})['state'], "stopping")
+        self.assertIn('error', metaTaxServer.submit(self.socket, self.input, join(self.dirName, "late")))
+        start = time.time()
+        while self.server.poll() is None and time.time() - start < 30:
+            time.sleep(0.1)
+        self.assertEqual(self.server.poll(), 0)
+        self.assertFalse(os.path.exists(self.socket))
+
+if __name__ == "__main__":
+    unittest.main()
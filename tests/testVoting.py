@@ -0,0 +1,143 @@
+"""Differential tests of the voting engines against ClassTree, the reference implementation of the
+multilevel voting algorithm. Run them from the root of the repository with:
+
+    python -m unittest discover tests
+"""
+
+import sys, os, unittest, numpy as np
+from collections import OrderedDict
+myPath = os.path.split( os.path.abspath(__file__) )[0]
+sys.path.insert(0, os.path.join(myPath, ".."))
+sys.path.insert(0, os.path.join(myPath, "..", "plugins"))
+import config, multiLevelVoting, classifierTables
+from multiLevelVoting import ClassTree, PrefixTree, VotingCache, BatchVoting, randomLineageLists, classTreeClassifications
+
+def lineage(*taxIds):
+    """Lineage with the given taxon IDs at the first ranks of config.allowedRank (None skips a rank).
+    """
+    return OrderedDict((r, t) for r, t in zip(config.allowedRank, taxIds) if t is not None)
+
+# Hand-written combinations of lineages (one list per read)
+CASES = {
+    'consistent':   [lineage(1, 2, 3, 4, 5), lineage(1, 2, 3, 4), lineage(1, 2, 3, 4, 5, 6), lineage(1, 2, 7)],
+    'conflicting':  [lineage(1, 2, 3, 4, 5), lineage(1, 2, 3, 8, 9), lineage(1, 2, 10), lineage(11, 12, 13)],
+    'inconsistent': [lineage(1, 2, 3, 4), lineage(1, 5, 3, 4), lineage(1, 5, 3)], # Same taxa, other ancestors
+    'single':       [lineage(1, 2, 3, 4, 5, 6, 7)],
+    'identical':    [lineage(1, 2, 3, 4), lineage(1, 2, 3, 4), lineage(1, 2, 3, 4)],
+    'missingRanks': [lineage(1, None, 3, 4), lineage(1, 2, 3), lineage(1, None, 3, 4, None, 6)],
+    'disagreement': [lineage(1, 2, 3), lineage(4, 5, 6)],
+}
+
+def tablesOf(lineageLists):
+    """Returns ClassifierTables with the lineage matrix of the lineages of lineageLists (each distinct
+    lineage gets its own taxon ID) and the calls of each read, padded with None to the same number of tools.
+    """
+    nTools = max(len(l) for l in lineageLists)
+    ids    = {}
+    calls  = []
+    for lineages in lineageLists:
+        calls.append([ids.setdefault(tuple(l.items()), len(ids) + 1) for l in lineages] + [None]*(nTools - len(lineages)))
+    tables = classifierTables.ClassifierTables()
+    tables.taxIds = np.arange(1, len(ids) + 1)
+    tables.lineageMatrix = np.zeros((len(config.allowedRank), len(ids)), dtype=np.int32)
+    for items, taxId in ids.iteritems():
+        for r, t in items:
+            tables.lineageMatrix[config.allowedRank.index(r), taxId - 1] = t
+    tables.codes = np.zeros((nTools, len(lineageLists)), dtype=np.int32)
+    return tables, calls
+
+class BatchVotingTest(unittest.TestCase):
+    def check(self, lineageLists):
+        expected = classTreeClassifications(lineageLists)
+        self.assertEqual(BatchVoting().getClassifications(lineageLists), expected)
+        # Matrix indexed from the lineage matrix of the tables
+        tables, calls = tablesOf([l for l in lineageLists if len(l) > 0])
+        withLineages  = [l for l in lineageLists if len(l) > 0]
+        self.assertEqual(BatchVoting(tables = tables).getClassifications(withLineages, calls),
+                         [e for l, e in zip(lineageLists, expected) if len(l) > 0])
+
+    def testCases(self):
+        for name, lineages in sorted(CASES.items()):
+            self.check([lineages])
+        self.check(CASES.values() + [[]])
+
+    def testDisagreement(self):
+        self.assertEqual(BatchVoting().getClassifications([CASES['disagreement']])[0][0], "disagreement")
+
+    def testRandomConsistent(self):
+        self.check(randomLineageLists(3000, seed = 1, consistent = True))
+
+    def testRandomConflicting(self):
+        self.check(randomLineageLists(3000, seed = 2, consistent = False))
+
+    def testCheckFunction(self):
+        self.assertEqual(multiLevelVoting.checkBatchClassification(1000), 0)
+
+class PrefixTreeTest(unittest.TestCase):
+    def classify(self, engine, lineages):
+        for l in lineages:
+            engine.addClassification(l)
+        return engine.getClassification()
+
+    def check(self, lineageLists):
+        for lineages in lineageLists:
+            if len(lineages) > 0:
+                self.assertEqual(self.classify(PrefixTree(), lineages), self.classify(ClassTree(), lineages), lineages)
+
+    def testConsistent(self):
+        self.check([CASES['consistent'], CASES['missingRanks']])
+
+    def testConflicting(self):
+        self.check([CASES['conflicting'], CASES['inconsistent']])
+
+    def testSingle(self):
+        self.check([CASES['single']])
+        self.assertEqual(self.classify(PrefixTree(), CASES['single'])[4], CASES['single'][0])
+
+    def testIdentical(self):
+        self.check([CASES['identical']])
+        self.assertEqual(self.classify(PrefixTree(), CASES['identical'])[2], 3) # votes
+
+    def testDisagreement(self):
+        self.check([CASES['disagreement']])
+        prefixTree = PrefixTree()
+        self.assertEqual(self.classify(prefixTree, CASES['disagreement'])[0], "disagreement")
+        self.assertEqual(prefixTree.pruned, 3) # Pruned down to the first rank
+
+    def testRandomConsistent(self):
+        self.check(randomLineageLists(3000, seed = 1, consistent = True))
+
+    def testRandomConflicting(self):
+        self.check(randomLineageLists(3000, seed = 2, consistent = False))
+
+    def testCheckFunction(self):
+        self.assertEqual(multiLevelVoting.checkPrefixTree(1000), 0)
+
+class VotingCacheTest(unittest.TestCase):
+    def check(self, lineageLists, voter = None):
+        voter = voter or VotingCache()
+        self.assertEqual(voter.getClassifications(lineageLists), classTreeClassifications(lineageLists))
+
+    def testCases(self):
+        for name, lineages in sorted(CASES.items()):
+            self.check([lineages], VotingCache(maxSize = 0))
+        self.check([CASES['consistent'], CASES['identical'], CASES['missingRanks'], CASES['disagreement'], []]*3)
+
+    def testOrder(self):
+        # Ties between lineages with missing ranks depend on the order of the classifiers
+        lineages = [lineage(31, None, 63, 157), lineage(31, 55, None, 69)]
+        voter = VotingCache()
+        self.check([lineages, lineages[::-1], lineages], voter)
+        self.assertEqual(voter.hits, 1)
+
+    def testRandomConsistent(self):
+        self.check(randomLineageLists(3000, seed = 1, consistent = True))
+
+    def testRandomConflicting(self):
+        self.check(randomLineageLists(3000, seed = 2, consistent = False), VotingCache(maxSize = 0))
+
+    def testCheckFunction(self):
+        self.assertEqual(multiLevelVoting.checkVotingCache(1000), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,3 +1,4 @@
+import zlib
 from collections import OrderedDict
 
 # ----------------------------------------------
@@ -7,3 +8,16 @@ def isNA(lineage):
     if "root" in lineage.keys() and lineage["root"] == "0":
         return True
     return False
+
+def readBucket(name, n, stride = 1):
+    """Returns the bucket (0 to n - 1) of a normalized read name. It is computed from the CRC-32 of the
+    name, so it is the same in all processes, runs and nodes. Buckets of the reads of a shard of N shards
+    (see the -shard option of metaTax.py) use stride N, so that they do not depend on the shard.
+    """
+    return ((zlib.crc32(name) & 0xffffffff)//stride) % n
+
+def readBuckets(names, n, stride = 1):
+    """Same as readBucket() for a list of read names. Returns a list.
+    """
+    crc32 = zlib.crc32
+    return [((crc32(name) & 0xffffffff)//stride) % n for name in names]